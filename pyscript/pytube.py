@@ -1,6 +1,7 @@
 import os
 import requests
 import random
+import uuid
 import asyncio
 import glob
 from datetime import datetime, timezone, timedelta
@@ -12,14 +13,19 @@ from utils import create_date_state
 __PYTUBE_BASE_URL = 'http://127.0.0.1:114'        # Base URL for your PyTube API server
 __PYTUBE_CACHE_DAY = 30                           # Cache duration in days (30 days = 1 month). Songs won't be played until cache expires or playlist completes
 __PYTUBE_TIME_OUT = 90                            # API request timeout in seconds
+__PYTUBE_READ_AHEAD_TRACKS = 2                    # Songs the server keeps downloaded after the current one (0 = off)
 
 # App config
 __PYTUBE_HEADER = { "Content-Type": "application/json" }
+__PYTUBE_REQUEST_ID_HEADER = "X-Request-Id"       # Same id in our logs and the server's logs/traces
+__PYTUBE_VIDEO_HEADER = { "Content-Type": "application/json", "X-Request-Deadline": str(__PYTUBE_TIME_OUT - 5) }   # Server stops trying strategies once our timeout can't be met
 __PYTUBE_MP3_FOLDER = "/config/www/tts"
 __PYTUBE_MEDIA_CACHE_FOLDER = '/config/pyscript/cache'
 __PYTUBE_MEDIA_CACHE_FILE_PATH = f'{__PYTUBE_MEDIA_CACHE_FOLDER}/pytube_media_cache.json'
 __PYTUBE_MIN_ACCEPT_TOTAL_SONG_IN_PLAYLIST = 2
 __PYTUBE_MAX_ATTEMPT = 5
+__PYTUBE_JOB_POLL_WAIT = 5                        # Seconds the server may hold each job status request
+__PYTUBE_JOB_POLL_INTERVAL = 1                    # Seconds to sleep between job status requests
 
 class __MediaPlayerStatus:
     OFF = "off"                     # The media player is turned off and is not accepting commands until turned on
@@ -44,6 +50,7 @@ class __MediaPlayer:
         playlist: list = None,
         original_playlist: list = None,
         seek_position: float = None,
+        start_offset: float = 0,
         play_time_check: bool = False,
         shuffle: bool = False
     ):
@@ -54,6 +61,7 @@ class __MediaPlayer:
         self.playing_remaining_time = playing_remaining_time
         self.playing_attempt = playing_attempt
         self.seek_position = seek_position
+        self.start_offset = start_offset  # Seconds into the song the served audio starts at
         self.playlist_url = playlist_url
         self.playlist = playlist if playlist is not None else []
         self.original_playlist = original_playlist if original_playlist is not None else [] 
@@ -72,6 +80,7 @@ class __MediaPlayer:
                 self.playing_remaining_time = dict.get("playing_remaining_time", self.playing_remaining_time)
                 self.playing_attempt = dict.get("playing_attempt", self.playing_attempt)
                 self.seek_position = dict.get("seek_position", self.seek_position)
+                self.start_offset = dict.get("start_offset", self.start_offset)
                 self.play_time_check = dict.get("play_time_check", self.play_time_check)
                 self.shuffle = dict.get("shuffle", self.shuffle)
                 self.playlist_url = dict.get("playlist_url", self.playlist_url)
@@ -102,6 +111,7 @@ class __MediaPlayer:
         playlist: list = None,
         original_playlist: list = None,
         seek_position: float = None,
+        start_offset: float = None,
         play_time_check: bool = None,
         shuffle: bool = None,
         save_to_cache: bool = True
@@ -114,6 +124,7 @@ class __MediaPlayer:
         __playing_remaining_time = playing_remaining_time if playing_remaining_time is not None else self.playing_remaining_time
         __playing_attempt = playing_attempt if playing_attempt is not None else self.playing_attempt        
         __seek_position = seek_position if seek_position is not None else self.seek_position
+        __start_offset = start_offset if start_offset is not None else self.start_offset
         __play_time_check = play_time_check if play_time_check is not None else self.play_time_check
         __shuffle = shuffle if shuffle is not None else self.shuffle
         __playlist_url = playlist_url if playlist_url is not None else self.playlist_url
@@ -130,6 +141,7 @@ class __MediaPlayer:
         self.playlist = __playlist
         self.original_playlist = __original_playlist
         self.seek_position = __seek_position
+        self.start_offset = __start_offset
         self.shuffle = __shuffle
         self.play_time_check = __play_time_check
 
@@ -142,6 +154,7 @@ class __MediaPlayer:
                 "playing_remaining_time": self.playing_remaining_time,
                 "playing_attempt": self.playing_attempt,
                 "seek_position": self.seek_position,
+                "start_offset": self.start_offset,
                 "play_time_check": self.play_time_check,
                 "shuffle": self.shuffle,
                 "playlist_url": self.playlist_url,
@@ -260,8 +273,9 @@ class __MediaPlayer:
 
             media_playing_time = now - media_position_updated_at
             elapsed_since_update = media_playing_time.total_seconds()
-            media_playing_current_time = media_position + elapsed_since_update
-            media_playing_remaining_time = media_duration - media_playing_current_time
+            # The speaker only knows the audio it was given, which may start part way into the song
+            media_playing_remaining_time = media_duration - (media_position + elapsed_since_update)
+            media_playing_current_time = self.start_offset + media_position + elapsed_since_update
 
             self.update_play_status(
                 playing_current_time = media_playing_current_time,
@@ -361,41 +375,93 @@ class __MediaService:
     @staticmethod
     def get_playlist(
         entity_id: str,
-        playlist_url: str
+        playlist_url: str,
+        request_id: str = None
     ): 
-        url = f'{__PYTUBE_BASE_URL}/v3/playlist?url={playlist_url}&device={entity_id}'
+        url = f'{__PYTUBE_BASE_URL}/v3/playlist?url={playlist_url}&device={entity_id}&unavailable=omit'
         try:
-            response = task.executor(requests.get, url, headers=__PYTUBE_HEADER, timeout=__PYTUBE_TIME_OUT)
+            response = task.executor(requests.get, url, headers=__MediaService.with_request_id(__PYTUBE_HEADER, request_id), timeout=__PYTUBE_TIME_OUT)
             if response.status_code == 200:
                 return response.json()
             else:
-                log.error(f"❌ [Pytube][get_playlist] Failed with status {response.status_code}: {response.text}")
+                log.error(f"❌ [Pytube][get_playlist][{request_id}] Failed with status {response.status_code}: {response.text}")
                 return None
         except Exception as e:
-            log.error(f"❌ [Pytube][get_playlist] Exception occurred: {e}")
+            log.error(f"❌ [Pytube][get_playlist][{request_id}] Exception occurred: {e}")
             return None
 
+    @staticmethod
+    def with_request_id(
+        header: dict,
+        request_id: str
+    ):
+        if not request_id:
+            return header
+        request_header = dict(header)
+        request_header[__PYTUBE_REQUEST_ID_HEADER] = request_id
+        return request_header
+
     @staticmethod
     def get_video_info(
         entity_id: str,
-        video_id: str
+        video_id: str,
+        request_id: str = None
     ):
-        log.info(f"[Pytube][get_video_info] Getting video info with id={video_id}....")
-        return __MediaService.__get_video_info_v3(entity_id, video_id)
+        log.info(f"[Pytube][get_video_info][{request_id}] Getting video info with id={video_id}....")
+        return __MediaService.__get_video_info_v3(entity_id, video_id, request_id)
+
+    @staticmethod
+    def update_read_ahead(
+        entity_id: str,
+        playlist: list,
+        song_index: int,
+        request_id: str = None
+    ):
+        if __PYTUBE_READ_AHEAD_TRACKS <= 0:
+            return None
+
+        url = f'{__PYTUBE_BASE_URL}/v3/readahead'
+        data = {
+            "device": entity_id,
+            "video_ids": [item.get("video_id", "") for item in playlist],
+            "cursor": song_index,
+            "count": __PYTUBE_READ_AHEAD_TRACKS
+        }
+        try:
+            response = task.executor(requests.post, url, json=data, headers=__MediaService.with_request_id(__PYTUBE_HEADER, request_id), timeout=15)
+            if response.status_code == 202:
+                return response.json()
+            else:
+                log.warning(f"[Pytube][update_read_ahead] Failed with status {response.status_code}: {response.text}")
+                return None
+        except Exception as e:
+            log.warning(f"[Pytube][update_read_ahead] Exception occurred: {e}")
+            return None
+
+    @staticmethod
+    def cancel_read_ahead(
+        entity_id: str
+    ):
+        url = f'{__PYTUBE_BASE_URL}/v3/readahead?device={entity_id}'
+        try:
+            task.executor(requests.delete, url, headers=__PYTUBE_HEADER, timeout=15)
+        except Exception as e:
+            log.warning(f"[Pytube][cancel_read_ahead] Exception occurred: {e}")
 
     @staticmethod
     def download_mp3_file(
-        mp3_path: str
+        mp3_path: str,
+        request_id: str = None
     ):
         url = f'{__PYTUBE_BASE_URL}/{mp3_path}'
         try:
-            response = task.executor(requests.get, url, headers=__PYTUBE_HEADER, timeout=__PYTUBE_TIME_OUT)
+            response = task.executor(requests.get, url, headers=__MediaService.with_request_id(__PYTUBE_HEADER, request_id), timeout=__PYTUBE_TIME_OUT)
             if response.status_code == 200:
                 return response.content
             else:
                 return None
         except Exception as e:
-            log.error(f"❌ [Pytube][download_mp3_file] Exception occurred: {e}")
+            log.error(f"❌ [Pytube][download_mp3_file][{request_id}] Exception occurred: {e}")
             return None
 
     @staticmethod
@@ -418,20 +484,49 @@ class __MediaService:
     @staticmethod
     def __get_video_info_v3(
         entity_id: str,
-        video_id: str
+        video_id: str,
+        request_id: str = None
     ):
-        url = f'{__PYTUBE_BASE_URL}/v3/video/{video_id}?device={entity_id}'
+        url = f'{__PYTUBE_BASE_URL}/v3/video/{video_id}?device={entity_id}&mode=async'
         try:
-            response = task.executor(requests.get, url, headers=__PYTUBE_HEADER, timeout=__PYTUBE_TIME_OUT)
+            response = task.executor(requests.get, url, headers=__MediaService.with_request_id(__PYTUBE_VIDEO_HEADER, request_id), timeout=__PYTUBE_TIME_OUT)
             if response.status_code == 200:
                 return response.json()
+            elif response.status_code == 202:
+                # Not cached yet: poll the download job instead of holding a connection
+                return __MediaService.__wait_for_video_job(response.json(), request_id)
             else:
-                log.error(f"❌ [Pytube][__get_video_info_v3] Failed with status {response.status_code}: {response.text}")
+                log.error(f"❌ [Pytube][__get_video_info_v3][{request_id}] Failed with status {response.status_code}: {response.text}")
                 return None
         except Exception as e:
-            log.error(f"❌ [Pytube][__get_video_info_v3] Exception occurred: {e}")
+            log.error(f"❌ [Pytube][__get_video_info_v3][{request_id}] Exception occurred: {e}")
+            return None
+
+    @staticmethod
+    def __wait_for_video_job(
+        job: dict,
+        request_id: str = None
+    ):
+        url = f'{__PYTUBE_BASE_URL}{job["status_url"]}&wait={__PYTUBE_JOB_POLL_WAIT}'
+        deadline = datetime.now() + timedelta(seconds=__PYTUBE_TIME_OUT)
+        try:
+            while datetime.now() < deadline:
+                response = task.executor(requests.get, url, headers=__MediaService.with_request_id(__PYTUBE_HEADER, request_id), timeout=__PYTUBE_JOB_POLL_WAIT + 10)
+                if response.status_code == 200:
+                    return response.json()["video_info"]
+                elif response.status_code != 202:
+                    log.error(f"❌ [Pytube][__wait_for_video_job][{request_id}] Failed with status {response.status_code}: {response.text}")
+                    return None
+                task.sleep(__PYTUBE_JOB_POLL_INTERVAL)
+            log.error(f"❌ [Pytube][__wait_for_video_job][{request_id}] Timed out after {__PYTUBE_TIME_OUT}s waiting for job {job['job_id']}")
+            return None
+        except Exception as e:
+            log.error(f"❌ [Pytube][__wait_for_video_job][{request_id}] Exception occurred: {e}")
             return None
 
+def __new_request_id():
+    return uuid.uuid4().hex[:16]
+
 def __is_more_than_days(
     initial_date_str: str, 
     days: float = __PYTUBE_CACHE_DAY
@@ -452,7 +547,8 @@ async def __pytube_play(
     video_id: str,
     video_title: str,
     video_thumnnail: str,
-    mp3_path: str
+    mp3_path: str,
+    request_id: str = None
 ):
     pytube_media_player = __MediaPlayerManager.get_media_player(entity_id = entity_id)
     try:
@@ -467,7 +563,8 @@ async def __pytube_play(
 
         log.info(f"[Pytube][__pytube_play][{entity_id}] Downloading song... {video_id}/{video_title}")
         data = __MediaService.download_mp3_file(
-            mp3_path = mp3_path
+            mp3_path = mp3_path,
+            request_id = request_id
         )
         
         if data is None:
@@ -527,9 +624,13 @@ async def __pytube_goto_song_at_index(
         pytube_media_player.song_play_index = song_index
         playlist_item = pytube_media_player.playlist[song_index]
         video_id = playlist_item["video_id"]
+        # One id for every server call of this track change, so the server's log lines and traces match ours
+        request_id = __new_request_id()
+        started_at = datetime.now()
         video_info = __MediaService.get_video_info(
             entity_id = entity_id,
-            video_id = video_id
+            video_id = video_id,
+            request_id = request_id
         )
         log.info(f"[Pytube][__pytube_goto_song_at_index][{entity_id}] video_info = {video_info}")
 
@@ -537,10 +638,21 @@ async def __pytube_goto_song_at_index(
             log.error(f"❌ [Pytube][__pytube_goto_song_at_index][{entity_id}] Error when getting the video info. Reason: video_info = None")
             return False
 
+        # Let the server prepare the next songs while this one plays
+        __MediaService.update_read_ahead(
+            entity_id = entity_id,
+            playlist = pytube_media_player.playlist,
+            song_index = song_index,
+            request_id = request_id
+        )
 
         video_title = video_info["video_title"]
         video_thumbnail_url = video_info["video_thumbnail_url"]
         mp3_path = video_info["mp3_url"]
+        # Resume: the server cuts the audio at the paused position, so there is nothing to seek
+        start_offset = seek_position if seek_position is not None and seek_position > 0 else 0
+        if start_offset > 0:
+            mp3_path = f"{mp3_path}&start={start_offset:.1f}"
         is_loaded_from_cache = video_info["is_loaded_from_cache"]
 
         video_title = f"[{song_index + 1}/{playlist_size}] {video_title}"
@@ -554,26 +666,16 @@ async def __pytube_goto_song_at_index(
                 video_id = video_id,
                 video_title = video_title,
                 video_thumnnail = video_thumbnail_url,
-                mp3_path = mp3_path
+                mp3_path = mp3_path,
+                request_id = request_id
             )
+        log.info(f"[Pytube][__pytube_goto_song_at_index][{entity_id}][{request_id}] Track change took {(datetime.now() - started_at).total_seconds():.1f}s -- success={result}")
 
         if result:
-            # seek to position if needed
-            if seek_position is not None and seek_position > 0:
-                # Delay time, the media player need to time to load mp3 file
-                await asyncio.sleep(2)
-                await hass.services.async_call(
-                    "media_player", 
-                    "media_seek",
-                    {
-                        "entity_id": entity_id,
-                        "seek_position": seek_position
-                    }
-                )
-
             pytube_media_player.update_play_status(
                 status = __MediaPlayerStatus.PLAYING,
                 seek_position = 0,
+                start_offset = start_offset,
                 playing_attempt = 0
             )
 
@@ -694,7 +796,8 @@ async def pytube_play_playlist(
 
     original_playlist = __MediaService.get_playlist(
         entity_id = entity_id,
-        playlist_url = playlist_url
+        playlist_url = playlist_url,
+        request_id = __new_request_id()
     )
 
     if original_playlist is None or original_playlist == []:
@@ -944,6 +1047,9 @@ async def pytube_stop(
             seek_position = None
         )
         
+        # Stop preparing songs for this media player
+        __MediaService.cancel_read_ahead(entity_id = entity_id)
+
         # Remove from manager (this will also stop the listener)
         __MediaPlayerManager.remove_media_player_sync(entity_id = entity_id)
         
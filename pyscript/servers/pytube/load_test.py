@@ -0,0 +1,460 @@
+import os
+import sys
+import json
+import time
+import types
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.cookiejar
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qs, urlparse, quote
+from urllib.request import Request, urlopen
+
+# Configuration
+DEFAULT_SPEAKERS = 5
+DEFAULT_DURATION = 120  # Seconds of traffic to generate
+DEFAULT_TIME_FACTOR = 60  # Tracks play this many times faster than real time
+DEFAULT_PLAYLISTS = 3  # Stub playlists shared by the speakers
+DEFAULT_TRACKS = 40  # Tracks per stub playlist
+DEFAULT_STUB_PORT = 11400
+DEFAULT_STUB_LATENCY = (1.0, 3.0)  # Seconds (min, max) a stubbed download takes
+DEFAULT_STUB_CPU = 0.2  # Seconds of pure-Python work per stubbed extraction, like signature deciphering
+DEFAULT_STUB_MP3_SIZE = 512 * 1024  # Bytes written for every stubbed track
+STUB_TRACK_DURATION = (150, 330)  # Track durations (seconds) reported by the stub
+STUB_ENV = 'PYTUBE_LOAD_TEST_STUB'  # JSON stub settings, inherited by the extraction workers
+READ_AHEAD_TRACKS = 2  # Same as the pyscript client
+REQUEST_TIME_OUT = 90  # Same as the pyscript client
+DEADLINE_HEADER_VALUE = str(REQUEST_TIME_OUT - 5)
+JOB_POLL_WAIT = 5
+JOB_POLL_INTERVAL = 1
+SERVER_START_TIME_OUT = 30
+
+
+def log(message):
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+
+# ================= Stub YouTube backend =================
+
+def get_stub_settings():
+    return json.loads(os.environ.get(STUB_ENV) or '{}')
+
+
+def get_stub_track_duration(video_id):
+    return random.Random(video_id).randint(*STUB_TRACK_DURATION)
+
+
+def get_stub_video_id(playlist_index, track_index):
+    """11-character video id, like YouTube's"""
+    return f"L{playlist_index:02d}{track_index:08d}"
+
+
+def get_stub_playlist_url(playlist_index, tracks):
+    return f"https://www.youtube.com/playlist?list=LOADTEST{playlist_index:02d}N{tracks}"
+
+
+class StubYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL: synthetic playlists and downloads, no network"""
+
+    def __init__(self, params=None):
+        self.params = params or {}
+        self.settings = get_stub_settings()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def extract_info(self, url, download=True, **kwargs):
+        query = parse_qs(urlparse(url).query)
+        if 'list' in query:
+            return self._extract_playlist(query['list'][0])
+        return self._extract_video(query['v'][0], download)
+
+    def _extract_playlist(self, playlist_id):
+        playlist_index, tracks = playlist_id[len('LOADTEST'):].split('N')
+        entries = []
+        for track_index in range(int(tracks)):
+            video_id = get_stub_video_id(int(playlist_index), track_index)
+            entries.append({
+                'id': video_id,
+                'title': f"Load test track {video_id}",
+                'duration': get_stub_track_duration(video_id)
+            })
+        return {'id': playlist_id, 'entries': entries}
+
+    def _extract_video(self, video_id, download):
+        # Burn CPU like signature deciphering does, then wait like the network would
+        cpu_until = time.time() + self.settings.get('cpu', DEFAULT_STUB_CPU)
+        while time.time() < cpu_until:
+            sum(i * i for i in range(1000))
+
+        info = {
+            'id': video_id,
+            'title': f"Load test track {video_id}",
+            'duration': get_stub_track_duration(video_id),
+            'thumbnail': '',
+            'formats': [{'format_id': '251', 'acodec': 'opus', 'vcodec': 'none', 'abr': 128, 'ext': 'webm'}],
+            'format_id': '251',
+            'acodec': 'opus',
+            'abr': 128,
+            'ext': 'webm',
+            'filesize': self.settings.get('mp3_size', DEFAULT_STUB_MP3_SIZE)
+        }
+        if download:
+            self._download(info)
+        return info
+
+    def _download(self, info):
+        latency = random.uniform(*self.settings.get('latency', DEFAULT_STUB_LATENCY))
+        total_bytes = info['filesize']
+        path = self.params['outtmpl']
+        for key in ('title', 'id', 'ext'):
+            path = path.replace(f"%({key})s", str(info[key]))
+
+        steps = 10
+        with open(path, 'wb') as f:
+            for step in range(1, steps + 1):
+                time.sleep(latency / steps)
+                f.write(b'\0' * (total_bytes // steps))
+                for hook in self.params.get('progress_hooks', []):
+                    hook({
+                        'status': 'downloading',
+                        'downloaded_bytes': total_bytes * step // steps,
+                        'total_bytes': total_bytes,
+                        'speed': total_bytes / latency,
+                        'eta': latency * (steps - step) / steps
+                    })
+        for hook in self.params.get('progress_hooks', []):
+            hook({'status': 'finished', 'downloaded_bytes': total_bytes, 'total_bytes': total_bytes})
+
+
+class StubYouTube:
+    """Stands in for pytubefix objects, which the load test does not exercise"""
+
+    def __init__(self, *args, **kwargs):
+        raise Exception("pytubefix is not available in load tests")
+
+
+class StubCookieJar(http.cookiejar.MozillaCookieJar):
+    """Stands in for yt_dlp.cookies.YoutubeDLCookieJar, which keeps session and expired cookies by default"""
+
+    def load(self, filename=None, ignore_discard=True, ignore_expires=True):
+        super().load(filename, ignore_discard, ignore_expires)
+
+    def save(self, filename=None, ignore_discard=True, ignore_expires=True):
+        super().save(filename, ignore_discard, ignore_expires)
+
+
+def install_stub_backend():
+    """Replace yt_dlp and pytubefix before pytube_server imports them"""
+    yt_dlp_module = types.ModuleType('yt_dlp')
+    yt_dlp_module.YoutubeDL = StubYoutubeDL
+    yt_dlp_cookies_module = types.ModuleType('yt_dlp.cookies')
+    yt_dlp_cookies_module.YoutubeDLCookieJar = StubCookieJar
+    yt_dlp_module.cookies = yt_dlp_cookies_module
+    pytubefix_module = types.ModuleType('pytubefix')
+    pytubefix_module.YouTube = StubYouTube
+    pytubefix_module.Playlist = StubYouTube
+    pytubefix_cli_module = types.ModuleType('pytubefix.cli')
+    pytubefix_cli_module.on_progress = lambda stream, chunk, bytes_remaining: None
+    pytubefix_module.cli = pytubefix_cli_module
+    sys.modules.update({
+        'yt_dlp': yt_dlp_module,
+        'yt_dlp.cookies': yt_dlp_cookies_module,
+        'pytubefix': pytubefix_module,
+        'pytubefix.cli': pytubefix_cli_module
+    })
+
+
+# Extraction workers re-import this module, so they need the stub too
+if os.environ.get(STUB_ENV):
+    install_stub_backend()
+
+
+def serve_stub(port, settings):
+    """Run pytube_server on the stub backend with a throw-away cache directory"""
+    os.environ[STUB_ENV] = json.dumps(settings)
+    install_stub_backend()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import pytube_server as server
+
+    cache_dir = tempfile.mkdtemp(prefix='pytube_load_test_')
+    server.folder_path = cache_dir
+    server.thumbnail_folder_path = os.path.join(cache_dir, 'thumbs')
+    server.hls_folder_path = os.path.join(cache_dir, 'hls')
+    server.cache_index.path = os.path.join(cache_dir, 'cache_index.json')
+    server.failed_video_cache.path = os.path.join(cache_dir, 'failed_videos.json')
+    server.span_exporter.path = os.path.join(cache_dir, 'traces.jsonl')
+    server.SESSION_FOLDER = os.path.join(cache_dir, 'session')
+    server.SESSION_OAUTH_TOKEN_FILE = os.path.join(cache_dir, 'session', 'oauth_tokens.json')
+    server.YTDLP_CACHE_DIR = os.path.join(cache_dir, 'session', 'yt-dlp')
+    server.extraction_session = server.ExtractionSession(
+        os.path.join(cache_dir, 'session', 'cookies.txt'),
+        os.path.join(cache_dir, 'cookies.txt')
+    )
+    server.extraction_pool.start()
+
+    log(f"Stub server cache directory: {cache_dir}")
+    server.app.run(host='127.0.0.1', port=port, debug=False)
+
+
+def start_stub_server(port, settings, log_file):
+    """Start serve_stub in a child process and wait until it answers /health"""
+    command = [
+        sys.executable, os.path.abspath(__file__), '--serve-stub',
+        '--stub-port', str(port),
+        '--stub-latency', str(settings['latency'][0]), str(settings['latency'][1]),
+        '--stub-cpu', str(settings['cpu']),
+        '--stub-mp3-size', str(settings['mp3_size'])
+    ]
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+    server_url = f"http://127.0.0.1:{port}"
+    started_at = time.time()
+    while time.time() - started_at < SERVER_START_TIME_OUT:
+        if process.poll() is not None:
+            raise Exception(f"Stub server exited with code {process.returncode}, see {log_file.name}")
+        try:
+            with urlopen(f"{server_url}/health", timeout=1):
+                return process, server_url
+        except (URLError, OSError):
+            time.sleep(0.2)
+    process.terminate()
+    raise Exception(f"Stub server did not start within {SERVER_START_TIME_OUT}s, see {log_file.name}")
+
+
+# ================= Load generator =================
+
+class EndpointStats:
+    """Latency samples and error counts per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._errors = {}
+
+    def record(self, endpoint, latency, ok):
+        with self._lock:
+            self._latencies.setdefault(endpoint, []).append(latency)
+            if not ok:
+                self._errors[endpoint] = self._errors.get(endpoint, 0) + 1
+
+    @staticmethod
+    def percentile(samples, percent):
+        index = max(int(round(percent / 100.0 * len(samples))) - 1, 0)
+        return samples[min(index, len(samples) - 1)]
+
+    def summary(self, elapsed):
+        with self._lock:
+            result = {}
+            for endpoint, latencies in sorted(self._latencies.items()):
+                samples = sorted(latencies)
+                errors = self._errors.get(endpoint, 0)
+                result[endpoint] = {
+                    'requests': len(samples),
+                    'errors': errors,
+                    'error_rate': errors / len(samples),
+                    'per_second': len(samples) / elapsed if elapsed > 0 else 0,
+                    'p50_ms': self.percentile(samples, 50) * 1000,
+                    'p90_ms': self.percentile(samples, 90) * 1000,
+                    'p99_ms': self.percentile(samples, 99) * 1000,
+                    'max_ms': samples[-1] * 1000
+                }
+            return result
+
+
+def timed_request(stats, endpoint, url, method='GET', body=None, headers=None, timeout=REQUEST_TIME_OUT):
+    """Send one request, record its latency under endpoint and return (status, body)"""
+    request_headers = {'Content-Type': 'application/json'}
+    request_headers.update(headers or {})
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    started_at = time.time()
+    try:
+        with urlopen(Request(url, data=data, headers=request_headers, method=method), timeout=timeout) as response:
+            content = response.read()
+            status = response.status
+    except HTTPError as e:
+        content = e.read()
+        status = e.code
+    except Exception as e:
+        stats.record(endpoint, time.time() - started_at, False)
+        return None, str(e).encode('utf-8')
+    stats.record(endpoint, time.time() - started_at, 200 <= status < 300)
+    return status, content
+
+
+def get_video_info(stats, server_url, device, video_id):
+    """Resolve a track like the pyscript client: async video request, then job polling"""
+    status, content = timed_request(
+        stats, 'video', f"{server_url}/v3/video/{video_id}?device={quote(device)}&mode=async",
+        headers={'X-Request-Deadline': DEADLINE_HEADER_VALUE}
+    )
+    if status == 200:
+        return json.loads(content)
+    if status != 202:
+        return None
+
+    job = json.loads(content)
+    deadline = time.time() + REQUEST_TIME_OUT
+    while time.time() < deadline:
+        status, content = timed_request(
+            stats, 'job', f"{server_url}{job['status_url']}&wait={JOB_POLL_WAIT}", timeout=JOB_POLL_WAIT + 10
+        )
+        if status == 200:
+            return json.loads(content)['video_info']
+        if status != 202:
+            return None
+        time.sleep(JOB_POLL_INTERVAL)
+    return None
+
+
+def run_speaker(index, server_url, playlist_url, stop_at, time_factor, stats):
+    """One simulated speaker: load the playlist, then play its tracks until stop_at"""
+    rng = random.Random(index)
+    device = f"media_player.load_test_{index}"
+
+    playlist = None
+    while playlist is None and time.time() < stop_at:
+        status, content = timed_request(
+            stats, 'playlist',
+            f"{server_url}/v3/playlist?url={quote(playlist_url, safe='')}&device={quote(device)}&unavailable=omit"
+        )
+        if status == 200 and json.loads(content):
+            playlist = json.loads(content)
+        else:
+            time.sleep(5)
+
+    position = rng.randrange(len(playlist)) if playlist else 0
+    while playlist and time.time() < stop_at:
+        item = playlist[position]
+        started_at = time.time()
+        video_info = get_video_info(stats, server_url, device, item['video_id'])
+        played = False
+        if video_info:
+            timed_request(stats, 'readahead', f"{server_url}/v3/readahead", method='POST', body={
+                'device': device,
+                'video_ids': [track['video_id'] for track in playlist],
+                'cursor': position,
+                'count': READ_AHEAD_TRACKS
+            }, timeout=15)
+            status, content = timed_request(stats, 'mp3', f"{server_url}{video_info['mp3_url']}")
+            played = status == 200 and len(content) > 0
+        stats.record('track_change', time.time() - started_at, played)
+
+        if played:
+            duration = float(video_info.get('video_duration') or item.get('video_duration') or 0)
+            time.sleep(max(min(duration / time_factor, stop_at - time.time()), 0))
+        else:
+            time.sleep(1)
+        position = (position + 1) % len(playlist)
+
+    timed_request(stats, 'readahead_cancel', f"{server_url}/v3/readahead?device={quote(device)}",
+                  method='DELETE', timeout=15)
+
+
+def print_report(summary, elapsed, speakers):
+    log(f"Results for {speakers} speakers over {elapsed:.0f}s")
+    print(f"{'endpoint':<18}{'requests':>9}{'errors':>8}{'err %':>7}{'req/s':>8}"
+          f"{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for endpoint, row in summary.items():
+        print(f"{endpoint:<18}{row['requests']:>9}{row['errors']:>8}{row['error_rate'] * 100:>7.1f}"
+              f"{row['per_second']:>8.2f}{row['p50_ms']:>9.0f}{row['p90_ms']:>9.0f}"
+              f"{row['p99_ms']:>9.0f}{row['max_ms']:>9.0f}")
+    track_changes = summary.get('track_change')
+    if track_changes:
+        played = track_changes['requests'] - track_changes['errors']
+        print(f"Sustained: {played / elapsed * 60:.1f} track changes/min "
+              f"({played} played, {track_changes['errors']} failed)")
+
+
+def run_load_test(server_url, playlist_urls, speakers, duration, time_factor, json_file=None):
+    stats = EndpointStats()
+    started_at = time.time()
+    stop_at = started_at + duration
+    threads = []
+    for index in range(speakers):
+        thread = threading.Thread(
+            target=run_speaker,
+            args=(index, server_url, playlist_urls[index % len(playlist_urls)], stop_at, time_factor, stats),
+            daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+
+    log(f"Started {speakers} speakers against {server_url} for {duration}s (time factor {time_factor}x)")
+    for thread in threads:
+        # In-flight requests may end a little after stop_at
+        thread.join(max(stop_at - time.time(), 0) + REQUEST_TIME_OUT)
+
+    elapsed = time.time() - started_at
+    summary = stats.summary(elapsed)
+    print_report(summary, elapsed, speakers)
+    if json_file:
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump({'speakers': speakers, 'elapsed': elapsed, 'endpoints': summary}, f, indent=2)
+        log(f"Wrote {json_file}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate speakers following the pyscript client request pattern against pytube_server'
+    )
+    parser.add_argument('--speakers', type=int, default=DEFAULT_SPEAKERS, help=f'Simulated speakers (default: {DEFAULT_SPEAKERS})')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help=f'Seconds to run (default: {DEFAULT_DURATION})')
+    parser.add_argument('--time-factor', type=float, default=DEFAULT_TIME_FACTOR, help=f'Playback speed-up (default: {DEFAULT_TIME_FACTOR})')
+    parser.add_argument('--server', help='Test a running server instead of starting one on the stub backend')
+    parser.add_argument('--playlist', action='append', help='Playlist URL to play with --server (repeatable)')
+    parser.add_argument('--playlists', type=int, default=DEFAULT_PLAYLISTS, help=f'Stub playlists (default: {DEFAULT_PLAYLISTS})')
+    parser.add_argument('--tracks', type=int, default=DEFAULT_TRACKS, help=f'Tracks per stub playlist (default: {DEFAULT_TRACKS})')
+    parser.add_argument('--stub-port', type=int, default=DEFAULT_STUB_PORT, help=f'Port of the stub server (default: {DEFAULT_STUB_PORT})')
+    parser.add_argument('--stub-latency', type=float, nargs=2, default=DEFAULT_STUB_LATENCY, metavar=('MIN', 'MAX'),
+                        help='Seconds a stubbed download takes')
+    parser.add_argument('--stub-cpu', type=float, default=DEFAULT_STUB_CPU, help='CPU seconds per stubbed extraction')
+    parser.add_argument('--stub-mp3-size', type=int, default=DEFAULT_STUB_MP3_SIZE, help='Bytes per stubbed track')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    parser.add_argument('--serve-stub', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    settings = {'latency': list(args.stub_latency), 'cpu': args.stub_cpu, 'mp3_size': args.stub_mp3_size}
+    if args.serve_stub:
+        serve_stub(args.stub_port, settings)
+        return
+
+    if args.server:
+        if not args.playlist:
+            parser.error('--playlist is required with --server')
+        server_url, playlist_urls, process = args.server.rstrip('/'), args.playlist, None
+    else:
+        log_file = tempfile.NamedTemporaryFile(prefix='pytube_load_test_', suffix='.log', delete=False)
+        process, server_url = start_stub_server(args.stub_port, settings, log_file)
+        playlist_urls = [get_stub_playlist_url(index, args.tracks) for index in range(args.playlists)]
+        log(f"Stub server running at {server_url}, log: {log_file.name}")
+
+    try:
+        summary = run_load_test(
+            server_url=server_url,
+            playlist_urls=playlist_urls,
+            speakers=max(args.speakers, 1),
+            duration=args.duration,
+            time_factor=args.time_factor,
+            json_file=args.json
+        )
+    except KeyboardInterrupt:
+        log("Interrupted")
+        sys.exit(130)
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=10)
+
+    failed = sum(row['errors'] for row in summary.values())
+    sys.exit(0 if failed == 0 else 2)
+
+
+if __name__ == '__main__':
+    main()
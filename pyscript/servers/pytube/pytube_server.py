@@ -2,14 +2,39 @@ import os
 import re
 import json
 import glob
-from flask import Flask, jsonify, send_file, request
+import io
+import tarfile
+import subprocess
+import shutil
+import uuid
+import hashlib
+import hmac
+import queue
+import tempfile
+import contextvars
+import signal
+import ssl
+import multiprocessing
+import cProfile
+import pstats
+import marshal
+import tracemalloc
+from flask import Flask, jsonify, send_file, request, Response, stream_with_context, g
+from werkzeug.wsgi import ClosingIterator
 from pytubefix import YouTube, Playlist
 from pytubefix.cli import on_progress
 import yt_dlp
+from yt_dlp.cookies import YoutubeDLCookieJar
 import logging
 import time
 import random
-from urllib.parse import parse_qs, urlparse
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse, quote
+from urllib.error import HTTPError, URLError
+from http.client import HTTPException
+from urllib.request import urlopen, Request, build_opener, HTTPCookieProcessor
 
 # Flask app setup
 app = Flask(__name__)
@@ -19,12 +44,282 @@ folder_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'download
 HOST = '0.0.0.0'  # Allow external access
 PORT = 114
 MAX_RETRIES = 1
+VIDEO_INFO_CACHE_SIZE = 512  # Max video-info payloads kept in memory
+VIDEO_INFO_CACHE_TTL = 6 * 60 * 60  # Seconds before a memory entry is re-checked on disk
+FLAT_METADATA_CACHE_SIZE = 20000  # Max playlist-entry metadata records kept in memory
+MAX_CONCURRENT_DOWNLOADS = 4  # Downloads running at once across all devices
+MAX_DOWNLOADS_PER_DEVICE = 2  # Downloads running at once for a single device
+PRIORITY_INTERACTIVE = 'interactive'  # Now-playing requests, always scheduled first
+PRIORITY_BACKGROUND = 'background'  # Prefetch/warm-up requests, use spare slots only
+BUNDLE_MANIFEST_NAME = 'manifest.json'  # Index stored first in cache export bundles
+BUNDLE_VERSION = 1
+BUNDLE_STREAM_QUEUE_CHUNKS = 64  # Tar blocks (10 KiB each) buffered per export before the writer waits for the client
+ADMIN_TOKEN = ''  # Required in the X-Admin-Token header by the /v3/cache admin endpoints; when empty only localhost may
+PEER_SERVERS = []  # Other pytube_server instances to copy cached files from, e.g. ['http://10.25.113.182:114']
+PEER_LOOKUP_TIMEOUT = 1.0  # Seconds to wait for a peer to answer a cache lookup
+PEER_TRANSFER_TIMEOUT = 30  # Seconds to wait on a stalled MP3 copy from a peer
+PEER_MISS_TTL = 10 * 60  # Seconds to remember that a peer does not have a video
+PEER_DOWN_TTL = 60  # Seconds to skip a peer after a connection/HTTP error or timeout
+# Errors that mean the peer itself is in trouble, anything else only skips the video on that peer
+PEER_CONNECTION_ERRORS = (HTTPError, URLError, HTTPException, ConnectionError, TimeoutError)
+THUMBNAIL_PROXY = True  # Serve thumbnails from /v3/thumb/<id> instead of YouTube
+THUMBNAIL_WIDTH = 320  # Width (px) of the cached thumbnail, height keeps the aspect ratio
+THUMBNAIL_MAX_AGE = 30 * 24 * 60 * 60  # Cache-Control max-age (seconds) for thumbnails
+thumbnail_folder_path = os.path.join(folder_path, 'thumbs')
+hls_folder_path = os.path.join(folder_path, 'hls')
+HLS_ENABLED = False  # Opt-in: serve /v3/hls/<id>/index.m3u8, packaged with ffmpeg after each download
+HLS_SEGMENT_SECONDS = 6  # Target duration of one HLS segment
+HLS_AUDIO_BITRATE = '128k'  # AAC bitrate of the HLS segments
+HLS_PACKAGE_TIMEOUT = 120  # Seconds ffmpeg may take to package one track
+HLS_MAX_CONCURRENT = 1  # ffmpeg packaging jobs running at once
+HLS_MAX_AGE = 24 * 60 * 60  # Cache-Control max-age (seconds) for HLS playlists and segments
+# Where cached audio and metadata live:
+# 'local' - files in folder_path only
+# 's3'    - also in an S3-compatible bucket (AWS S3, MinIO, ...) shared by several servers,
+#           folder_path stays the download area and a local cache in front of the bucket
+STORAGE_BACKEND = 'local'
+S3_ENDPOINT = 'http://127.0.0.1:9000'  # Path-style endpoint, e.g. https://s3.eu-west-1.amazonaws.com
+S3_BUCKET = 'pytube-cache'
+S3_PREFIX = ''  # Key prefix inside the bucket, e.g. 'pytube/'
+S3_REGION = 'us-east-1'
+S3_ACCESS_KEY = ''
+S3_SECRET_KEY = ''
+S3_TIMEOUT = 30  # Seconds before a stalled bucket request fails
+CACHE_INDEX_FILE = os.path.join(folder_path, 'cache_index.json')
+CACHE_INDEX_FLUSH_INTERVAL = 30  # Seconds between writes of the cache index to disk
+CACHE_PAGE_SIZE = 50  # Default page size for /v3/cache
+READ_AHEAD_TRACKS = 2  # Tracks after the cursor kept downloaded by /v3/readahead
+READ_AHEAD_MAX_TRACKS = 10  # Upper bound for the count a client may ask for
+JOB_TTL = 10 * 60  # Seconds a finished video job stays available for polling
+JOB_MAX_WAIT = 30  # Upper bound (seconds) for a job long poll
+PROGRESS_EVENT_INTERVAL = 0.5  # Min seconds between progress events for one video
+PROGRESS_KEEPALIVE = 15  # Seconds between SSE keep-alive comments
+# How MP3 bytes leave the server:
+# 'sendfile'   - zero-copy os.sendfile on the client socket (send_file on TLS or without os.sendfile)
+# 'x-accel'    - only return X-Accel-Redirect, nginx serves the file from MP3_X_ACCEL_PREFIX
+# 'x-sendfile' - only return X-Sendfile with the absolute path (Apache/lighttpd)
+# 'send_file'  - stream through Flask/Python
+MP3_DELIVERY_MODE = 'sendfile'
+MP3_X_ACCEL_PREFIX = '/pytube_download/'  # nginx `internal` location aliased to folder_path
+SENDFILE_CHUNK_SIZE = 8 * 1024 * 1024
+MP3_START_TRANSCODE_BITRATE = '192k'  # Bitrate used when ?start= has to re-encode a non-MP3 file
+MP3_START_MAX_TRANSCODES = 2  # ffmpeg re-encodes for ?start= running at once, more get a 503
+MP3_START_TRANSCODE_TIMEOUT = 120  # Seconds one ?start= re-encode or stream copy may take
+# Containers ?start= cuts with an ffmpeg stream copy (no decode/encode) instead of re-encoding to MP3
+MP3_START_COPY_FORMATS = {'audio/mp4': 'mp4', 'audio/webm': 'webm', 'audio/ogg': 'ogg'}
+YTDLP_COOKIE_FILE = 'cookies.txt'  # Seeds the extraction session when present, merged in again whenever it changes
+YTDLP_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+SESSION_FOLDER = os.path.join(folder_path, 'session')
+SESSION_COOKIE_FILE = os.path.join(SESSION_FOLDER, 'cookies.txt')  # Cookie jar shared by every extraction
+SESSION_OAUTH_TOKEN_FILE = os.path.join(SESSION_FOLDER, 'oauth_tokens.json')  # pytubefix OAuth cache (v1)
+YTDLP_CACHE_DIR = os.path.join(SESSION_FOLDER, 'yt-dlp')  # yt-dlp player/signature cache, kept across restarts
+SESSION_REFRESH_INTERVAL = 6 * 60 * 60  # Seconds without any extraction before the session is refreshed
+SESSION_REFRESH_CHECK_INTERVAL = 10 * 60  # Seconds between staleness checks
+SESSION_REFRESH_URL = 'https://www.youtube.com/'
+# Format strategies tried in order for Home Assistant compatibility
+YTDLP_FORMAT_STRATEGIES = [
+    # Strategy 1: Try specific audio formats we know exist
+    ('233/234', 'Specific m3u8 audio formats'),
+    # Strategy 2: Try any audio format
+    ('bestaudio', 'Best available audio'),
+    # Strategy 3: Try lowest quality video (sometimes works when audio fails)
+    ('worst[height<=360]', 'Low quality video'),
+    # Strategy 4: Just get anything
+    ('worst', 'Worst quality available'),
+    # Strategy 5: No format specification (let yt-dlp decide)
+    (None, 'Default format selection'),
+    # Strategy 6: Try specific video formats that might have audio
+    ('18', 'MP4 360p format'),
+    ('36', '3GP 240p format'),
+]
+# Audio quality policy: pick the smallest stream that meets it before the fixed strategies
+# Opt-in: opus/webm is smaller but not every player handles it, even with its real MIME type
+AUDIO_QUALITY_POLICY = {
+    'enabled': False,
+    'max_abr': 160,  # kbps, skip streams above this bitrate
+    'min_abr': 48,  # kbps, skip streams below this bitrate
+    'preferred_codecs': ['mp4a', 'opus'],  # Tried in order; any codec is accepted if none match
+    'audio_only': True  # Only consider streams without video
+}
+FAILED_VIDEO_FILE = os.path.join(folder_path, 'failed_videos.json')
+FAILED_VIDEO_UNAVAILABLE_TTL = 24 * 60 * 60  # Seconds to skip private/deleted/blocked videos
+FAILED_VIDEO_BASE_TTL = 10 * 60  # Seconds to skip a video after its first generic failure
+FAILED_VIDEO_MAX_TTL = 6 * 60 * 60  # Upper bound for the doubling backoff of generic failures
+FAILED_VIDEO_MAX_ENTRIES = 5000  # Entries kept in the failed-video cache, soonest to expire are dropped first
+# Error fragments that mean the video will not come back soon
+UNAVAILABLE_ERROR_MARKERS = [
+    'private video', 'video unavailable', 'has been removed', 'been terminated',
+    'not available in your country', 'blocked it in your country', 'members-only',
+    'sign in to confirm your age', 'this video is not available', 'does not exist'
+]
+HEDGE_ENABLED = False  # Opt-in: race format strategies/backends for lower tail latency
+HEDGE_DELAY = 8  # Seconds without any downloaded bytes before starting the next attempt
+HEDGE_MAX_PARALLEL = 2  # Attempts allowed to run at the same time for one video
+HEDGE_PYTUBEFIX_BACKUP = True  # Use pytubefix as the first backup attempt
+SOCKET_TIMEOUT = 15  # Seconds before a stalled network read fails (yt-dlp and pytubefix)
+ATTEMPT_TIMEOUT = 60  # Max seconds for a single download strategy/backend attempt
+DOWNLOAD_DEADLINE = 120  # Default overall budget (seconds) to resolve one video request, 0 = none
+DEADLINE_HEADER = 'X-Request-Deadline'  # Clients may send a shorter budget (seconds) in this header
+MIN_ATTEMPT_BUDGET = 5  # Don't start another attempt with less time than this left
+EXTRACTION_WORKERS = 4  # Worker processes running yt-dlp/pytubefix attempts, 0 = run on request threads
+EXTRACTION_KILL_GRACE = 10  # Extra seconds before a worker that overran its attempt is killed
+EXTRACTION_PRELOAD_MODULES = ['yt_dlp', 'yt_dlp.extractor.youtube', 'pytubefix']  # Imported once, before workers fork
+EXTRACTION_WORKER_NICE = 10  # Niceness added to extraction workers, also lowers their disk I/O priority on Linux
+DOWNLOAD_BANDWIDTH_LIMIT = 0  # Bytes/s shared by all YouTube downloads, 0 = unlimited
+DOWNLOAD_BANDWIDTH_DURING_PLAYBACK = 256 * 1024  # Bytes/s shared by background downloads while audio is served, 0 = unlimited
+PLAYBACK_GRACE = 2  # Seconds downloads stay throttled after the last audio response finished
+DOWNLOAD_BURST_SECONDS = 1  # Unused bandwidth a throttled download may catch up on at once
+DOWNLOAD_INFO_FIELDS = [  # Info fields sent back from a download attempt
+    'title', 'duration', 'thumbnail', 'format_id', 'acodec', 'abr', 'tbr', 'ext', 'filesize', 'filesize_approx'
+]
+PROFILING_ENABLED = False  # Opt-in: allow profiling requests with ?profile=1 or sampling
+PROFILING_TOKEN = ''  # Required in the X-Profile-Token header; when empty only localhost may profile
+PROFILING_SAMPLE_RATE = 0.0  # Fraction of requests profiled automatically while enabled
+PROFILING_TRACE_ALLOCATIONS = True  # Also summarize allocations with tracemalloc (one request at a time)
+PROFILING_MAX_PROFILES = 50  # Profiles kept in memory for download
+PROFILING_TOP_ENTRIES = 40  # Functions/allocation sites listed in a profile summary
+REQUEST_ID_HEADER = 'X-Request-Id'  # Sent by clients, echoed back; generated when missing
+TRACE_ENABLED = True  # Write timing spans to TRACE_FILE as JSON lines
+TRACE_FILE = os.path.join(folder_path, 'traces.jsonl')
+TRACE_FILE_MAX_BYTES = 10 * 1024 * 1024  # TRACE_FILE is rotated to TRACE_FILE.1 past this size
+
+# Request id and innermost span of the work running in this context
+_current_request_id = contextvars.ContextVar('request_id', default=None)
+_current_span_id = contextvars.ContextVar('span_id', default=None)
+
+
+class RequestIdLogFilter(logging.Filter):
+    """Tag log lines with the request id of the work that wrote them"""
+
+    def filter(self, record):
+        request_id = _current_request_id.get()
+        record.request_tag = f"[{request_id}] " if request_id else ''
+        return True
+
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(name)s:%(request_tag)s%(message)s')
+for _log_handler in logging.getLogger().handlers:
+    _log_handler.addFilter(RequestIdLogFilter())
 logger = logging.getLogger(__name__)
 
 
+
+class SpanExporter:
+    """Append finished spans to a JSON lines file from a background thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue(maxsize=10000)
+        self._lock = threading.Lock()
+        self._started = False
+
+    def export(self, span):
+        if not TRACE_ENABLED:
+            return
+        if not self._started:
+            with self._lock:
+                if not self._started:
+                    threading.Thread(target=self._run, daemon=True).start()
+                    self._started = True
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            spans = [self._queue.get()]
+            while True:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                ensure_directory_exists(os.path.dirname(self.path))
+                if os.path.exists(self.path) and os.path.getsize(self.path) > TRACE_FILE_MAX_BYTES:
+                    os.replace(self.path, f"{self.path}.1")
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    for span in spans:
+                        f.write(json.dumps(span, ensure_ascii=False, default=str) + '\n')
+            except Exception as e:
+                logger.error(f"Failed to write trace spans: {str(e)}")
+
+
+span_exporter = SpanExporter(TRACE_FILE)
+
+
+def get_request_id():
+    """Request id of the work running in this context, or None"""
+    return _current_request_id.get()
+
+
+@contextmanager
+def request_id_context(request_id):
+    """Run the with block under request_id, for work a request hands to another thread"""
+    token = _current_request_id.set(request_id)
+    try:
+        yield
+    finally:
+        _current_request_id.reset(token)
+
+
+def start_span(name, **attributes):
+    """Open a span as the child of the current one. Finish it with finish_span"""
+    span = {
+        'request_id': _current_request_id.get(),
+        'span_id': uuid.uuid4().hex[:16],
+        'parent_id': _current_span_id.get(),
+        'name': name,
+        'start': time.time(),
+        'attributes': attributes
+    }
+    span['token'] = _current_span_id.set(span['span_id'])
+    return span
+
+
+def finish_span(span, error=None):
+    """Close a span from start_span and export it"""
+    _current_span_id.reset(span.pop('token'))
+    span['duration_ms'] = round((time.time() - span['start']) * 1000, 2)
+    span['status'] = 'error' if error else 'ok'
+    if error:
+        span['attributes']['error'] = str(error)[:300]
+    span['pid'] = os.getpid()
+    span['thread'] = threading.current_thread().name
+    span_exporter.export(span)
+
+
+@contextmanager
+def trace_span(name, **attributes):
+    """Time the with block as a span; yields its attributes dict so the block can add to it"""
+    span = start_span(name, **attributes)
+    try:
+        yield span['attributes']
+    except BaseException as e:
+        finish_span(span, e)
+        raise
+    finish_span(span)
+
+
+# In-memory LRU of video-info payloads keyed by video_id
+_video_info_cache = OrderedDict()
+_video_info_cache_lock = threading.Lock()
+
+# Metadata seen in flat playlist extraction, keyed by video_id
+_flat_video_metadata = OrderedDict()
+_flat_video_metadata_lock = threading.Lock()
+
+# Negative cache for peer lookups: key -> expiry timestamp
+# Keys are peer URLs (peer is down) or (peer URL, video_id) (peer has no copy)
+_peer_negative_cache = {}
+_peer_negative_cache_lock = threading.Lock()
+
+# One lock per video_id so concurrent requests share a single download
+_video_download_locks = {}
+_video_download_locks_lock = threading.Lock()
+
+
 def ensure_directory_exists(path):
     """Create directory if it doesn't exist"""
     try:
@@ -37,6 +332,22 @@ def ensure_directory_exists(path):
         return False
 
 
+VIDEO_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{11}')
+
+
+def is_valid_video_id(video_id):
+    """Whether video_id looks like a YouTube id, so it is safe in file names and glob patterns"""
+    return bool(video_id) and VIDEO_ID_PATTERN.fullmatch(video_id) is not None
+
+
+def build_invalid_video_id_response(video_id):
+    return jsonify({
+        'error': 'Invalid video id',
+        'message': f'Invalid video id: {video_id}',
+        'video_id': video_id
+    }), 400
+
+
 def sanitize_filename(filename):
     """Remove invalid characters from filename"""
     # Remove or replace invalid characters for filenames
@@ -76,6 +387,7 @@ def save_playlist_cache(playlist_id, data):
         cache_path = get_playlist_cache_path(playlist_id)
         with open(cache_path, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        cache_index.set_playlist(playlist_id, [item.get("video_id") for item in data])
         logger.info(f"Saved playlist cache: {cache_path}")
         return True
     except Exception as e:
@@ -105,11 +417,18 @@ def get_video_metadata_cache_path(video_id, title):
 
 
 def save_video_metadata_cache(video_id, title, metadata):
-    """Save video metadata to cache"""
+    """Save video metadata to cache and publish the video to the storage backend"""
     try:
-        cache_path = get_video_metadata_cache_path(video_id, title)
-        with open(cache_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        invalidate_video_info_in_memory(video_id)
+        cache_path = cache_storage.save_metadata(video_id, title, metadata)
+        cache_storage.publish(video_id, metadata)
+        cache_index.add_video(
+            video_id,
+            metadata.get("mp3_url"),
+            title=metadata.get("video_title", ""),
+            duration=metadata.get("video_duration", 0),
+            backend=metadata.get("backend", "unknown")
+        )
         logger.info(f"Saved video metadata cache: {cache_path}")
         return True
     except Exception as e:
@@ -134,847 +453,4684 @@ def load_video_metadata_cache(cache_path):
         return None
 
 def find_cached_metadata_file(video_id):
-    """Find cached MP3 file by video_id using glob pattern"""
-    try:
-        pattern = os.path.join(folder_path, f"*_{video_id}.json")
-        matches = glob.glob(pattern)
-        if matches:
-            # Return the first match (should only be one)
-            return matches[0]
-        return None
-    except Exception as e:
-        logger.error(f"Failed to find cached MP3 file: {str(e)}")
-        return None
+    """Find the local cached metadata file of video_id"""
+    return cache_storage.find_metadata(video_id)
 
 def find_cached_mp3_file(video_id):
-    """Find cached MP3 file by video_id using glob pattern"""
-    try:
-        pattern = os.path.join(folder_path, f"*_{video_id}.mp3")
-        matches = glob.glob(pattern)
-        if matches:
-            # Return the first match (should only be one)
-            return matches[0]
-        return None
-    except Exception as e:
-        logger.error(f"Failed to find cached MP3 file: {str(e)}")
-        return None
+    """Find the local cached MP3 file of video_id"""
+    return cache_storage.find_audio(video_id)
+
 
+def load_cached_video_metadata(video_id):
+    """Load video metadata from the local cache or the storage backend"""
+    return cache_storage.load_metadata(video_id)
 
-def create_youtube_object_with_retry(video_url, max_retries=MAX_RETRIES, device=None):
+
+def is_audio_cached(video_id):
+    """Whether video_id is cached locally or in the storage backend"""
+    return cache_storage.has_audio(video_id)
+
+
+class LocalCacheStorage:
     """
-    Create YouTube object with retry logic and exponential backoff
-    Returns YouTube object or None if all attempts fail
+    Cached audio and metadata as files in folder_path (the default backend)
+    Other backends extend this one, folder_path stays their download area and local cache
     """
-    for attempt in range(max_retries):
-        try:
-            # Add some randomization to avoid thundering herd
-            if attempt > 0:
-                delay = (2 ** attempt) + random.uniform(0, 1)
-                # logger.info(f"Retrying YouTube object creation after "
-                #             f"{delay:.2f}s (attempt {attempt + 1}/"
-                #             f"{max_retries})")
-                time.sleep(delay)
-            
-            if device:
-                # V2 API with device-specific token
-                # token_file = get_device_token_path(device)  # Currently unused
-                yt = YouTube(
-                    video_url,
-                    # use_oauth=False,
-                    # allow_oauth_cache=True,
-                    # token_file=token_file,
-                    on_progress_callback=on_progress
-                )
-            else:
-                # V1 API (original)
-                yt = YouTube(
-                    video_url,
-                    use_oauth=True,
-                    allow_oauth_cache=True,
-                    on_progress_callback=on_progress
-                )
-            
-            # Test that the object is actually accessible
-            # _ = yt.title  # This will trigger the API call
-            return yt
-        except Exception as e:
-            logger.warning(f"Attempt {attempt + 1}/{max_retries} failed for "
-                           f"{video_url}: {str(e)}")
-            if attempt == max_retries - 1:
-                logger.error(f"All {max_retries} attempts failed for "
-                             f"{video_url}")
-                return None
-    return YouTube(video_url, on_progress_callback=on_progress)
 
-def download_audio_with_ytdlp(video_id):
-    """Download audio using yt-dlp and get info in single call"""
-    youtube_url = f"https://youtube.com/watch?v={video_id}"
-    
-    # Try multiple format strategies for Home Assistant compatibility
-    format_strategies = [
-        # Strategy 1: Try specific audio formats we know exist
-        ('233/234', 'Specific m3u8 audio formats'),
-        # Strategy 2: Try any audio format
-        ('bestaudio', 'Best available audio'),
-        # Strategy 3: Try lowest quality video (sometimes works when audio fails)
-        ('worst[height<=360]', 'Low quality video'),
-        # Strategy 4: Just get anything
-        ('worst', 'Worst quality available'),
-        # Strategy 5: No format specification (let yt-dlp decide)
-        (None, 'Default format selection'),
-        # Strategy 6: Try specific video formats that might have audio
-        ('18', 'MP4 360p format'),
-        ('36', '3GP 240p format'),
-    ]
-    
-    # Check if cookies file exists, if not, don't use it
-    cookie_file = 'cookies.txt'
-    use_cookies = os.path.exists(cookie_file)
-    
-    for strategy, description in format_strategies:
-        ydl_opts = {
-            'outtmpl': os.path.join(folder_path, '%(title)s_%(id)s.%(ext)s'),
-            'noplaylist': True,
-            'quiet': False,  # Enable verbose output for debugging
-            'no_warnings': False,  # Show warnings to understand issues
-            'ignoreerrors': False,
-            'extractaudio': False,  # Don't try to extract audio (no FFmpeg)
-            # Handle signature extraction failures (common in HA)
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['android', 'web'],  # Try different clients
-                }
-            },
-            # Alternative user agent for better compatibility
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-            }
-        }
-        
-        # Only add format if specified
-        if strategy:
-            ydl_opts['format'] = strategy
-            
-        # Only add cookies if file exists
-        if use_cookies:
-            ydl_opts['cookiefile'] = cookie_file
-        
+    name = 'local'
+
+    @staticmethod
+    def _find_local_file(video_id, extension):
+        if not is_valid_video_id(video_id):
+            return None
         try:
-            logger.info(f"Trying strategy: {description} (format: {strategy})")
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                # First, just get info without downloading to see what's available
-                logger.info("Getting video info first...")
-                info = ydl.extract_info(youtube_url, download=False)
-                
-                available_formats = info.get('formats', [])
-                logger.info(f"Found {len(available_formats)} available formats")
-                
-                # Now try to download
-                logger.info("Attempting download...")
-                info = ydl.extract_info(youtube_url, download=True)
-                
-                # Find the downloaded file (might not be mp3)
-                pattern = os.path.join(folder_path, f"*_{video_id}.*")
-                matches = glob.glob(pattern)
-                if matches:
-                    downloaded_file = matches[0]
-                    logger.info(f"Downloaded file: {downloaded_file}")
-                    
-                    # Rename to .mp3 for consistency (even if it's not audio)
-                    mp3_file = downloaded_file.rsplit('.', 1)[0] + '.mp3'
-                    if downloaded_file != mp3_file:
-                        os.rename(downloaded_file, mp3_file)
-                        logger.info(f"Renamed to: {mp3_file}")
-                    
-                    return mp3_file, info
-                else:
-                    logger.warning("No files found matching pattern")
-                    
+            matches = glob.glob(os.path.join(glob.escape(folder_path), f"*_{video_id}.{extension}"))
+            if matches:
+                # Return the first match (should only be one)
+                return matches[0]
+            return None
         except Exception as e:
-            logger.warning(f"Strategy '{description}' failed: {str(e)}")
-            continue
-    
-    # If all strategies fail, provide detailed error
-    error_msg = f"All {len(format_strategies)} download strategies failed for video {video_id}. "
-    error_msg += f"Video URL: {youtube_url}. "
-    error_msg += f"Cookies available: {use_cookies}. "
-    error_msg += "This might be due to: 1) Video is private/deleted, 2) Network restrictions in HA, "
-    error_msg += "3) yt-dlp version compatibility, 4) Missing dependencies in HA container"
-    
-    raise Exception(error_msg)
+            logger.error(f"Failed to find cached {extension} file: {str(e)}")
+            return None
 
+    def find_audio(self, video_id):
+        """Local path of the cached audio, None if it is not on local disk"""
+        return self._find_local_file(video_id, 'mp3')
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint"""
-    return jsonify({
-        'status': 'healthy',
-        'service': 'YouTube Downloader API',
-        'cache_directory': folder_path,
-        'directory_exists': os.path.exists(folder_path)
-    })
+    def find_metadata(self, video_id):
+        """Local path of the cached metadata, None if it is not on local disk"""
+        return self._find_local_file(video_id, 'json')
 
+    def has_audio(self, video_id):
+        return bool(self.find_audio(video_id))
 
-@app.route('/', methods=['GET'])
-def api_info():
-    """API information endpoint"""
-    return jsonify({
-        'service': 'YouTube Downloader API',
-        'version': '2.0.0',
-        'endpoints': {
-            'GET /': 'API information',
-            'GET /health': 'Health check',
-            'GET /v2/playlist?url=<playlist_url>&device=<device_id>': (
-                'Get simplified playlist info with smart caching (using pytubefix)'
-            ),
-            'GET /v2/video/<video_id>?device=<device_id>': (
-                'Get video information with mp3_url if cached (using pytubefix)'
-            ),
-            'GET /v2/mp3/<video_id>?device=<device_id>': (
-                'Serve cached MP3 file directly'
-            ),
-            'GET /v3/playlist?url=<playlist_url>&device=<device_id>': (
-                'Get simplified playlist info with smart caching (using yt-dlp)'
-            ),
-            'GET /v3/video/<video_id>?device=<device_id>': (
-                'Get video information with mp3_url if cached (using yt-dlp)'
-            ),
-            'GET /v3/mp3/<video_id>?device=<device_id>': (
-                'Serve cached MP3 file directly'
-            )
-        },
-        'cache_directory': folder_path,
-        'tokens_directory': './tokens'
-    })
+    def load_metadata(self, video_id):
+        return load_video_metadata_cache(self.find_metadata(video_id))
+
+    def save_metadata(self, video_id, title, metadata):
+        """Write the metadata file. Returns its path"""
+        cache_path = get_video_metadata_cache_path(video_id, title)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        return cache_path
 
+    def publish(self, video_id, metadata):
+        """Make a newly cached video available to the backend (nothing to do on local disk)"""
 
-# ================= V2 API ENDPOINTS =================
+    def fetch_audio(self, video_id):
+        """Local path of the audio, copied from the backend first if needed. None if not cached"""
+        return self.find_audio(video_id)
 
-@app.route('/v2/playlist', methods=['GET'])
-def get_playlist_videos_v2():
+    def build_audio_response(self, video_id):
+        """Response serving audio that is only in the backend, None if the backend does not have it"""
+        return None
+
+    def delete(self, video_id):
+        """Delete the backend's copy of video_id. Returns bytes freed"""
+        return 0
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+class S3Client:
     """
-    V2: Get videos from a YouTube playlist with device-specific tokens
-    Expected query parameters: url (YouTube playlist URL), device (device identifier)
-    Returns: JSON array with simplified video information and caching
+    Minimal S3 client on urllib, signing requests with AWS Signature Version 4
+    Uses path-style URLs, which AWS, MinIO and most S3-compatible stores accept
     """
-    try:
-        playlist_url = request.args.get('url')
-        device = request.args.get('device')
-        
-        if not playlist_url:
-            return jsonify({
-                'error': 'Missing required parameter: url',
-                'message': 'Please provide a YouTube playlist URL'
-            }), 400
-            
-        if not device:
-            return jsonify({
-                'error': 'Missing required parameter: device',
-                'message': 'Please provide a device identifier'
-            }), 400
 
-        # Extract playlist ID for caching
-        playlist_id = extract_playlist_id(playlist_url)
-        if not playlist_id:
-            return jsonify({
-                'error': 'Invalid playlist URL',
-                'message': 'Could not extract playlist ID from URL'
-            }), 400
+    def __init__(self, endpoint, bucket, region, access_key, secret_key, timeout):
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.timeout = timeout
+        self.host = urlparse(self.endpoint).netloc
 
-        # Ensure cache directory exists
-        if not ensure_directory_exists(folder_path):
-            logger.warning(f"Could not create cache directory: {folder_path}")
+    def _sign(self, method, path, headers):
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        date_stamp = amz_date[:8]
+        headers['x-amz-date'] = amz_date
+        # Bodies are streamed from disk, so the payload is not part of the signature
+        headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
 
-        logger.info(
-            f"Processing playlist (v2): {playlist_url} for device: {device}"
+        signed_headers = 'host;x-amz-content-sha256;x-amz-date'
+        canonical_request = '\n'.join([
+            method,
+            path,
+            '',
+            f"host:{self.host}",
+            'x-amz-content-sha256:UNSIGNED-PAYLOAD',
+            f"x-amz-date:{amz_date}",
+            '',
+            signed_headers,
+            'UNSIGNED-PAYLOAD'
+        ])
+        scope = f"{date_stamp}/{self.region}/s3/aws4_request"
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256',
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+        ])
+
+        signing_key = f"AWS4{self.secret_key}".encode('utf-8')
+        for part in (date_stamp, self.region, 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        headers['Authorization'] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
         )
 
-        try:
-            # Always try to get playlist from YouTube API first
-            playlist = Playlist(playlist_url)
-            video_urls = playlist.video_urls
+    def request(self, method, key, body=None, headers=None):
+        """
+        Send a signed request for key and return the open response
+        Raises HTTPError for error statuses (e.g. 404 when the object does not exist)
+        """
+        path = quote(f"/{self.bucket}/{key}", safe='/~')
+        headers = dict(headers or {})
+        self._sign(method, path, headers)
+        return urlopen(
+            Request(f"{self.endpoint}{path}", data=body, headers=headers, method=method),
+            timeout=self.timeout
+        )
 
-            if not video_urls:
-                # If no videos found, try to return cached data
-                cached_data = load_playlist_cache(playlist_id)
-                if cached_data:
-                    logger.info(
-                        f"No videos found in API, returning cached data for {playlist_id}"
-                    )
-                    return jsonify(cached_data)
-                
-                return jsonify({
-                    'error': 'No videos found',
-                    'message': (
-                        'The playlist appears to be empty or inaccessible'
-                    )
-                }), 404
 
-            # Build response data
-            videos_info = []
-            for video_url in video_urls:
-                video_id = video_url.split('watch?v=')[-1].split('&')[0]
-                video_info = {
-                    "video_url": video_url,
-                    "video_id": video_id
-                }
-                videos_info.append(video_info)
+class S3CacheStorage(LocalCacheStorage):
+    """
+    Cache in an S3-compatible bucket, so several servers share one cache
+    Downloads still land in folder_path and are uploaded once saved. Audio that is
+    only in the bucket is served with ranged reads, or copied to folder_path when a
+    feature needs a local file (HLS packaging, ?start= cutting)
+    """
 
-            # Save successful results to cache
-            save_playlist_cache(playlist_id, videos_info)
-            logger.info(
-                f"Successfully processed {len(videos_info)} videos (v2)"
-            )
+    name = 's3'
 
-            return jsonify(videos_info)
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+
+    def _audio_key(self, video_id):
+        return f"{self.prefix}audio/{video_id}.mp3"
+
+    def _metadata_key(self, video_id):
+        return f"{self.prefix}metadata/{video_id}.json"
+
+    def _head(self, key):
+        """Object headers, None if it does not exist"""
+        try:
+            with self.client.request('HEAD', key) as response:
+                return response.headers
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
 
+    def has_audio(self, video_id):
+        if super().has_audio(video_id):
+            return True
+        try:
+            return self._head(self._audio_key(video_id)) is not None
         except Exception as e:
-            logger.error(f"Error processing playlist: {str(e)}")
-            # Only if API fails, try to return cached data
-            cached_data = load_playlist_cache(playlist_id)
-            if cached_data:
-                logger.info(
-                    f"API failed, returning cached data for {playlist_id}: {str(e)}"
-                )
-                return jsonify(cached_data)
-            
-            return jsonify({
-                'error': 'Failed to process playlist',
-                'message': str(e)
-            }), 500
+            # An unreachable bucket must not stop downloads from working
+            logger.warning(f"Could not check {video_id} in bucket {self.client.bucket}: {str(e)}")
+            return False
 
-    except Exception as e:
-        logger.error(f"Error in v2 playlist endpoint: {str(e)}")
-        return jsonify({
-            'error': 'Failed to process playlist',
-            'message': str(e)
-        }), 500
+    def load_metadata(self, video_id):
+        metadata = super().load_metadata(video_id)
+        if metadata:
+            return metadata
+        try:
+            with self.client.request('GET', self._metadata_key(video_id)) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except HTTPError as e:
+            if e.code != 404:
+                logger.error(f"Failed to load metadata of {video_id} from bucket: {str(e)}")
+        except Exception as e:
+            logger.error(f"Failed to load metadata of {video_id} from bucket: {str(e)}")
+        return None
 
+    def _upload(self, video_id, audio_file, metadata):
+        with trace_span('storage.upload', video_id=video_id):
+            with open(audio_file, 'rb') as f:
+                self.client.request('PUT', self._audio_key(video_id), body=f, headers={
+                    'Content-Type': get_audio_mimetype(audio_file),
+                    'Content-Length': str(os.path.getsize(audio_file))
+                }).close()
+            # Metadata goes last: other servers treat it as the sign of a complete upload
+            body = json.dumps(metadata, ensure_ascii=False).encode('utf-8')
+            self.client.request('PUT', self._metadata_key(video_id), body=body, headers={
+                'Content-Type': 'application/json',
+                'Content-Length': str(len(body))
+            }).close()
+        logger.info(f"Uploaded {video_id} to bucket {self.client.bucket}")
 
-@app.route('/v3/playlist', methods=['GET'])
+    def publish(self, video_id, metadata):
+        """Upload the audio and metadata in the background, the request does not wait for it"""
+        audio_file = metadata.get("mp3_url")
+        if not audio_file or not os.path.exists(audio_file):
+            return
+
+        def run():
+            try:
+                self._upload(video_id, audio_file, metadata)
+            except Exception as e:
+                logger.error(f"Failed to upload {video_id} to bucket: {str(e)}")
+
+        threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+
+    def fetch_audio(self, video_id):
+        local_file = super().fetch_audio(video_id)
+        if local_file:
+            return local_file
+
+        with get_video_download_lock(video_id):
+            local_file = super().fetch_audio(video_id)
+            if local_file:
+                return local_file
+            metadata = self.load_metadata(video_id)
+            if not metadata:
+                return None
+
+            title = metadata.get("video_title", "")
+            local_file = os.path.join(folder_path, f"{sanitize_filename(title)}_{video_id}.mp3")
+            temp_file = f"{local_file}.part"
+            try:
+                with trace_span('storage.fetch', video_id=video_id), \
+                        self.client.request('GET', self._audio_key(video_id)) as response, \
+                        open(temp_file, 'wb') as f:
+                    shutil.copyfileobj(response, f, 1024 * 1024)
+                os.replace(temp_file, local_file)
+            except Exception as e:
+                logger.error(f"Failed to fetch {video_id} from bucket: {str(e)}")
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                return None
+
+            metadata = dict(metadata, mp3_url=local_file)
+            LocalCacheStorage.save_metadata(self, video_id, title, metadata)
+            cache_index.add_video(
+                video_id,
+                local_file,
+                title=title,
+                duration=metadata.get("video_duration", 0),
+                backend=metadata.get("backend", "unknown")
+            )
+            return local_file
+
+    def build_audio_response(self, video_id):
+        """Stream the object, passing the client's Range header on so seeks are ranged reads"""
+        headers = {}
+        if request.headers.get('Range'):
+            headers['Range'] = request.headers['Range']
+        try:
+            remote = self.client.request('GET', self._audio_key(video_id), headers=headers)
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            if e.code == 416:
+                return Response(status=416, headers={'Content-Range': e.headers.get('Content-Range', '')})
+            raise
+
+        def generate():
+            with remote:
+                while True:
+                    chunk = remote.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        response_headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(f'{video_id}.mp3')}"
+        }
+        for name in ('Content-Length', 'Content-Range', 'ETag', 'Last-Modified'):
+            if remote.headers.get(name):
+                response_headers[name] = remote.headers[name]
+        mimetype = remote.headers.get('Content-Type') or 'audio/mpeg'
+        response = Response(generate(), status=remote.status, mimetype=mimetype, headers=response_headers)
+        response.direct_passthrough = True
+        return response
+
+    def delete(self, video_id):
+        headers = self._head(self._audio_key(video_id))
+        freed = int(headers.get('Content-Length', 0)) if headers else 0
+        for key in (self._audio_key(video_id), self._metadata_key(video_id)):
+            try:
+                self.client.request('DELETE', key).close()
+            except HTTPError as e:
+                if e.code != 404:
+                    raise
+        return freed
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'endpoint': self.client.endpoint,
+            'bucket': self.client.bucket,
+            'prefix': self.prefix
+        }
+
+
+def create_cache_storage():
+    """Build the storage backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 's3':
+        client = S3Client(S3_ENDPOINT, S3_BUCKET, S3_REGION, S3_ACCESS_KEY, S3_SECRET_KEY, S3_TIMEOUT)
+        return S3CacheStorage(client, S3_PREFIX)
+    return LocalCacheStorage()
+
+
+cache_storage = create_cache_storage()
+
+
+class CacheIndex:
+    """
+    In-memory index of cached videos and playlist snapshots
+    Kept in sync by the save/delete helpers and flushed to CACHE_INDEX_FILE,
+    so inventory and statistics never need a directory scan
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._videos = {}
+        self._playlists = {}
+        self._loaded = False
+        self._dirty = False
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self._videos = data.get("videos", {})
+                self._playlists = data.get("playlists", {})
+                logger.info(f"Loaded cache index: {len(self._videos)} videos")
+                return
+        except Exception as e:
+            logger.error(f"Failed to load cache index, rebuilding: {str(e)}")
+        self.rebuild()
+
+    def rebuild(self):
+        """Rebuild the index from the download folder (one directory scan)"""
+        with self._lock:
+            self._loaded = True
+            self._videos = {}
+            self._playlists = {}
+            for mp3_file in glob.glob(os.path.join(folder_path, "*_*.mp3")):
+                video_id = get_video_id_from_cache_file(mp3_file)
+                metadata = load_video_metadata_cache(find_cached_metadata_file(video_id)) or {}
+                self.add_video(
+                    video_id,
+                    mp3_file,
+                    title=metadata.get("video_title", ""),
+                    duration=metadata.get("video_duration", 0),
+                    backend=metadata.get("backend", "unknown")
+                )
+            for playlist_file in glob.glob(os.path.join(folder_path, "playlist_*.json")):
+                playlist_id = os.path.basename(playlist_file)[len("playlist_"):-len(".json")]
+                playlist_data = load_playlist_cache(playlist_id) or []
+                self._playlists[playlist_id] = [item.get("video_id") for item in playlist_data]
+            self._dirty = True
+            logger.info(f"Rebuilt cache index: {len(self._videos)} videos, {len(self._playlists)} playlists")
+
+    def add_video(self, video_id, mp3_file, title="", duration=0, backend="unknown"):
+        if not mp3_file or not os.path.exists(mp3_file):
+            return
+        with self._lock:
+            self._ensure_loaded()
+            previous = self._videos.get(video_id, {})
+            now = int(time.time())
+            self._videos[video_id] = {
+                "video_id": video_id,
+                "video_title": title,
+                "video_duration": str(duration),
+                "mp3_file": mp3_file,
+                "size": os.path.getsize(mp3_file),
+                "backend": backend,
+                "created_at": now,
+                "last_access": now,
+                "hits": previous.get("hits", 0)
+            }
+            self._dirty = True
+
+    def touch(self, video_id, hit=True):
+        """Record an access to a cached video"""
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._videos.get(video_id)
+            if entry is None:
+                return
+            entry["last_access"] = int(time.time())
+            if hit:
+                entry["hits"] += 1
+            self._dirty = True
+
+    def remove_video(self, video_id):
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._videos.pop(video_id, None)
+            if entry is not None:
+                self._dirty = True
+            return entry
+
+    def get_video(self, video_id):
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._videos.get(video_id)
+            return dict(entry) if entry else None
+
+    def set_playlist(self, playlist_id, video_ids):
+        with self._lock:
+            self._ensure_loaded()
+            self._playlists[playlist_id] = [video_id for video_id in video_ids if video_id]
+            self._dirty = True
+
+    def remove_playlist(self, playlist_id):
+        with self._lock:
+            self._ensure_loaded()
+            video_ids = self._playlists.pop(playlist_id, None)
+            if video_ids is not None:
+                self._dirty = True
+            return video_ids
+
+    def get_playlist(self, playlist_id):
+        with self._lock:
+            self._ensure_loaded()
+            video_ids = self._playlists.get(playlist_id)
+            return list(video_ids) if video_ids is not None else None
+
+    def list_videos(self, playlist_id=None):
+        with self._lock:
+            self._ensure_loaded()
+            if playlist_id is None:
+                return [dict(entry) for entry in self._videos.values()]
+            return [
+                dict(self._videos[video_id])
+                for video_id in self._playlists.get(playlist_id, [])
+                if video_id in self._videos
+            ]
+
+    def playlist_totals(self):
+        with self._lock:
+            self._ensure_loaded()
+            totals = []
+            for playlist_id, video_ids in self._playlists.items():
+                cached = [self._videos[video_id] for video_id in video_ids if video_id in self._videos]
+                totals.append({
+                    "playlist_id": playlist_id,
+                    "videos": len(video_ids),
+                    "cached_videos": len(cached),
+                    "size": sum(entry["size"] for entry in cached)
+                })
+            return totals
+
+    def totals(self):
+        with self._lock:
+            self._ensure_loaded()
+            return {
+                "videos": len(self._videos),
+                "playlists": len(self._playlists),
+                "size": sum(entry["size"] for entry in self._videos.values()),
+                "hits": sum(entry["hits"] for entry in self._videos.values())
+            }
+
+    def flush(self):
+        """Write the index to disk if it changed since the last flush"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {"videos": self._videos, "playlists": self._playlists}
+            try:
+                ensure_directory_exists(os.path.dirname(self.path))
+                temp_path = f"{self.path}.part"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+                self._dirty = False
+            except Exception as e:
+                logger.error(f"Failed to save cache index: {str(e)}")
+
+
+cache_index = CacheIndex(CACHE_INDEX_FILE)
+
+
+def run_cache_index_flusher():
+    """Periodically persist the cache index (runs in a daemon thread)"""
+    while True:
+        time.sleep(CACHE_INDEX_FLUSH_INTERVAL)
+        cache_index.flush()
+
+
+def forget_cached_video(video_id):
+    """Drop a video from the in-memory caches (the files are already gone) and its HLS output"""
+    invalidate_video_info_in_memory(video_id)
+    cache_index.remove_video(video_id)
+    hls_packager.remove(video_id)
+
+
+def delete_cached_video(video_id):
+    """
+    Delete a video's MP3, metadata, thumbnail and HLS output, locally and in the storage
+    backend, and forget it. Returns bytes freed
+    Raises ValueError for an invalid video_id
+    """
+    if not is_valid_video_id(video_id):
+        raise ValueError(f"Invalid video id: {video_id}")
+
+    freed = 0
+    entry = cache_index.get_video(video_id) or {}
+    candidates = [
+        entry.get("mp3_file") or find_cached_mp3_file(video_id),
+        find_cached_metadata_file(video_id),
+        get_thumbnail_cache_path(video_id)
+    ]
+    for file_path in candidates:
+        if file_path and os.path.exists(file_path):
+            freed += os.path.getsize(file_path)
+            os.remove(file_path)
+    freed += hls_packager.remove(video_id)
+    freed += cache_storage.delete(video_id)
+    forget_cached_video(video_id)
+    logger.info(f"Deleted cached video {video_id} ({freed} bytes)")
+    return freed
+
+
+def build_flat_video_info(entry):
+    """Build a playlist item from a yt-dlp flat playlist entry, keeping title/duration/thumbnail"""
+    video_id = entry['id']
+    video_info = {
+        "video_url": f"https://youtube.com/watch?v={video_id}",
+        "video_id": video_id
+    }
+    if entry.get('title'):
+        video_info["video_title"] = entry['title']
+    if entry.get('duration'):
+        video_info["video_duration"] = str(int(entry['duration']))
+    thumbnails = [thumbnail for thumbnail in entry.get('thumbnails') or [] if thumbnail.get('url')]
+    if thumbnails:
+        # yt-dlp lists thumbnails from smallest to largest
+        video_info["video_thumbnail_url"] = thumbnails[-1]['url']
+    elif entry.get('thumbnail'):
+        video_info["video_thumbnail_url"] = entry['thumbnail']
+    return video_info
+
+
+def remember_flat_video_metadata(videos_info):
+    """Feed playlist items into the per-video metadata cache"""
+    with _flat_video_metadata_lock:
+        for video_info in videos_info:
+            if not video_info.get("video_title"):
+                continue
+            _flat_video_metadata[video_info["video_id"]] = {
+                "video_title": video_info.get("video_title", ""),
+                "video_duration": video_info.get("video_duration", "0"),
+                "video_thumbnail_url": video_info.get("video_thumbnail_url", "")
+            }
+            _flat_video_metadata.move_to_end(video_info["video_id"])
+        while len(_flat_video_metadata) > FLAT_METADATA_CACHE_SIZE:
+            _flat_video_metadata.popitem(last=False)
+
+
+def get_flat_video_metadata(video_id):
+    """Get title/duration/thumbnail seen in a playlist for video_id, or None"""
+    with _flat_video_metadata_lock:
+        metadata = _flat_video_metadata.get(video_id)
+        return dict(metadata) if metadata else None
+
+
+def get_video_id_from_cache_file(file_path):
+    """Get the video_id from a `<title>_<video_id>.<ext>` cache file name"""
+    # YouTube ids are 11 characters and may themselves contain underscores
+    return os.path.splitext(os.path.basename(file_path))[0][-11:]
+
+
+def get_video_info_from_memory(video_id):
+    """Get a video-info payload from the in-memory LRU, or None if missing/expired"""
+    with _video_info_cache_lock:
+        entry = _video_info_cache.get(video_id)
+        if entry is None:
+            return None
+        cached_at, payload = entry
+        if time.time() - cached_at > VIDEO_INFO_CACHE_TTL:
+            del _video_info_cache[video_id]
+            return None
+        _video_info_cache.move_to_end(video_id)
+        return dict(payload)
+
+
+def put_video_info_in_memory(video_id, payload):
+    """Store a video-info payload in the in-memory LRU, evicting the oldest entries"""
+    if VIDEO_INFO_CACHE_SIZE <= 0:
+        return
+    with _video_info_cache_lock:
+        _video_info_cache[video_id] = (time.time(), dict(payload))
+        _video_info_cache.move_to_end(video_id)
+        while len(_video_info_cache) > VIDEO_INFO_CACHE_SIZE:
+            _video_info_cache.popitem(last=False)
+
+
+def invalidate_video_info_in_memory(video_id=None):
+    """Drop one video (or everything when video_id is None) from the in-memory LRU"""
+    with _video_info_cache_lock:
+        if video_id is None:
+            _video_info_cache.clear()
+        else:
+            _video_info_cache.pop(video_id, None)
+
+
+class DownloadScheduler:
+    """
+    Hand out download slots fairly across devices
+    Interactive requests go before background ones, then the device served
+    least recently wins, so one device's prefetch cannot starve another
+    """
+
+    def __init__(self, max_concurrent, max_per_device):
+        self.max_concurrent = max_concurrent
+        self.max_per_device = max_per_device
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._active_total = 0
+        self._active_by_device = {}
+        self._last_served = {}
+        self._sequence = 0
+
+    def _next_ticket(self):
+        """Pick the waiting ticket that should get the next free slot"""
+        candidates = [
+            ticket for ticket in self._waiting
+            if self._active_by_device.get(ticket['device'], 0) < self.max_per_device
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda ticket: (
+            0 if ticket['priority'] == PRIORITY_INTERACTIVE else 1,
+            self._last_served.get(ticket['device'], -1),
+            ticket['sequence']
+        ))
+
+    def acquire(self, device, priority=PRIORITY_INTERACTIVE, deadline=None):
+        """Wait for a slot; returns False if none was free before deadline (None waits forever)"""
+        with self._condition:
+            self._sequence += 1
+            ticket = {'device': device, 'priority': priority, 'sequence': self._sequence}
+            self._waiting.append(ticket)
+            while not (self._active_total < self.max_concurrent and self._next_ticket() is ticket):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    self._waiting.remove(ticket)
+                    # This ticket may have been the one others were queued behind
+                    self._condition.notify_all()
+                    return False
+                self._condition.wait(timeout=remaining)
+            self._waiting.remove(ticket)
+            self._active_total += 1
+            self._active_by_device[device] = self._active_by_device.get(device, 0) + 1
+            self._last_served[device] = self._sequence
+            self._condition.notify_all()
+            return True
+
+    def release(self, device):
+        with self._condition:
+            self._active_total -= 1
+            self._active_by_device[device] -= 1
+            if self._active_by_device[device] <= 0:
+                del self._active_by_device[device]
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, device, priority=PRIORITY_INTERACTIVE, deadline=None):
+        """
+        Hold a download slot for the duration of the with block
+        Raises DeadlineExceeded if no slot is free before deadline
+        """
+        started_at = time.time()
+        with trace_span('scheduler.wait', device=device, priority=priority) as span:
+            acquired = self.acquire(device, priority, deadline)
+            span['acquired'] = acquired
+        if not acquired:
+            raise DeadlineExceeded(f"Deadline reached while waiting for a download slot for {device}")
+        waited = time.time() - started_at
+        if waited > 1:
+            logger.info(f"Download slot for {device} ({priority}) granted after {waited:.1f}s")
+        try:
+            yield
+        finally:
+            self.release(device)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'active': self._active_total,
+                'active_by_device': dict(self._active_by_device),
+                'waiting': len(self._waiting),
+                'max_concurrent': self.max_concurrent,
+                'max_per_device': self.max_per_device
+            }
+
+
+download_scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_DOWNLOADS_PER_DEVICE)
+
+# Scheduling priority of the download running in this context, and the holder
+# (anything with a .value in bytes/s, 0 = unlimited) its rate limit is read from
+_current_download_priority = contextvars.ContextVar('download_priority', default=PRIORITY_INTERACTIVE)
+_download_rate_limit = contextvars.ContextVar('download_rate_limit', default=None)
+
+
+class _RateLimitHolder:
+    """Rate limit of a download running in this process (workers use a shared RawValue)"""
+
+    def __init__(self):
+        self.value = 0.0
+
+
+@contextmanager
+def download_priority_context(priority):
+    """Run the with block's downloads at priority, for bandwidth shaping"""
+    token = _current_download_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_download_priority.reset(token)
+
+
+class TrafficShaper:
+    """
+    Split download bandwidth so serving audio on the LAN always comes first
+    Interactive downloads share DOWNLOAD_BANDWIDTH_LIMIT. While audio responses are in
+    flight (and PLAYBACK_GRACE after), background downloads only share
+    DOWNLOAD_BANDWIDTH_DURING_PLAYBACK. Limits are re-split whenever a download or
+    an audio response starts or ends, and running downloads pick them up right away
+    """
+
+    def __init__(self, download_limit, playback_download_limit, playback_grace):
+        self.download_limit = download_limit
+        self.playback_download_limit = playback_download_limit
+        self.playback_grace = playback_grace
+        self._lock = threading.Lock()
+        self._downloads = {}
+        self._next_download_id = 0
+        self._streams = 0
+        self._playback_until = 0
+        self._grace_timer = None
+
+    def _is_playback_active(self):
+        return self._streams > 0 or time.time() < self._playback_until
+
+    def _rebalance(self):
+        """Write every running download's share of its budget. Call with _lock held"""
+        playback = self._is_playback_active()
+        counts = {PRIORITY_INTERACTIVE: 0, PRIORITY_BACKGROUND: 0}
+        for priority, _ in self._downloads.values():
+            counts[priority] += 1
+        for priority, holder in self._downloads.values():
+            budget = self.download_limit
+            if priority == PRIORITY_BACKGROUND and playback and self.playback_download_limit:
+                budget = min(budget or self.playback_download_limit, self.playback_download_limit)
+            holder.value = float(budget) / counts[priority] if budget else 0.0
+
+    @contextmanager
+    def download(self, holder):
+        """Keep holder.value at this download's share for the duration of the with block"""
+        priority = _current_download_priority.get()
+        if priority not in (PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND):
+            priority = PRIORITY_INTERACTIVE
+        with self._lock:
+            self._next_download_id += 1
+            download_id = self._next_download_id
+            self._downloads[download_id] = (priority, holder)
+            self._rebalance()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._downloads[download_id]
+                self._rebalance()
+
+    def stream_started(self):
+        with self._lock:
+            self._streams += 1
+            self._rebalance()
+
+    def stream_finished(self):
+        with self._lock:
+            self._streams -= 1
+            if self._streams > 0:
+                return
+            self._playback_until = time.time() + self.playback_grace
+            # Lift the playback limit once the grace period is over
+            if self._grace_timer:
+                self._grace_timer.cancel()
+            self._grace_timer = threading.Timer(self.playback_grace + 0.1, self._on_grace_over)
+            self._grace_timer.daemon = True
+            self._grace_timer.start()
+
+    def _on_grace_over(self):
+        with self._lock:
+            self._rebalance()
+
+    def track_playback(self, response):
+        """Count response as playback until it has been sent (or the client went away)"""
+        self.stream_started()
+        if response.direct_passthrough:
+            # werkzeug hands passthrough bodies (send_file, sendfile) to the server as-is,
+            # so the response's own close callbacks would never run
+            response.response = ClosingIterator(response.response, self.stream_finished)
+        else:
+            response.call_on_close(self.stream_finished)
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                'playback_active': self._is_playback_active(),
+                'audio_responses': self._streams,
+                'downloads': [
+                    {'priority': priority, 'rate_limit': holder.value or None}
+                    for priority, holder in self._downloads.values()
+                ],
+                'download_limit': self.download_limit or None,
+                'playback_download_limit': self.playback_download_limit or None
+            }
+
+
+traffic_shaper = TrafficShaper(DOWNLOAD_BANDWIDTH_LIMIT, DOWNLOAD_BANDWIDTH_DURING_PLAYBACK, PLAYBACK_GRACE)
+
+
+def get_request_priority():
+    """Read the scheduling priority from the query string (defaults to interactive)"""
+    priority = request.args.get('priority', PRIORITY_INTERACTIVE)
+    if priority not in (PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND):
+        return PRIORITY_INTERACTIVE
+    return priority
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a video can no longer be resolved before the request deadline"""
+
+
+class AttemptTimeout(Exception):
+    """Raised from a progress callback when one download attempt runs past ATTEMPT_TIMEOUT"""
+
+
+def get_request_deadline():
+    """
+    Absolute deadline (epoch seconds) for resolving a video in this request
+    Uses the smaller of DOWNLOAD_DEADLINE and the client's DEADLINE_HEADER budget; None means no limit
+    """
+    budget = DOWNLOAD_DEADLINE
+    header_value = request.headers.get(DEADLINE_HEADER)
+    if header_value:
+        try:
+            client_budget = float(header_value)
+            if client_budget > 0:
+                budget = min(budget, client_budget) if budget else client_budget
+        except ValueError:
+            logger.warning(f"Ignoring invalid {DEADLINE_HEADER} header: {header_value}")
+    if not budget or budget <= 0:
+        return None
+    return time.time() + budget
+
+
+def get_attempt_timeout(video_id, deadline, last_error=None):
+    """
+    Seconds the next download attempt may run, capped by the time left before deadline
+    Raises DeadlineExceeded when less than MIN_ATTEMPT_BUDGET is left
+    """
+    if deadline is None:
+        return ATTEMPT_TIMEOUT
+    remaining = deadline - time.time()
+    if remaining < MIN_ATTEMPT_BUDGET:
+        raise build_deadline_error(video_id, last_error)
+    return min(ATTEMPT_TIMEOUT, remaining)
+
+
+def build_deadline_error(video_id, last_error=None):
+    """Build the DeadlineExceeded raised when a download ran out of time"""
+    error_msg = f"Deadline reached before video {video_id} could be downloaded"
+    if last_error:
+        error_msg += f". Last error: {last_error}"
+    progress_broker.publish(video_id, 'error', message=error_msg)
+    return DeadlineExceeded(error_msg)
+
+
+def check_attempt_time(attempt_deadline, description):
+    """Abort the running attempt once it is past its own deadline"""
+    if time.time() > attempt_deadline:
+        raise AttemptTimeout(f"Attempt '{description}' ran out of time")
+
+
+@contextmanager
+def acquire_before_deadline(lock, deadline, video_id):
+    """Hold lock, giving up with DeadlineExceeded if it is not free before deadline"""
+    timeout = -1 if deadline is None else max(deadline - time.time(), 0)
+    with trace_span('video.lock_wait', video_id=video_id) as span:
+        acquired = lock.acquire(timeout=timeout)
+        span['acquired'] = acquired
+    if not acquired:
+        raise DeadlineExceeded(f"Deadline reached while waiting for another download of video {video_id}")
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+class _TarStreamBuffer:
+    """
+    File-like sink that hands tarfile output to the response through a bounded queue
+    write() blocks while the client is behind and raises BrokenPipeError once it went away
+    """
+
+    def __init__(self, max_chunks):
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._closed = threading.Event()
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise BrokenPipeError("Cache bundle stream was closed")
+
+    def write(self, data):
+        self._put(bytes(data))
+        return len(data)
+
+    def finish(self):
+        """Mark the end of the archive"""
+        try:
+            self._put(None)
+        except BrokenPipeError:
+            pass
+
+    def close(self):
+        self._closed.set()
+
+    def chunks(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            yield chunk
+
+
+# Files a cache bundle may contain: `<title>_<video_id>.mp3|json` and `playlist_<id>.json` snapshots
+BUNDLE_VIDEO_FILE_PATTERN = re.compile(r'.+_[A-Za-z0-9_-]{11}\.(mp3|json)')
+BUNDLE_PLAYLIST_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+def is_admin_authorized():
+    """Whether this request may list, delete, rebuild, export or import the cache"""
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+def build_admin_forbidden_response():
+    return jsonify({
+        'error': 'Forbidden',
+        'message': 'Cache administration requires a valid X-Admin-Token header'
+    }), 403
+
+
+def is_bundle_entry_allowed(name):
+    """Whether a file of a cache bundle may be written to the download folder"""
+    # Server state files must never be replaced by an import
+    reserved = {os.path.basename(cache_index.path), os.path.basename(failed_video_cache.path)}
+    if os.path.basename(name) != name or name in reserved:
+        return False
+    if name.startswith('playlist_') and name.endswith('.json'):
+        return BUNDLE_PLAYLIST_ID_PATTERN.fullmatch(name[len('playlist_'):-len('.json')]) is not None
+    return BUNDLE_VIDEO_FILE_PATTERN.fullmatch(name) is not None
+
+
+def build_cache_bundle_manifest(playlist_id=None):
+    """
+    Build the index of a cache export bundle
+    Returns the manifest dict and the list of file paths to put in the bundle
+    """
+    playlist_ids = []
+    if playlist_id:
+        playlist_ids.append(playlist_id)
+    else:
+        for playlist_file in glob.glob(os.path.join(folder_path, "playlist_*.json")):
+            playlist_ids.append(os.path.basename(playlist_file)[len("playlist_"):-len(".json")])
+
+    video_ids = None
+    if playlist_id:
+        playlist_data = load_playlist_cache(playlist_id) or []
+        video_ids = [item.get("video_id") for item in playlist_data if item.get("video_id")]
+    else:
+        video_ids = [
+            get_video_id_from_cache_file(mp3_file)
+            for mp3_file in glob.glob(os.path.join(folder_path, "*_*.mp3"))
+        ]
+
+    files = [get_playlist_cache_path(item) for item in playlist_ids
+             if os.path.exists(get_playlist_cache_path(item))]
+    videos = []
+    for video_id in video_ids:
+        mp3_file = find_cached_mp3_file(video_id)
+        if not mp3_file:
+            continue
+        metadata_file = find_cached_metadata_file(video_id)
+        metadata = load_video_metadata_cache(metadata_file) or {}
+        videos.append({
+            "video_id": video_id,
+            "mp3_file": os.path.basename(mp3_file),
+            "metadata_file": os.path.basename(metadata_file) if metadata_file else None,
+            "size": os.path.getsize(mp3_file),
+            "video_title": metadata.get("video_title", ""),
+            "video_thumbnail_url": metadata.get("video_thumbnail_url", ""),
+            "video_duration": str(metadata.get("video_duration", "0"))
+        })
+        files.append(mp3_file)
+        if metadata_file:
+            files.append(metadata_file)
+
+    manifest = {
+        "version": BUNDLE_VERSION,
+        "created_at": int(time.time()),
+        "playlists": playlist_ids,
+        "videos": videos
+    }
+    return manifest, files
+
+
+def write_cache_bundle(sink, manifest, files):
+    """Write a tar archive of the manifest followed by the cached files to sink"""
+    try:
+        with tarfile.open(fileobj=sink, mode='w|') as tar:
+            manifest_bytes = json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+            manifest_info = tarfile.TarInfo(BUNDLE_MANIFEST_NAME)
+            manifest_info.size = len(manifest_bytes)
+            manifest_info.mtime = manifest["created_at"]
+            tar.addfile(manifest_info, io.BytesIO(manifest_bytes))
+
+            for file_path in files:
+                try:
+                    member_file = open(file_path, 'rb')
+                except OSError as e:
+                    logger.warning(f"Skipping {file_path} in cache bundle: {str(e)}")
+                    continue
+                with member_file:
+                    info = tar.gettarinfo(arcname=os.path.basename(file_path), fileobj=member_file)
+                    # Copied in tarfile's small blocks, the sink applies the back-pressure
+                    tar.addfile(info, member_file)
+    except BrokenPipeError:
+        logger.info("Cache bundle export stopped, the client disconnected")
+    except Exception as e:
+        # The archive is cut short, the client sees a truncated tar
+        logger.error(f"Failed to write cache bundle: {str(e)}")
+    finally:
+        sink.finish()
+
+
+def generate_cache_bundle(manifest, files):
+    """
+    Yield a tar archive of the manifest followed by the cached files
+    Written by a background thread, memory stays at BUNDLE_STREAM_QUEUE_CHUNKS blocks
+    """
+    sink = _TarStreamBuffer(BUNDLE_STREAM_QUEUE_CHUNKS)
+    writer = threading.Thread(target=write_cache_bundle, args=(sink, manifest, files), daemon=True)
+    writer.start()
+    try:
+        yield from sink.chunks()
+    finally:
+        sink.close()
+
+
+def import_cache_bundle(stream):
+    """
+    Unpack a cache bundle into the download folder
+    Only audio, metadata and playlist files are written; the manifest must come first
+    and is used to prime the in-memory index instead of re-parsing files
+    Returns a summary dict, raises ValueError for a bundle of an unknown version
+    """
+    manifest = None
+    imported_files = 0
+    skipped_files = 0
+    with tarfile.open(fileobj=stream, mode='r|') as tar:
+        for member in tar:
+            name = member.name
+            if manifest is None:
+                # Check the version before anything is written
+                if not member.isfile() or name != BUNDLE_MANIFEST_NAME:
+                    raise ValueError(f"Cache bundle must start with {BUNDLE_MANIFEST_NAME}")
+                manifest = json.loads(tar.extractfile(member).read().decode('utf-8'))
+                if not isinstance(manifest, dict) or manifest.get("version") != BUNDLE_VERSION:
+                    version = manifest.get("version") if isinstance(manifest, dict) else None
+                    raise ValueError(f"Unsupported cache bundle version {version}, expected {BUNDLE_VERSION}")
+                continue
+
+            if not member.isfile() or not is_bundle_entry_allowed(name):
+                logger.warning(f"Skipping {name} in cache bundle")
+                skipped_files += 1
+                continue
+
+            source = tar.extractfile(member)
+
+            target_path = os.path.join(folder_path, name)
+            temp_path = f"{target_path}.part"
+            with open(temp_path, 'wb') as f:
+                while True:
+                    chunk = source.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            os.replace(temp_path, target_path)
+            imported_files += 1
+
+    if manifest is None:
+        raise ValueError(f"Cache bundle has no {BUNDLE_MANIFEST_NAME}")
+
+    playlist_ids = [
+        playlist_id for playlist_id in manifest.get("playlists", [])
+        if isinstance(playlist_id, str) and BUNDLE_PLAYLIST_ID_PATTERN.fullmatch(playlist_id)
+    ]
+    for playlist_id in playlist_ids:
+        playlist_data = load_playlist_cache(playlist_id) or []
+        cache_index.set_playlist(playlist_id, [item.get("video_id") for item in playlist_data])
+
+    imported_videos = 0
+    for video in manifest.get("videos", []):
+        video_id = video.get("video_id")
+        mp3_name = video.get("mp3_file") or ""
+        if (not is_valid_video_id(video_id) or not mp3_name.endswith(f"_{video_id}.mp3")
+                or not is_bundle_entry_allowed(mp3_name)
+                or not os.path.exists(os.path.join(folder_path, mp3_name))):
+            continue
+        invalidate_video_info_in_memory(video_id)
+        cache_index.add_video(
+            video_id,
+            os.path.join(folder_path, video["mp3_file"]),
+            title=video.get("video_title", ""),
+            duration=video.get("video_duration", 0),
+            backend="import"
+        )
+        put_video_info_in_memory(video_id, {
+            "video_title": video.get("video_title", ""),
+            "video_thumbnail_url": video.get("video_thumbnail_url", ""),
+            "video_id": video_id,
+            "video_url": f"https://youtube.com/watch?v={video_id}",
+            "video_duration": str(video.get("video_duration", "0"))
+        })
+        imported_videos += 1
+
+    return {
+        "version": manifest["version"],
+        "imported_files": imported_files,
+        "skipped_files": skipped_files,
+        "imported_videos": imported_videos,
+        "playlists": playlist_ids
+    }
+
+
+def _is_peer_skipped(key):
+    with _peer_negative_cache_lock:
+        expires_at = _peer_negative_cache.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < time.time():
+            del _peer_negative_cache[key]
+            return False
+        return True
+
+
+def _skip_peer(key, ttl):
+    now = time.time()
+    with _peer_negative_cache_lock:
+        # Misses are keyed per video, so drop expired entries instead of letting them pile up
+        for expired_key in [k for k, expires_at in _peer_negative_cache.items() if expires_at < now]:
+            del _peer_negative_cache[expired_key]
+        _peer_negative_cache[key] = now + ttl
+
+
+def fetch_video_from_peers(video_id):
+    """
+    Copy a cached MP3 and its metadata from the first peer that has it
+    Returns (mp3_file, info) with yt-dlp style info keys, or None on a miss
+    """
+    for peer in PEER_SERVERS:
+        peer = peer.rstrip('/')
+        if _is_peer_skipped(peer) or _is_peer_skipped((peer, video_id)):
+            continue
+
+        try:
+            with urlopen(f"{peer}/v3/peer/{video_id}", timeout=PEER_LOOKUP_TIMEOUT) as response:
+                metadata = json.loads(response.read().decode('utf-8'))
+        except HTTPError as e:
+            if e.code == 404:
+                _skip_peer((peer, video_id), PEER_MISS_TTL)
+            else:
+                logger.warning(f"Peer {peer} lookup failed for {video_id}: {str(e)}")
+                _skip_peer(peer, PEER_DOWN_TTL)
+            continue
+        except Exception as e:
+            logger.warning(f"Peer {peer} unreachable, skipping for {PEER_DOWN_TTL}s: {str(e)}")
+            _skip_peer(peer, PEER_DOWN_TTL)
+            continue
+
+        video_title = metadata.get("video_title") or video_id
+        mp3_file = os.path.join(folder_path, f"{sanitize_filename(video_title)}_{video_id}.mp3")
+        temp_file = f"{mp3_file}.part"
+        try:
+            copied = 0
+            with urlopen(f"{peer}/v3/mp3/{video_id}?device=peer", timeout=PEER_TRANSFER_TIMEOUT) as response:
+                with open(temp_file, 'wb') as f:
+                    while True:
+                        chunk = response.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        copied += len(chunk)
+            # A truncated copy must never become a cache hit
+            if copied != metadata.get("size"):
+                raise Exception(f"copied {copied} bytes, peer reported {metadata.get('size')}")
+            os.replace(temp_file, mp3_file)
+        except Exception as e:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            if isinstance(e, PEER_CONNECTION_ERRORS):
+                logger.warning(f"Copy from peer {peer} failed for {video_id}, skipping the peer for {PEER_DOWN_TTL}s: {str(e)}")
+                _skip_peer(peer, PEER_DOWN_TTL)
+            else:
+                # The peer works, only its copy of this video is bad
+                logger.warning(f"Copy from peer {peer} failed for {video_id}: {str(e)}")
+                _skip_peer((peer, video_id), PEER_MISS_TTL)
+            continue
+
+        logger.info(f"Copied {video_id} from peer {peer}: {mp3_file}")
+        return mp3_file, {
+            'title': video_title,
+            'duration': metadata.get("video_duration", 0),
+            'thumbnail': metadata.get("video_thumbnail_url", ""),
+            'audio_format': metadata.get("audio_format")
+        }
+    return None
+
+
+def get_thumbnail_cache_path(video_id):
+    """Get cache file path for a resized thumbnail"""
+    return os.path.join(thumbnail_folder_path, f"{video_id}.jpg")
+
+
+def build_thumbnail_url(video_id, original_url):
+    """Point video_thumbnail_url at our thumbnail proxy when it is enabled"""
+    if not THUMBNAIL_PROXY:
+        return original_url
+    return f"{request.host_url.rstrip('/')}/v3/thumb/{video_id}"
+
+
+def cache_thumbnail(video_id, source_url):
+    """
+    Download a thumbnail once and store a resized JPEG copy with ffmpeg
+    Falls back to the original bytes if ffmpeg is unavailable or fails
+    Concurrent calls for one video each work on their own temp files, the last one wins
+    Returns the cached file path
+    """
+    ensure_directory_exists(thumbnail_folder_path)
+    thumbnail_path = get_thumbnail_cache_path(video_id)
+    original_fd, original_path = tempfile.mkstemp(prefix=f".{video_id}_", suffix='.orig', dir=thumbnail_folder_path)
+    resized_fd, resized_path = tempfile.mkstemp(prefix=f".{video_id}_", suffix='.jpg', dir=thumbnail_folder_path)
+    os.close(resized_fd)
+
+    try:
+        with os.fdopen(original_fd, 'wb') as f, urlopen(source_url, timeout=10) as response:
+            f.write(response.read())
+
+        try:
+            subprocess.run([
+                'ffmpeg', '-y', '-loglevel', 'error',
+                '-i', original_path,
+                '-vf', f"scale='min({THUMBNAIL_WIDTH},iw)':-2",
+                '-q:v', '5',
+                resized_path
+            ], check=True, capture_output=True, timeout=15)
+            os.replace(resized_path, thumbnail_path)
+        except Exception as e:
+            logger.warning(f"Could not resize thumbnail for {video_id}, keeping original: {str(e)}")
+            os.replace(original_path, thumbnail_path)
+    finally:
+        for temp_path in (original_path, resized_path):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    logger.info(f"Cached thumbnail: {thumbnail_path}")
+    return thumbnail_path
+
+
+HLS_PLAYLIST_NAME = 'index.m3u8'
+HLS_SEGMENT_PATTERN = re.compile(r'^seg_\d{5}\.ts$')
+
+
+class HlsPackager:
+    """
+    Segment cached audio into HLS (AAC in MPEG-TS) with ffmpeg
+    Each video is packaged once into hls/<video_id>/, swapped in whole when done
+    """
+
+    def __init__(self, max_concurrent):
+        self._lock = threading.Lock()
+        self._video_locks = {}
+        self._slots = threading.Semaphore(max_concurrent)
+
+    @staticmethod
+    def get_folder(video_id):
+        return os.path.join(hls_folder_path, video_id)
+
+    def get_playlist_path(self, video_id):
+        return os.path.join(self.get_folder(video_id), HLS_PLAYLIST_NAME)
+
+    def _get_video_lock(self, video_id):
+        with self._lock:
+            return self._video_locks.setdefault(video_id, threading.Lock())
+
+    def package(self, video_id):
+        """
+        Package video_id unless it already is and return its playlist path
+        Raises FileNotFoundError if the audio is not cached (dropping stale HLS output),
+        Exception if ffmpeg fails
+        """
+        playlist_path = self.get_playlist_path(video_id)
+        if os.path.exists(playlist_path) and is_audio_cached(video_id):
+            return playlist_path
+
+        with self._get_video_lock(video_id):
+            source_file = cache_storage.fetch_audio(video_id)
+            if not source_file or not os.path.exists(source_file):
+                self.remove(video_id)
+                raise FileNotFoundError(f"No cached audio for video {video_id}")
+            if os.path.exists(playlist_path):
+                return playlist_path
+
+            ensure_directory_exists(hls_folder_path)
+            temp_folder = tempfile.mkdtemp(prefix=f".{video_id}_", dir=hls_folder_path)
+            try:
+                with self._slots, trace_span('hls.package', video_id=video_id):
+                    # Re-encode: the cached file may be opus/webm or even a video container
+                    subprocess.run([
+                        'ffmpeg', '-y', '-loglevel', 'error',
+                        '-i', source_file,
+                        '-vn', '-c:a', 'aac', '-b:a', HLS_AUDIO_BITRATE,
+                        '-f', 'hls',
+                        '-hls_time', str(HLS_SEGMENT_SECONDS),
+                        '-hls_playlist_type', 'vod',
+                        '-hls_segment_filename', os.path.join(temp_folder, 'seg_%05d.ts'),
+                        os.path.join(temp_folder, HLS_PLAYLIST_NAME)
+                    ], check=True, capture_output=True, timeout=HLS_PACKAGE_TIMEOUT)
+                shutil.rmtree(self.get_folder(video_id), ignore_errors=True)
+                os.replace(temp_folder, self.get_folder(video_id))
+            except subprocess.CalledProcessError as e:
+                error_output = e.stderr.decode('utf-8', errors='replace').strip()
+                raise Exception(f"ffmpeg failed to package video {video_id}: {error_output[:300]}")
+            finally:
+                shutil.rmtree(temp_folder, ignore_errors=True)
+
+        logger.info(f"Packaged HLS for {video_id}: {playlist_path}")
+        return playlist_path
+
+    def package_in_background(self, video_id):
+        def run():
+            try:
+                self.package(video_id)
+            except Exception as e:
+                logger.warning(f"HLS packaging failed for {video_id}: {str(e)}")
+
+        threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+
+    def remove(self, video_id):
+        """Delete the HLS output of video_id. Returns bytes freed"""
+        folder = self.get_folder(video_id)
+        if not is_valid_video_id(video_id) or not os.path.isdir(folder):
+            return 0
+        freed = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+        shutil.rmtree(folder, ignore_errors=True)
+        return freed
+
+    def prune(self):
+        """
+        Delete HLS output whose audio is no longer cached, and temp folders left by
+        packaging runs that died. Returns the number of folders removed
+        """
+        if not os.path.isdir(hls_folder_path):
+            return 0
+        removed = 0
+        for entry in os.scandir(hls_folder_path):
+            if not entry.is_dir():
+                continue
+            if entry.name.startswith('.'):
+                # In-progress packaging never outlives HLS_PACKAGE_TIMEOUT
+                if time.time() - entry.stat().st_mtime > HLS_PACKAGE_TIMEOUT:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+            elif not is_valid_video_id(entry.name) or not is_audio_cached(entry.name):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        if removed:
+            logger.info(f"Removed {removed} stale HLS folders from {hls_folder_path}")
+        return removed
+
+
+hls_packager = HlsPackager(HLS_MAX_CONCURRENT)
+
+
+def build_hls_url(video_id):
+    return f"/v3/hls/{video_id}/{HLS_PLAYLIST_NAME}"
+
+
+class ProgressBroker:
+    """
+    Fan out download progress events to Server-Sent Events subscribers
+    Subscribers listen to one video_id or to every video (video_id None)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._latest = {}
+        self._last_published = {}
+
+    def subscribe(self, video_id=None):
+        subscriber = queue.Queue(maxsize=100)
+        with self._lock:
+            self._subscribers.setdefault(video_id, set()).add(subscriber)
+            # Replay the current state so late subscribers are not left blank
+            latest = [self._latest[video_id]] if video_id in self._latest else (
+                list(self._latest.values()) if video_id is None else []
+            )
+        for event in latest:
+            subscriber.put_nowait(event)
+        return subscriber
+
+    def unsubscribe(self, subscriber, video_id=None):
+        with self._lock:
+            subscribers = self._subscribers.get(video_id)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[video_id]
+
+    def publish(self, video_id, status, **fields):
+        """Publish an event; 'downloading' events are throttled per video"""
+        now = time.time()
+        event = {'video_id': video_id, 'status': status, 'time': now}
+        event.update(fields)
+        with self._lock:
+            if status == 'downloading':
+                if now - self._last_published.get(video_id, 0) < PROGRESS_EVENT_INTERVAL:
+                    return
+                self._last_published[video_id] = now
+            if status in ('finished', 'error'):
+                self._latest.pop(video_id, None)
+                self._last_published.pop(video_id, None)
+            else:
+                self._latest[video_id] = event
+            targets = list(self._subscribers.get(video_id, ())) + list(self._subscribers.get(None, ()))
+        for subscriber in targets:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                pass
+
+
+progress_broker = ProgressBroker()
+
+
+def make_ytdlp_progress_hook(video_id, strategy):
+    """Build a yt-dlp progress hook that publishes to the progress broker"""
+    def hook(progress):
+        status = progress.get('status')
+        if status not in ('downloading', 'finished'):
+            return
+        progress_broker.publish(
+            video_id,
+            'downloading' if status == 'downloading' else 'downloaded',
+            backend='yt-dlp',
+            strategy=strategy,
+            downloaded_bytes=progress.get('downloaded_bytes'),
+            total_bytes=progress.get('total_bytes') or progress.get('total_bytes_estimate'),
+            speed=progress.get('speed'),
+            eta=progress.get('eta')
+        )
+    return hook
+
+
+def make_pytubefix_progress_callback(video_id):
+    """Build a pytubefix progress callback that publishes to the progress broker"""
+    started_at = time.time()
+
+    def callback(stream, chunk, bytes_remaining):
+        on_progress(stream, chunk, bytes_remaining)
+        total_bytes = stream.filesize
+        downloaded_bytes = total_bytes - bytes_remaining
+        elapsed = max(time.time() - started_at, 0.001)
+        speed = downloaded_bytes / elapsed
+        progress_broker.publish(
+            video_id,
+            'downloading',
+            backend='pytubefix',
+            strategy='audio only',
+            downloaded_bytes=downloaded_bytes,
+            total_bytes=total_bytes,
+            speed=speed,
+            eta=(bytes_remaining / speed) if speed else None
+        )
+    return callback
+
+
+def create_youtube_object_with_retry(video_url, max_retries=MAX_RETRIES, device=None, deadline=None):
+    """
+    Create YouTube object with retry logic and exponential backoff
+    Retries stop early when the next one would start past deadline
+    Returns YouTube object or None if all attempts fail
+    """
+    video_id = video_url.split('watch?v=')[-1].split('&')[0]
+    progress_callback = make_pytubefix_progress_callback(video_id)
+    for attempt in range(max_retries):
+        try:
+            # Add some randomization to avoid thundering herd
+            if attempt > 0:
+                delay = (2 ** attempt) + random.uniform(0, 1)
+                if deadline is not None and time.time() + delay + MIN_ATTEMPT_BUDGET > deadline:
+                    logger.warning(f"No time left to retry {video_url} before the deadline")
+                    return None
+                # logger.info(f"Retrying YouTube object creation after "
+                #             f"{delay:.2f}s (attempt {attempt + 1}/"
+                #             f"{max_retries})")
+                time.sleep(delay)
+            
+            if device:
+                # V2 API with device-specific token
+                # token_file = get_device_token_path(device)  # Currently unused
+                yt = YouTube(
+                    video_url,
+                    # use_oauth=False,
+                    # allow_oauth_cache=True,
+                    # token_file=token_file,
+                    on_progress_callback=progress_callback
+                )
+            else:
+                # V1 API (original), the OAuth token is cached with the extraction session
+                ensure_directory_exists(SESSION_FOLDER)
+                yt = YouTube(
+                    video_url,
+                    use_oauth=True,
+                    allow_oauth_cache=True,
+                    token_file=SESSION_OAUTH_TOKEN_FILE,
+                    on_progress_callback=progress_callback
+                )
+            
+            # Test that the object is actually accessible
+            # _ = yt.title  # This will trigger the API call
+            return yt
+        except Exception as e:
+            logger.warning(f"Attempt {attempt + 1}/{max_retries} failed for "
+                           f"{video_url}: {str(e)}")
+            if attempt == max_retries - 1:
+                logger.error(f"All {max_retries} attempts failed for "
+                             f"{video_url}")
+                return None
+    return YouTube(video_url, on_progress_callback=progress_callback)
+
+def get_format_bitrate(fmt):
+    """Get the audio bitrate (kbps) of a yt-dlp format, or None if unknown"""
+    return fmt.get('abr') or fmt.get('tbr')
+
+
+def select_audio_format(formats, policy=None):
+    """
+    Pick the smallest yt-dlp format that satisfies the audio quality policy
+    Returns the format dict or None if nothing matches
+    """
+    policy = policy or AUDIO_QUALITY_POLICY
+    candidates = []
+    for fmt in formats:
+        if fmt.get('acodec') in (None, 'none'):
+            continue
+        if policy.get('audio_only') and fmt.get('vcodec') not in (None, 'none'):
+            continue
+        bitrate = get_format_bitrate(fmt)
+        if bitrate is None:
+            continue
+        if policy.get('max_abr') and bitrate > policy['max_abr']:
+            continue
+        if policy.get('min_abr') and bitrate < policy['min_abr']:
+            continue
+        candidates.append(fmt)
+
+    for codec in policy.get('preferred_codecs') or []:
+        preferred = [fmt for fmt in candidates if fmt.get('acodec', '').startswith(codec)]
+        if preferred:
+            candidates = preferred
+            break
+
+    if not candidates:
+        return None
+    # Same duration for every stream, so the lowest bitrate is the smallest download
+    return min(candidates, key=lambda fmt: (
+        get_format_bitrate(fmt),
+        fmt.get('filesize') or fmt.get('filesize_approx') or 0
+    ))
+
+
+def audio_policy_format_selector(ctx):
+    """yt-dlp `format` callable applying AUDIO_QUALITY_POLICY to the extracted formats"""
+    selected = select_audio_format(ctx.get('formats', []))
+    if selected:
+        logger.info(
+            f"Audio policy selected format {selected.get('format_id')}: "
+            f"{selected.get('acodec')} {get_format_bitrate(selected)}kbps"
+        )
+        yield selected
+
+
+def get_format_strategies():
+    """Format strategies to try, with the audio quality policy first when enabled"""
+    if AUDIO_QUALITY_POLICY.get('enabled'):
+        return [(audio_policy_format_selector, 'Audio quality policy')] + YTDLP_FORMAT_STRATEGIES
+    return list(YTDLP_FORMAT_STRATEGIES)
+
+
+def describe_audio_format(info):
+    """Summarize the format yt-dlp downloaded, for the metadata cache"""
+    if not info or not info.get('format_id'):
+        return None
+    return {
+        'format_id': info.get('format_id'),
+        'acodec': info.get('acodec'),
+        'abr': info.get('abr') or info.get('tbr'),
+        'ext': info.get('ext'),
+        'filesize': info.get('filesize') or info.get('filesize_approx')
+    }
+
+
+def get_audio_mimetype(file_path):
+    """
+    MIME type of a cached audio file from its first bytes
+    Cached files are all named .mp3, but may hold AAC/MP4, opus/webm or ogg
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            header = f.read(12)
+    except OSError:
+        return 'audio/mpeg'
+    if header[4:8] == b'ftyp':
+        return 'audio/mp4'
+    if header[:4] == b'\x1a\x45\xdf\xa3':
+        return 'audio/webm'
+    if header[:4] == b'OggS':
+        return 'audio/ogg'
+    return 'audio/mpeg'
+
+
+class ExtractionSession:
+    """
+    One warm YouTube session shared by every extraction and kept across restarts
+    The cookie jar (consent, visitor data and whatever else YouTube hands out) lives in
+    SESSION_COOKIE_FILE, seeded from YTDLP_COOKIE_FILE. Each extraction works on its own
+    copy that is merged back afterwards, since yt-dlp rewrites its cookie file on exit
+    and concurrent runs would otherwise clobber each other
+    """
+
+    def __init__(self, path, seed_path):
+        self.path = path
+        self.seed_path = seed_path
+        self._lock = threading.Lock()
+        self._jar = None
+        self._seed_mtime = 0
+        self._updated_at = 0
+        self._refreshed_at = None
+        self._refresh_error = None
+
+    def _ensure_loaded(self):
+        """Load the jar, then merge in the seed file if it changed since. Call with _lock held"""
+        if self._jar is None:
+            self._jar = YoutubeDLCookieJar()
+            if os.path.exists(self.path):
+                try:
+                    self._jar.load(self.path)
+                    self._updated_at = os.path.getmtime(self.path)
+                    logger.info(f"Loaded extraction session: {len(self._jar)} cookies")
+                except Exception as e:
+                    logger.error(f"Failed to load extraction session, starting cold: {str(e)}")
+
+        if not os.path.exists(self.seed_path):
+            return
+        seed_mtime = os.path.getmtime(self.seed_path)
+        if seed_mtime <= max(self._seed_mtime, self._updated_at):
+            return
+        self._seed_mtime = seed_mtime
+        try:
+            seed_jar = YoutubeDLCookieJar()
+            seed_jar.load(self.seed_path)
+        except Exception as e:
+            logger.error(f"Failed to read {self.seed_path}: {str(e)}")
+            return
+        for cookie in seed_jar:
+            self._jar.set_cookie(cookie)
+        self._save()
+        logger.info(f"Merged {len(seed_jar)} cookies from {self.seed_path} into the extraction session")
+
+    def _save(self):
+        """Write the jar atomically. Call with _lock held"""
+        self._jar.clear_expired_cookies()
+        ensure_directory_exists(os.path.dirname(self.path))
+        temp_file = f"{self.path}.part"
+        self._jar.save(temp_file)
+        os.replace(temp_file, self.path)
+        self._updated_at = time.time()
+
+    @contextmanager
+    def cookie_file(self):
+        """Path of a private copy of the session cookies, merged back after the with block"""
+        with self._lock:
+            self._ensure_loaded()
+            ensure_directory_exists(os.path.dirname(self.path))
+            fd, copy_path = tempfile.mkstemp(prefix='cookies_', suffix='.txt', dir=os.path.dirname(self.path))
+            os.close(fd)
+            self._jar.save(copy_path)
+        try:
+            yield copy_path
+        finally:
+            self._merge(copy_path)
+
+    def _merge(self, copy_path):
+        try:
+            jar = YoutubeDLCookieJar()
+            jar.load(copy_path)
+            with self._lock:
+                for cookie in jar:
+                    self._jar.set_cookie(cookie)
+                self._save()
+        except Exception as e:
+            # e.g. the worker was killed while yt-dlp was writing the copy
+            logger.warning(f"Could not merge extraction cookies back into the session: {str(e)}")
+        finally:
+            try:
+                os.remove(copy_path)
+            except OSError:
+                pass
+
+    def refresh(self):
+        """Visit SESSION_REFRESH_URL with the session so YouTube renews its cookies"""
+        with self.cookie_file() as cookie_file:
+            jar = YoutubeDLCookieJar(cookie_file)
+            jar.load()
+            opener = build_opener(HTTPCookieProcessor(jar))
+            refresh_request = Request(SESSION_REFRESH_URL, headers={'User-Agent': YTDLP_USER_AGENT})
+            with opener.open(refresh_request, timeout=SOCKET_TIMEOUT) as response:
+                response.read()
+            jar.save()
+        self._refreshed_at = time.time()
+        logger.info(f"Refreshed extraction session: {self.cookie_count()} cookies")
+
+    def refresh_if_stale(self):
+        """Refresh unless an extraction used (and so renewed) the session recently"""
+        with self._lock:
+            self._ensure_loaded()
+            stale = time.time() - self._updated_at > SESSION_REFRESH_INTERVAL
+        if not stale:
+            return
+        try:
+            self.refresh()
+            self._refresh_error = None
+        except Exception as e:
+            self._refresh_error = str(e)
+            logger.warning(f"Failed to refresh extraction session: {str(e)}")
+
+    def cookie_count(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._jar)
+
+    def stats(self):
+        with self._lock:
+            self._ensure_loaded()
+            return {
+                'cookies': len(self._jar),
+                'updated_at': int(self._updated_at) or None,
+                'refreshed_at': int(self._refreshed_at) if self._refreshed_at else None,
+                'refresh_error': self._refresh_error,
+                'seed_file': self.seed_path if os.path.exists(self.seed_path) else None
+            }
+
+
+extraction_session = ExtractionSession(SESSION_COOKIE_FILE, YTDLP_COOKIE_FILE)
+
+
+def run_session_refresher():
+    """Keep the extraction session warm while the server is idle (runs in a daemon thread)"""
+    while True:
+        extraction_session.refresh_if_stale()
+        time.sleep(SESSION_REFRESH_CHECK_INTERVAL)
+
+
+def build_ytdlp_options(video_id, strategy, description, output_dir, attempt_timeout=ATTEMPT_TIMEOUT,
+                        cookie_file=None):
+    """
+    Build yt-dlp options for one format strategy, bounded by attempt_timeout seconds
+    cookie_file is the extraction session copy the attempt reads and updates
+    """
+    attempt_deadline = time.time() + attempt_timeout
+    ydl_opts = {
+        'outtmpl': os.path.join(output_dir, '%(title)s_%(id)s.%(ext)s'),
+        'noplaylist': True,
+        'quiet': False,  # Enable verbose output for debugging
+        'no_warnings': False,  # Show warnings to understand issues
+        'ignoreerrors': False,
+        'extractaudio': False,  # Don't try to extract audio (no FFmpeg)
+        # Handle signature extraction failures (common in HA)
+        'extractor_args': {
+            'youtube': {
+                'player_client': ['android', 'web'],  # Try different clients
+            }
+        },
+        # Alternative user agent for better compatibility
+        'http_headers': {
+            'User-Agent': YTDLP_USER_AGENT
+        },
+        # Fail stalled connections instead of hanging on them
+        'socket_timeout': min(SOCKET_TIMEOUT, attempt_timeout),
+        # Publish progress to /v3/progress subscribers, and stop the attempt once it runs too long
+        'progress_hooks': [
+            make_ytdlp_progress_hook(video_id, description),
+            lambda progress: check_attempt_time(attempt_deadline, description)
+        ]
+    }
+
+    # Only add format if specified
+    if strategy:
+        ydl_opts['format'] = strategy
+
+    # Reuse the warm session, and yt-dlp's player/signature cache from earlier runs
+    ydl_opts['cachedir'] = YTDLP_CACHE_DIR
+    if cookie_file:
+        ydl_opts['cookiefile'] = cookie_file
+
+    return ydl_opts
+
+
+def rename_download_to_mp3(video_id, output_dir):
+    """Find the file downloaded for video_id in output_dir and give it a .mp3 name"""
+    # Find the downloaded file (might not be mp3)
+    pattern = os.path.join(output_dir, f"*_{video_id}.*")
+    matches = [match for match in glob.glob(pattern) if not match.endswith(('.json', '.part'))]
+    if not matches:
+        return None
+
+    downloaded_file = matches[0]
+    logger.info(f"Downloaded file: {downloaded_file}")
+
+    # Rename to .mp3 for consistency (even if it's not audio)
+    mp3_file = downloaded_file.rsplit('.', 1)[0] + '.mp3'
+    if downloaded_file != mp3_file:
+        os.rename(downloaded_file, mp3_file)
+        logger.info(f"Renamed to: {mp3_file}")
+    return mp3_file
+
+
+def build_download_error(video_id, attempts, last_error=None):
+    """Build the exception raised when every download strategy failed"""
+    error_msg = f"All {attempts} download strategies failed for video {video_id}. "
+    if last_error:
+        error_msg += f"Last error: {last_error}. "
+    error_msg += f"Video URL: https://youtube.com/watch?v={video_id}. "
+    error_msg += f"Session cookies: {extraction_session.cookie_count()}. "
+    error_msg += "This might be due to: 1) Video is private/deleted, 2) Network restrictions in HA, "
+    error_msg += "3) yt-dlp version compatibility, 4) Missing dependencies in HA container"
+
+    progress_broker.publish(video_id, 'error', backend='yt-dlp', message=error_msg)
+    return Exception(error_msg)
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a progress callback to abort a losing hedged attempt"""
+
+
+def slim_download_info(info):
+    """Keep only DOWNLOAD_INFO_FIELDS so attempt results stay small and picklable"""
+    return {key: info.get(key) for key in DOWNLOAD_INFO_FIELDS if info.get(key) is not None}
+
+
+class DownloadThrottle:
+    """
+    Keep a download under the rate limit in _download_rate_limit by sleeping in its
+    progress callbacks. The limit is re-read while waiting, so it follows rebalancing
+    """
+
+    def __init__(self, check_progress):
+        self._rate_limit = _download_rate_limit.get()
+        self._check_progress = check_progress
+        self._allowed_at = time.time()
+        self._last_downloaded = {}
+
+    def consume(self, byte_count):
+        """Account for byte_count new bytes, sleeping until the rate limit allows them"""
+        rate = self._rate_limit.value if self._rate_limit is not None else 0
+        now = time.time()
+        if rate <= 0 or byte_count <= 0:
+            self._allowed_at = now
+            return
+        self._allowed_at = max(self._allowed_at, now - DOWNLOAD_BURST_SECONDS) + byte_count / rate
+        while True:
+            delay = self._allowed_at - time.time()
+            if delay <= 0:
+                return
+            time.sleep(min(delay, 0.5))
+            self._check_progress()
+            new_rate = self._rate_limit.value
+            if new_rate <= 0:
+                self._allowed_at = time.time()
+                return
+            if new_rate != rate:
+                # Stretch or shrink the wait still owed to the new rate
+                self._allowed_at = time.time() + max(self._allowed_at - time.time(), 0) * rate / new_rate
+                rate = new_rate
+
+    def ytdlp_hook(self, progress):
+        """yt-dlp progress hook: downloaded_bytes is cumulative per file"""
+        if progress.get('status') != 'downloading':
+            return
+        filename = progress.get('filename')
+        downloaded_bytes = progress.get('downloaded_bytes') or 0
+        last_downloaded = self._last_downloaded.get(filename, 0)
+        self._last_downloaded[filename] = downloaded_bytes
+        self.consume(downloaded_bytes - last_downloaded if downloaded_bytes >= last_downloaded else downloaded_bytes)
+
+
+def run_download_attempt(video_id, backend, strategy, description, output_dir, attempt_timeout,
+                         cancel_marker=None, probe_formats=False, cookie_file=None):
+    """
+    Download video_id into output_dir with one backend/format strategy
+    Runs inside an extraction worker when the pool is enabled, so it only takes and
+    returns picklable values. The attempt aborts once cancel_marker exists
+    cookie_file is the extraction session copy yt-dlp reads and updates
+    Returns the slim info dict of the download
+    """
+    youtube_url = f"https://youtube.com/watch?v={video_id}"
+    attempt_deadline = time.time() + attempt_timeout
+
+    def check_progress():
+        if cancel_marker and os.path.exists(cancel_marker):
+            raise DownloadCancelled(f"Hedged attempt '{description}' cancelled")
+        check_attempt_time(attempt_deadline, description)
+
+    # The race may have closed while this attempt waited for a worker
+    check_progress()
+    throttle = DownloadThrottle(check_progress)
+
+    if backend == 'pytubefix':
+        publish_progress = make_pytubefix_progress_callback(video_id)
+
+        def on_pytubefix_progress(stream, chunk, bytes_remaining):
+            check_progress()
+            publish_progress(stream, chunk, bytes_remaining)
+            throttle.consume(len(chunk))
+
+        yt = YouTube(youtube_url, on_progress_callback=on_pytubefix_progress)
+        audio_stream = yt.streams.get_audio_only()
+        check_progress()
+        audio_stream.download(
+            output_path=output_dir,
+            filename=f"{sanitize_filename(yt.title)}_{video_id}.mp4",
+            timeout=min(SOCKET_TIMEOUT, attempt_timeout)
+        )
+        return {'title': yt.title, 'duration': yt.length, 'thumbnail': yt.thumbnail_url}
+
+    ydl_opts = build_ytdlp_options(video_id, strategy, description, output_dir, attempt_timeout, cookie_file)
+    if cancel_marker:
+        ydl_opts['progress_hooks'].append(lambda progress: check_progress())
+        # Also stop a cancelled attempt before its ffmpeg post-processing
+        ydl_opts.setdefault('postprocessor_hooks', []).append(lambda progress: check_progress())
+    ydl_opts['progress_hooks'].append(throttle.ytdlp_hook)
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        if probe_formats:
+            # First, just get info without downloading to see what's available
+            logger.info("Getting video info first...")
+            info = ydl.extract_info(youtube_url, download=False)
+
+            available_formats = info.get('formats', [])
+            logger.info(f"Found {len(available_formats)} available formats")
+            check_attempt_time(attempt_deadline, description)
+
+            # Now try to download
+            logger.info("Attempting download...")
+        info = ydl.extract_info(youtube_url, download=True)
+    return slim_download_info(info)
+
+
+class ExtractionWorkerError(Exception):
+    """A download attempt failed (or its worker died) inside the extraction pool"""
+
+
+class _ForwardingProgressBroker:
+    """Stands in for progress_broker inside extraction workers and ships events to the parent"""
+
+    def __init__(self, events):
+        self._events = events
+        self._last_published = {}
+
+    def publish(self, video_id, status, **fields):
+        now = time.time()
+        if status == 'downloading':
+            if now - self._last_published.get(video_id, 0) < PROGRESS_EVENT_INTERVAL:
+                return
+            self._last_published[video_id] = now
+        try:
+            self._events.put_nowait((video_id, status, fields))
+        except queue.Full:
+            pass
+
+
+def _extraction_worker_main(conn, events, rate_limit):
+    """
+    Extraction worker process: run (func, args) tasks from conn until the parent goes away
+    rate_limit is shared with the parent, which keeps it at this worker's download share
+    """
+    global progress_broker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is handled by the parent
+    if EXTRACTION_WORKER_NICE and hasattr(os, 'nice'):
+        # Without an explicit ionice class, Linux derives the disk I/O priority from the nice value
+        os.nice(EXTRACTION_WORKER_NICE)
+    progress_broker = _ForwardingProgressBroker(events)
+    _download_rate_limit.set(rate_limit)
+    while True:
+        try:
+            func, args, request_id = conn.recv()
+        except EOFError:
+            return
+        try:
+            with request_id_context(request_id):
+                result = ('ok', func(*args))
+        except Exception as e:
+            result = ('error', str(e))
+        try:
+            conn.send(result)
+        except (BrokenPipeError, OSError):
+            # The parent is gone
+            return
+
+
+class ExtractionPool:
+    """
+    Pre-forked worker processes that run yt-dlp/pytubefix attempts off the Flask process,
+    so CPU-heavy extraction does not hold the GIL that serves cache hits and MP3s
+    Workers fork from a forkserver that already imported EXTRACTION_PRELOAD_MODULES.
+    A worker that crashes or overruns its attempt is killed and replaced on its own
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        self._context = None
+        self._events = None
+        self._started = False
+        self._busy = 0
+        self._restarts = 0
+
+    def start(self):
+        with self._lock:
+            if self._started or self.size <= 0:
+                return
+            try:
+                self._context = multiprocessing.get_context('forkserver')
+                self._context.set_forkserver_preload(EXTRACTION_PRELOAD_MODULES)
+            except ValueError:
+                # No forkserver on this platform
+                self._context = multiprocessing.get_context('spawn')
+            self._events = self._context.Queue(maxsize=1000)
+            threading.Thread(target=self._forward_events, daemon=True).start()
+            for _ in range(self.size):
+                self._idle.put(self._spawn())
+            self._started = True
+        logger.info(f"Started {self.size} extraction workers")
+
+    def _spawn(self):
+        parent_conn, child_conn = self._context.Pipe()
+        rate_limit = self._context.RawValue('d', 0.0)
+        process = self._context.Process(
+            target=_extraction_worker_main,
+            args=(child_conn, self._events, rate_limit),
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        return {'process': process, 'conn': parent_conn, 'rate_limit': rate_limit}
+
+    def _replace(self, worker):
+        worker['process'].kill()
+        worker['process'].join(timeout=5)
+        worker['conn'].close()
+        logger.warning(f"Replaced extraction worker {worker['process'].pid} "
+                       f"(exit code {worker['process'].exitcode})")
+        with self._lock:
+            self._restarts += 1
+        self._idle.put(self._spawn())
+
+    def _forward_events(self):
+        """Re-publish worker progress events on the parent's progress broker"""
+        while True:
+            try:
+                video_id, status, fields = self._events.get()
+                progress_broker.publish(video_id, status, **fields)
+            except Exception as e:
+                logger.error(f"Failed to forward extraction progress: {str(e)}")
+                time.sleep(1)
+
+    def run(self, func, args, timeout):
+        """
+        Run func(*args) in a worker and return its result, waiting at most timeout seconds
+        (plus EXTRACTION_KILL_GRACE). Runs on the calling thread when the pool is disabled
+        """
+        if self.size <= 0:
+            rate_limit = _RateLimitHolder()
+            token = _download_rate_limit.set(rate_limit)
+            try:
+                with traffic_shaper.download(rate_limit):
+                    return func(*args)
+            finally:
+                _download_rate_limit.reset(token)
+        self.start()
+
+        started_at = time.time()
+        with trace_span('extraction.queue_wait'):
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise AttemptTimeout("No extraction worker became free in time")
+
+        with self._lock:
+            self._busy += 1
+        healthy = False
+        try:
+            with traffic_shaper.download(worker['rate_limit']):
+                worker['conn'].send((func, args, get_request_id()))
+                remaining = max(timeout - (time.time() - started_at), 0) + EXTRACTION_KILL_GRACE
+                if not worker['conn'].poll(remaining):
+                    raise AttemptTimeout(f"Extraction worker hung for {time.time() - started_at:.0f}s and was restarted")
+                status, payload = worker['conn'].recv()
+            healthy = True
+        except (EOFError, OSError) as e:
+            raise ExtractionWorkerError(f"Extraction worker crashed: {str(e) or type(e).__name__}")
+        finally:
+            with self._lock:
+                self._busy -= 1
+            if healthy:
+                self._idle.put(worker)
+            else:
+                self._replace(worker)
+
+        if status == 'error':
+            raise ExtractionWorkerError(payload)
+        return payload
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.size if self._started else 0,
+                'busy': self._busy,
+                'restarts': self._restarts
+            }
+
+
+extraction_pool = ExtractionPool(EXTRACTION_WORKERS)
+
+
+def download_audio_with_ytdlp(video_id, deadline=None, device=None):
+    """
+    Download audio using yt-dlp and get info in single call
+    Strategies are not started once they can no longer finish before deadline
+    The caller holds one download slot for device; hedged attempts take their own
+    """
+    if HEDGE_ENABLED:
+        return download_audio_hedged(video_id, deadline, device)
+
+    format_strategies = get_format_strategies()
+    last_error = None
+    
+    for strategy, description in format_strategies:
+        attempt_timeout = get_attempt_timeout(video_id, deadline, last_error)
+        
+        try:
+            logger.info(f"Trying strategy: {description} (format: {strategy if isinstance(strategy, str) or strategy is None else 'policy'})")
+            progress_broker.publish(video_id, 'strategy', backend='yt-dlp', strategy=description)
+            
+            with trace_span('download.attempt', video_id=video_id, backend='yt-dlp', strategy=description), \
+                    extraction_session.cookie_file() as cookie_file:
+                info = extraction_pool.run(
+                    run_download_attempt,
+                    (video_id, 'yt-dlp', strategy, description, folder_path, attempt_timeout, None, True, cookie_file),
+                    attempt_timeout
+                )
+            
+            mp3_file = rename_download_to_mp3(video_id, folder_path)
+            if mp3_file:
+                progress_broker.publish(video_id, 'finished', backend='yt-dlp', strategy=description)
+                return mp3_file, info
+            else:
+                logger.warning("No files found matching pattern")
+                    
+        except Exception as e:
+            logger.warning(f"Strategy '{description}' failed: {str(e)}")
+            last_error = str(e)
+            continue
+    
+    # If all strategies fail, provide detailed error
+    raise build_download_error(video_id, len(format_strategies), last_error)
+
+
+def download_audio_with_pytubefix(video_id, deadline=None):
+    """
+    Download the audio-only stream with pytubefix in an extraction worker
+    Returns (mp3_file, info) with yt-dlp style info keys
+    Raises DeadlineExceeded when no time is left, Exception if the download fails
+    """
+    attempt_timeout = get_attempt_timeout(video_id, deadline)
+    description = 'pytubefix audio only'
+    progress_broker.publish(video_id, 'strategy', backend='pytubefix', strategy=description)
+
+    with trace_span('download.attempt', video_id=video_id, backend='pytubefix', strategy=description):
+        info = extraction_pool.run(
+            run_download_attempt,
+            (video_id, 'pytubefix', None, description, folder_path, attempt_timeout),
+            attempt_timeout
+        )
+
+    mp3_file = rename_download_to_mp3(video_id, folder_path)
+    if not mp3_file:
+        raise Exception(f"pytubefix finished without a file for video {video_id}")
+    progress_broker.publish(video_id, 'finished', backend='pytubefix', strategy='audio only')
+    return mp3_file, info
+
+
+def _attempt_has_bytes(attempt):
+    """Whether a hedged attempt has written any bytes into its temp folder yet"""
+    try:
+        return any(entry.is_file() and entry.stat().st_size > 0 for entry in os.scandir(attempt['temp_dir']))
+    except OSError:
+        return False
+
+
+def _close_hedged_race(race):
+    """
+    Close the race: attempts still running see the shared abort marker at their next
+    progress callback and stop, the last one to finish removes the race folder
+    """
+    with race['lock']:
+        race['open'] = False
+        if race['running'] > 0:
+            try:
+                with open(race['abort_marker'], 'w'):
+                    pass
+            except OSError:
+                pass
+            return
+    shutil.rmtree(race['dir'], ignore_errors=True)
+
+
+def _release_hedged_attempt_slot(attempt, race):
+    """Give back the download slot an attempt ran in"""
+    if attempt['slot'] == 'caller':
+        with race['lock']:
+            race['caller_slot_free'] = True
+    else:
+        download_scheduler.release(attempt['device'])
+
+
+def _run_hedged_attempt(video_id, candidate, attempt, race, results):
+    """
+    Run one hedged download attempt in its own temp folder
+    The first attempt to succeed while the race is open moves its file into
+    folder_path; the rest are aborted through race['abort_marker'] and clean up
+    """
+    backend, strategy, description = candidate
+    outcome = ('lost', attempt, None)
+    try:
+        progress_broker.publish(video_id, 'strategy', backend=backend, strategy=description)
+        attempt_timeout = max(attempt['deadline'] - time.time(), 0)
+        with trace_span('download.attempt', video_id=video_id, backend=backend, strategy=description, hedged=True), \
+                extraction_session.cookie_file() as cookie_file:
+            info = extraction_pool.run(
+                run_download_attempt,
+                (video_id, backend, strategy, description, attempt['temp_dir'], attempt_timeout,
+                 race['abort_marker'], False, cookie_file),
+                attempt_timeout
+            )
+
+        temp_mp3_file = rename_download_to_mp3(video_id, attempt['temp_dir'])
+        if not temp_mp3_file:
+            raise Exception("No files found matching pattern")
+
+        with race['lock']:
+            if race['open']:
+                race['open'] = False
+                mp3_file = os.path.join(folder_path, os.path.basename(temp_mp3_file))
+                os.replace(temp_mp3_file, mp3_file)
+                outcome = ('ok', attempt, (mp3_file, info))
+                progress_broker.publish(video_id, 'finished', backend=backend, strategy=description)
+    except Exception as e:
+        outcome = ('error', attempt, e)
+    finally:
+        shutil.rmtree(attempt['temp_dir'], ignore_errors=True)
+        # Free the slot before reporting, so the coordinator can start the next candidate in it
+        _release_hedged_attempt_slot(attempt, race)
+        with race['lock']:
+            race['running'] -= 1
+            last_out = race['running'] == 0 and not race['open']
+        if last_out:
+            shutil.rmtree(race['dir'], ignore_errors=True)
+        results.put(outcome)
+
+
+def download_audio_hedged(video_id, deadline=None, device=None):
+    """
+    Download with hedged attempts: when the newest attempt has not produced any
+    bytes after HEDGE_DELAY seconds (or failed), the next candidate starts in
+    parallel. The first attempt to finish wins. Once the race ends (a winner, deadline
+    passed or every candidate failed) a shared abort marker stops the attempts still running
+    One attempt runs in the caller's download slot, parallel ones only start when
+    download_scheduler has a free slot for device
+    """
+    candidates = [('yt-dlp', strategy, description) for strategy, description in get_format_strategies()]
+    if HEDGE_PYTUBEFIX_BACKUP:
+        candidates.insert(1, ('pytubefix', None, 'pytubefix audio only'))
+
+    ensure_directory_exists(folder_path)
+    race_dir = tempfile.mkdtemp(prefix='.hedge_', dir=folder_path)
+    race = {
+        'lock': threading.Lock(),
+        'open': True,
+        'caller_slot_free': True,
+        'running': 0,
+        'dir': race_dir,
+        'abort_marker': os.path.join(race_dir, '.aborted')
+    }
+    priority = _current_download_priority.get()
+    results = queue.Queue()
+    attempts = []
+
+    last_error = None
+    out_of_time = False
+
+    def start_next():
+        """Start the next candidate; returns False when the deadline leaves no room for it"""
+        nonlocal out_of_time
+        try:
+            attempt_timeout = get_attempt_timeout(video_id, deadline, last_error)
+        except DeadlineExceeded:
+            out_of_time = True
+            return False
+        with race['lock']:
+            slot = 'caller' if race['caller_slot_free'] else 'scheduler'
+            race['caller_slot_free'] = False
+        if slot == 'scheduler' and not download_scheduler.acquire(device, priority, deadline=time.time()):
+            # No slot free right now: hedge again at the next HEDGE_DELAY tick
+            logger.info(f"No download slot free to hedge {video_id}, waiting")
+            return False
+        candidate = candidates[len(attempts)]
+        attempt = {
+            'description': candidate[2],
+            'deadline': time.time() + attempt_timeout,
+            'temp_dir': tempfile.mkdtemp(prefix='attempt_', dir=race['dir']),
+            'device': device,
+            'slot': slot
+        }
+        attempts.append(attempt)
+        with race['lock']:
+            race['running'] += 1
+        logger.info(f"Hedged attempt {len(attempts)}/{len(candidates)}: {candidate[2]}")
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(_run_hedged_attempt, video_id, candidate, attempt, race, results),
+            daemon=True
+        ).start()
+        return True
+
+    def can_start_next():
+        return not out_of_time and len(attempts) < len(candidates) and running < HEDGE_MAX_PARALLEL
+
+    running = 0
+    try:
+        if start_next():
+            running += 1
+        while running > 0:
+            wait = HEDGE_DELAY if can_start_next() else None
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+                wait = remaining if wait is None else min(wait, remaining)
+            try:
+                outcome, attempt, payload = results.get(timeout=wait)
+            except queue.Empty:
+                if deadline is not None and time.time() >= deadline:
+                    # Out of time: late finishers discard their file, the rest stop at their next callback
+                    _close_hedged_race(race)
+                    # An attempt may have won just before the race closed
+                    while True:
+                        try:
+                            outcome, attempt, payload = results.get_nowait()
+                        except queue.Empty:
+                            break
+                        if outcome == 'ok':
+                            return payload
+                    break
+                # Nothing finished in time: hedge unless the newest attempt is already streaming
+                if not _attempt_has_bytes(attempts[-1]) and start_next():
+                    running += 1
+                continue
+
+            running -= 1
+            if outcome == 'ok':
+                logger.info(f"Hedged download won by: {attempt['description']}")
+                return payload
+
+            if outcome == 'error':
+                logger.warning(f"Strategy '{attempt['description']}' failed: {str(payload)}")
+                last_error = str(payload)
+            if can_start_next() and start_next():
+                running += 1
+
+        if out_of_time or (deadline is not None and time.time() >= deadline):
+            raise build_deadline_error(video_id, last_error)
+        raise build_download_error(video_id, len(candidates), last_error)
+    finally:
+        # Stops the losers (or, past the deadline, every attempt still running)
+        _close_hedged_race(race)
+
+
+class VideoUnavailableError(Exception):
+    """Raised without any network work for a video in the failed-video cache"""
+
+    def __init__(self, video_id, entry):
+        self.video_id = video_id
+        self.reason = entry['reason']
+        self.retry_after = max(int(entry['expires_at'] - time.time()), 0)
+        super().__init__(
+            f"Video {video_id} failed recently ({entry['reason']}: {entry['message']}). "
+            f"Retrying in {self.retry_after}s"
+        )
+
+
+class FailedVideoCache:
+    """
+    Negative cache of videos that could not be downloaded, with a backoff TTL
+    Private/deleted/blocked videos are skipped for FAILED_VIDEO_UNAVAILABLE_TTL,
+    other failures back off from FAILED_VIDEO_BASE_TTL up to FAILED_VIDEO_MAX_TTL
+    Expired entries are kept for FAILED_VIDEO_MAX_TTL more so a repeat failure keeps backing off,
+    then pruned; at most FAILED_VIDEO_MAX_ENTRIES are kept
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _ensure_loaded(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load failed-video cache: {str(e)}")
+
+    def _prune(self):
+        now = time.time()
+        self._entries = {
+            video_id: entry for video_id, entry in self._entries.items()
+            if entry.get('expires_at', 0) + FAILED_VIDEO_MAX_TTL > now
+        }
+        if len(self._entries) > FAILED_VIDEO_MAX_ENTRIES:
+            # Stable sort: on ties the entry recorded last stays
+            by_expiry = sorted(self._entries.items(), key=lambda item: item[1]['expires_at'])
+            self._entries = dict(by_expiry[-FAILED_VIDEO_MAX_ENTRIES:])
+
+    def _save(self):
+        self._prune()
+        try:
+            ensure_directory_exists(os.path.dirname(self.path))
+            temp_path = f"{self.path}.part"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logger.error(f"Failed to save failed-video cache: {str(e)}")
+
+    @staticmethod
+    def classify(message):
+        lowered = message.lower()
+        if any(marker in lowered for marker in UNAVAILABLE_ERROR_MARKERS):
+            return 'unavailable'
+        return 'failed'
+
+    def record(self, video_id, message):
+        """Remember a failure and return its cache entry, None for an invalid video_id"""
+        if not is_valid_video_id(video_id):
+            return None
+        reason = self.classify(message)
+        with self._lock:
+            self._ensure_loaded()
+            failures = self._entries.get(video_id, {}).get('failures', 0) + 1
+            if reason == 'unavailable':
+                ttl = FAILED_VIDEO_UNAVAILABLE_TTL
+            else:
+                ttl = min(FAILED_VIDEO_BASE_TTL * (2 ** (failures - 1)), FAILED_VIDEO_MAX_TTL)
+            entry = {
+                'reason': reason,
+                'message': message[:500],
+                'failures': failures,
+                'failed_at': int(time.time()),
+                'expires_at': int(time.time() + ttl)
+            }
+            self._entries[video_id] = entry
+            self._save()
+        logger.warning(f"Caching failure for {video_id} ({reason}) for {ttl}s")
+        return entry
+
+    def get(self, video_id):
+        """Get the active failure entry for video_id, or None once it expired"""
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._entries.get(video_id)
+            if entry is None or entry['expires_at'] <= time.time():
+                return None
+            return dict(entry)
+
+    def clear(self, video_id):
+        with self._lock:
+            self._ensure_loaded()
+            if self._entries.pop(video_id, None) is not None:
+                self._save()
+
+    def check(self, video_id):
+        """Raise VideoUnavailableError if video_id failed recently"""
+        entry = self.get(video_id)
+        if entry:
+            raise VideoUnavailableError(video_id, entry)
+
+
+failed_video_cache = FailedVideoCache(FAILED_VIDEO_FILE)
+
+
+def apply_failed_video_policy(videos_info, policy):
+    """Flag ('flag') or drop ('omit') playlist items that are in the failed-video cache"""
+    if policy not in ('flag', 'omit'):
+        return videos_info
+
+    result = []
+    for video_info in videos_info:
+        entry = failed_video_cache.get(video_info.get("video_id"))
+        if entry is None:
+            result.append(video_info)
+        elif policy == 'flag':
+            flagged = dict(video_info)
+            flagged["is_unavailable"] = True
+            flagged["unavailable_reason"] = entry['reason']
+            result.append(flagged)
+    return result
+
+
+def build_unavailable_response(error):
+    """Build the 404 response for a VideoUnavailableError"""
+    return jsonify({
+        'error': 'Video unavailable',
+        'message': str(error),
+        'reason': error.reason,
+        'retry_after': error.retry_after,
+        'video_id': error.video_id
+    }), 404
+
+
+def get_video_download_lock(video_id):
+    """Get the lock that serializes downloads of one video_id"""
+    with _video_download_locks_lock:
+        lock = _video_download_locks.get(video_id)
+        if lock is None:
+            lock = threading.Lock()
+            _video_download_locks[video_id] = lock
+        return lock
+
+
+def download_and_cache_video_v3(video_id, device, priority=PRIORITY_INTERACTIVE, deadline=None, backend='yt-dlp'):
+    """
+    Copy a video from a peer or download it with backend (yt-dlp, or pytubefix for v2),
+    then cache its metadata
+    Concurrent calls for the same video_id share a single download
+    Returns the device-independent video-info payload
+    Raises DeadlineExceeded if it cannot finish before deadline,
+    Exception if every download strategy fails
+    """
+    # Known-bad videos fail before any network work
+    failed_video_cache.check(video_id)
+
+    download_lock = get_video_download_lock(video_id)
+    with acquire_before_deadline(download_lock, deadline, video_id):
+        # Another request may have finished this download while we waited, or the file
+        # is already cached but not yet in memory or the index (e.g. after a restart)
+        if is_audio_cached(video_id):
+            memory_video_info = get_video_info_from_memory(video_id)
+            if memory_video_info:
+                return memory_video_info
+            cached_meta_data = load_cached_video_metadata(video_id) or get_flat_video_metadata(video_id) or {}
+            video_info = {
+                "video_title": cached_meta_data.get("video_title", ""),
+                "video_thumbnail_url": cached_meta_data.get("video_thumbnail_url", ""),
+                "video_id": video_id,
+                "video_url": f"https://youtube.com/watch?v={video_id}",
+                "video_duration": str(cached_meta_data.get("video_duration", "0"))
+            }
+            if cache_index.get_video(video_id) is None:
+                cache_index.add_video(
+                    video_id,
+                    find_cached_mp3_file(video_id),
+                    title=video_info["video_title"],
+                    duration=video_info["video_duration"],
+                    backend=cached_meta_data.get("backend", "unknown")
+                )
+            put_video_info_in_memory(video_id, video_info)
+            return dict(video_info)
+        # ...or failed it
+        failed_video_cache.check(video_id)
+
+        youtube_url = f"https://youtube.com/watch?v={video_id}"
+
+        # Copy from a peer if one has it, otherwise download with a fair per-device slot
+        peer_result = None
+        if PEER_SERVERS:
+            with trace_span('peer.fetch', video_id=video_id) as span:
+                peer_result = fetch_video_from_peers(video_id)
+                span['hit'] = bool(peer_result)
+        if peer_result:
+            downloaded_file, video_info_data = peer_result
+        else:
+            try:
+                with download_scheduler.slot(device, priority, deadline), download_priority_context(priority), \
+                        trace_span('download', video_id=video_id, backend=backend):
+                    if backend == 'pytubefix':
+                        downloaded_file, video_info_data = download_audio_with_pytubefix(video_id, deadline)
+                    else:
+                        downloaded_file, video_info_data = download_audio_with_ytdlp(video_id, deadline, device)
+            except DeadlineExceeded:
+                # Out of time is not a verdict on the video, don't cache it as failed
+                raise
+            except Exception as e:
+                failed_video_cache.record(video_id, str(e))
+                raise
+            failed_video_cache.clear(video_id)
+
+        # Extract video information
+        video_title = video_info_data.get('title', 'Unknown')
+        video_duration = video_info_data.get('duration', 0)
+        video_thumbnail_url = video_info_data.get('thumbnail', '')
+
+        # Prepare metadata for caching
+        metadata = {
+            "video_title": video_title,
+            "video_thumbnail_url": video_thumbnail_url,
+            "video_id": video_id,
+            "video_url": youtube_url,
+            "video_duration": video_duration,
+            "mp3_url": downloaded_file,
+            "backend": "peer" if peer_result else backend,
+            "audio_format": video_info_data.get('audio_format') or describe_audio_format(video_info_data)
+        }
+
+        # Save metadata to cache
+        save_video_metadata_cache(video_id, video_title, metadata)
+
+        video_info = {
+            "video_title": video_title,
+            "video_thumbnail_url": video_thumbnail_url,
+            "video_id": video_id,
+            "video_url": youtube_url,
+            "video_duration": str(video_duration)
+        }
+        put_video_info_in_memory(video_id, video_info)
+
+        if HLS_ENABLED:
+            hls_packager.package_in_background(video_id)
+        return dict(video_info)
+
+
+class ReadAheadManager:
+    """
+    Keep the next tracks of each device's play order downloaded in the background
+    A new cursor replaces the previous targets, so work for skipped tracks is
+    dropped before it starts (a download already running is left to finish)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._workers = {}
+
+    def update(self, device, video_ids, cursor, count=READ_AHEAD_TRACKS):
+        """Set the play order and cursor for a device. Returns the target video_ids"""
+        targets = [video_id for video_id in video_ids[cursor + 1:cursor + 1 + count] if video_id]
+        with self._lock:
+            self._sessions[device] = {'targets': targets, 'attempted': set(), 'request_id': get_request_id()}
+            worker = self._workers.get(device)
+            if worker is None or not worker.is_alive():
+                worker = threading.Thread(target=self._run, args=(device,), daemon=True)
+                self._workers[device] = worker
+                worker.start()
+        return targets
+
+    def cancel(self, device):
+        with self._lock:
+            return self._sessions.pop(device, None) is not None
+
+    def _next_target(self, device):
+        while True:
+            with self._lock:
+                session = self._sessions.get(device)
+                video_id = None
+                if session is not None:
+                    video_id = next((target for target in session['targets']
+                                     if target not in session['attempted']), None)
+                if video_id is None:
+                    # Nothing left to do, let update() start a fresh worker next time
+                    self._workers.pop(device, None)
+                    return None, None
+                session['attempted'].add(video_id)
+                request_id = session['request_id']
+            # Look at the files, not the index: it is flushed lazily and lags behind after a restart
+            if not is_audio_cached(video_id):
+                return video_id, request_id
+
+    def _run(self, device):
+        while True:
+            video_id, request_id = self._next_target(device)
+            if video_id is None:
+                return
+            # Traced under the /v3/readahead request that asked for it
+            with request_id_context(request_id):
+                try:
+                    logger.info(f"Read-ahead for {device}: {video_id}")
+                    with trace_span('readahead.download', video_id=video_id, device=device):
+                        download_and_cache_video_v3(video_id, device, PRIORITY_BACKGROUND)
+                except Exception as e:
+                    logger.warning(f"Read-ahead failed for {video_id}: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {device: list(session['targets']) for device, session in self._sessions.items()}
+
+
+read_ahead_manager = ReadAheadManager()
+
+
+class VideoJobManager:
+    """
+    Run slow video downloads as background jobs that clients poll
+    There is at most one pending job per video_id; finished jobs expire after JOB_TTL
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._pending_by_video = {}
+
+    def _expire(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job['finished_at'] and now - job['finished_at'] > JOB_TTL:
+                del self._jobs[job_id]
+
+    def submit(self, video_id, device, priority=PRIORITY_INTERACTIVE, deadline=None):
+        """Start (or join) the download job for video_id. Returns the job dict"""
+        with self._lock:
+            self._expire()
+            job_id = self._pending_by_video.get(video_id)
+            if job_id:
+                return self._jobs[job_id]
+
+            job = {
+                'job_id': uuid.uuid4().hex,
+                'video_id': video_id,
+                'device': device,
+                'status': 'pending',
+                'result': None,
+                'error': None,
+                'created_at': time.time(),
+                'finished_at': None,
+                'done': threading.Event()
+            }
+            self._jobs[job['job_id']] = job
+            self._pending_by_video[video_id] = job['job_id']
+
+        # The job keeps the request id (and span) of the request that started it
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self._run, job, priority, deadline),
+            daemon=True
+        ).start()
+        return job
+
+    def _run(self, job, priority, deadline):
+        try:
+            result = download_and_cache_video_v3(job['video_id'], job['device'], priority, deadline)
+            status, error = 'done', None
+        except Exception as e:
+            logger.error(f"Video job {job['job_id']} failed for {job['video_id']}: {str(e)}")
+            result, status, error = None, 'failed', str(e)
+
+        with self._lock:
+            job['result'] = result
+            job['error'] = error
+            job['status'] = status
+            job['finished_at'] = time.time()
+            self._pending_by_video.pop(job['video_id'], None)
+        job['done'].set()
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'jobs': len(self._jobs),
+                'pending': len(self._pending_by_video)
+            }
+
+
+video_job_manager = VideoJobManager()
+
+
+def build_job_response(job, device):
+    """Build the JSON body and status code describing a video job"""
+    body = {
+        'job_id': job['job_id'],
+        'video_id': job['video_id'],
+        'status': job['status'],
+        'status_url': f"/v3/jobs/{job['job_id']}?device={device}",
+        'progress_url': f"/v3/progress/{job['video_id']}"
+    }
+    if job['status'] == 'done':
+        video_info = dict(job['result'])
+        video_info["video_thumbnail_url"] = build_thumbnail_url(job['video_id'], video_info["video_thumbnail_url"])
+        video_info["mp3_url"] = f"/v3/mp3/{job['video_id']}?device={device}"
+        if HLS_ENABLED:
+            video_info["hls_url"] = build_hls_url(job['video_id'])
+        video_info["is_loaded_from_cache"] = False
+        body['video_info'] = video_info
+        return body, 200
+    if job['status'] == 'failed':
+        body['error'] = 'Download failed'
+        body['message'] = f"Failed to download video {job['video_id']}: {job['error']}"
+        return body, 500
+    return body, 202
+
+
+def _parse_response_byte_range(response, file_size):
+    """Get (offset, length) of the bytes a send_file response is going to send"""
+    content_range = response.headers.get('Content-Range')
+    if response.status_code == 206 and content_range:
+        # Format: bytes <start>-<end>/<size>
+        start, end = content_range.split(' ', 1)[1].split('/', 1)[0].split('-')
+        return int(start), int(end) - int(start) + 1
+    return 0, file_size
+
+
+def get_sendfile_socket():
+    """
+    Client socket os.sendfile can write to, or None
+    TLS sockets are excluded: sendfile would bypass the encryption layer
+    """
+    sock = request.environ.get('werkzeug.socket')
+    if sock is None or isinstance(sock, ssl.SSLSocket) or not hasattr(os, 'sendfile'):
+        return None
+    return sock
+
+
+def _sendfile_body(file_path, sock, offset, length):
+    """Response body that writes the file with os.sendfile once headers are out"""
+    # The empty chunk makes the server flush the status line and headers
+    yield b''
+    with open(file_path, 'rb') as f:
+        remaining = length
+        try:
+            while remaining > 0:
+                sent = os.sendfile(sock.fileno(), f.fileno(), offset, min(remaining, SENDFILE_CHUNK_SIZE))
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+        except (AttributeError, OSError, ValueError) as e:
+            if isinstance(e, (BrokenPipeError, ConnectionResetError)):
+                return
+            # e.g. a socket type the kernel cannot sendfile to: finish with regular writes
+            logger.warning(f"os.sendfile unavailable, copying instead: {str(e)}")
+            f.seek(offset)
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                sock.sendall(chunk)
+                remaining -= len(chunk)
+
+
+# MPEG audio frame header tables, indexed by the header's bitrate and sample rate fields
+MPEG1_LAYER3_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0]
+MPEG2_LAYER3_BITRATES = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0]
+MPEG_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def _parse_mp3_frame_header(header):
+    """Get (frame_length, frame_seconds) of an MPEG Layer III frame header, None if it is not one"""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03  # 3 = MPEG1, 2 = MPEG2, 0 = MPEG2.5
+    layer = (header[1] >> 1) & 0x03  # 1 = Layer III
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer != 1 or sample_rate_index == 3:
+        return None
+
+    bitrates = MPEG1_LAYER3_BITRATES if version == 3 else MPEG2_LAYER3_BITRATES
+    bitrate = bitrates[bitrate_index] * 1000
+    if bitrate == 0:
+        return None
+    sample_rate = MPEG_SAMPLE_RATES[version][sample_rate_index]
+    samples = 1152 if version == 3 else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples / sample_rate
+
+
+def find_mp3_frame_offset(file_path, start_seconds):
+    """
+    Byte offset of the first MP3 frame at or after start_seconds
+    Walks the frame headers, so it is exact for VBR files too
+    Returns None if the file is not MPEG Layer III audio (e.g. m4a/webm saved as .mp3)
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        offset = 0
+        header = f.read(10)
+        if header[:3] == b'ID3':
+            # Skip the ID3v2 tag: syncsafe size, plus a 10 byte footer when flagged
+            tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+            offset = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+
+        position = 0.0
+        frames = 0
+        while offset < file_size:
+            f.seek(offset)
+            frame = _parse_mp3_frame_header(f.read(4))
+            if frame is None:
+                # Garbage before the first two frames means this is not an MP3 at all
+                return None if frames < 2 else offset
+            if position >= start_seconds:
+                return offset
+            frame_length, frame_seconds = frame
+            offset += frame_length
+            position += frame_seconds
+            frames += 1
+        return file_size
+
+
+def _file_body(file_path, offset, length):
+    """Response body streaming length bytes of the file from offset"""
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+_offset_transcode_slots = threading.BoundedSemaphore(MP3_START_MAX_TRANSCODES)
+
+
+def _ffmpeg_from_offset(file_path, start_seconds, container, output_args, span_name, action):
+    """
+    Write the file from start_seconds into a temp file with ffmpeg, so the response has a length
+    -ss comes before -i: ffmpeg seeks the input instead of decoding up to start_seconds
+    Returns the temp file path (the caller deletes it), raises Exception if ffmpeg fails
+    """
+    temp_fd, temp_path = tempfile.mkstemp(prefix='.offset_', suffix=f'.{container}', dir=os.path.dirname(file_path))
+    os.close(temp_fd)
+    try:
+        with trace_span(span_name, start_seconds=start_seconds):
+            subprocess.run([
+                'ffmpeg', '-y', '-loglevel', 'error',
+                '-ss', f"{start_seconds:.3f}", '-i', file_path,
+                '-vn', *output_args, '-f', container, temp_path
+            ], check=True, capture_output=True, timeout=MP3_START_TRANSCODE_TIMEOUT)
+    except subprocess.CalledProcessError as e:
+        os.remove(temp_path)
+        error_output = e.stderr.decode('utf-8', errors='replace').strip()
+        raise Exception(f"ffmpeg failed to {action} {os.path.basename(file_path)}: {error_output[:300]}")
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def copy_from_offset(file_path, start_seconds, container):
+    """
+    Cut the file at start_seconds keeping its audio stream as-is (no decode/encode)
+    Audio packets are all keyframes, so the cut lands within one packet of start_seconds
+    """
+    output_args = ['-c:a', 'copy']
+    if container == 'mp4':
+        # Players can start before the whole file arrived
+        output_args += ['-movflags', '+faststart']
+    return _ffmpeg_from_offset(file_path, start_seconds, container, output_args,
+                               'mp3.copy_offset', 'stream copy')
+
+
+def transcode_from_offset(file_path, start_seconds):
+    """Re-encode the file to MP3 from start_seconds"""
+    return _ffmpeg_from_offset(file_path, start_seconds, 'mp3',
+                               ['-c:a', 'libmp3lame', '-b:a', MP3_START_TRANSCODE_BITRATE],
+                               'mp3.transcode_offset', 're-encode')
+
+
+def build_mp3_offset_response(cached_mp3_file, start_seconds):
+    """
+    Build the response delivering a cached track from start_seconds
+    Real MP3 files are cut at a frame boundary and sent as-is, MP4/WebM/Ogg files are cut with an
+    ffmpeg stream copy, anything else (or a failed copy) is re-encoded to MP3
+    (at most MP3_START_MAX_TRANSCODES re-encodes at once, 503 beyond that)
+    """
+    filename = os.path.basename(cached_mp3_file)
+    headers = {
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}",
+        'X-Audio-Start': f"{start_seconds:g}"
+    }
+
+    offset = find_mp3_frame_offset(cached_mp3_file, start_seconds)
+    if offset is None:
+        temp_path = None
+        mimetype = get_audio_mimetype(cached_mp3_file)
+        container = MP3_START_COPY_FORMATS.get(mimetype)
+        if container:
+            # Only demuxes and remuxes, cheap enough to skip the re-encode cap
+            try:
+                temp_path = copy_from_offset(cached_mp3_file, start_seconds, container)
+            except Exception as e:
+                logger.warning(f"Stream copy of {filename} from {start_seconds:g}s failed, re-encoding: {str(e)}")
+
+        if temp_path is None:
+            mimetype = 'audio/mpeg'
+            # ffmpeg is CPU-heavy on the small hosts this runs on, so cap the re-encodes
+            if not _offset_transcode_slots.acquire(blocking=False):
+                response = jsonify({
+                    'error': 'Too many re-encodes',
+                    'message': f'{MP3_START_MAX_TRANSCODES} tracks are already being re-encoded for ?start=, retry shortly'
+                })
+                response.status_code = 503
+                response.headers['Retry-After'] = '2'
+                return response
+            try:
+                logger.info(f"Re-encoding {filename} from {start_seconds:g}s, it cannot be cut as-is")
+                temp_path = transcode_from_offset(cached_mp3_file, start_seconds)
+            finally:
+                _offset_transcode_slots.release()
+        length = os.path.getsize(temp_path)
+        headers['Content-Length'] = str(length)
+        # No direct_passthrough: werkzeug only calls close (and call_on_close) on wrapped bodies
+        response = Response(_file_body(temp_path, 0, length), mimetype=mimetype, headers=headers)
+        # Runs once the response is done, even if the client disconnected or never read the body
+        response.call_on_close(lambda: os.path.exists(temp_path) and os.remove(temp_path))
+        return response
+
+    length = os.path.getsize(cached_mp3_file) - offset
+    headers['Content-Length'] = str(length)
+    sock = get_sendfile_socket()
+    if MP3_DELIVERY_MODE == 'sendfile' and sock is not None:
+        body = _sendfile_body(cached_mp3_file, sock, offset, length)
+    else:
+        body = _file_body(cached_mp3_file, offset, length)
+    response = Response(body, mimetype='audio/mpeg', headers=headers)
+    response.direct_passthrough = True
+    return response
+
+
+def build_mp3_response(cached_mp3_file):
+    """Build the response delivering a cached MP3 according to MP3_DELIVERY_MODE"""
+    filename = os.path.basename(cached_mp3_file)
+    mimetype = get_audio_mimetype(cached_mp3_file)
+
+    if MP3_DELIVERY_MODE in ('x-accel', 'x-sendfile'):
+        response = Response(status=200, mimetype=mimetype)
+        if MP3_DELIVERY_MODE == 'x-accel':
+            response.headers['X-Accel-Redirect'] = f"{MP3_X_ACCEL_PREFIX}{quote(filename)}"
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(cached_mp3_file)
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+        return response
+
+    response = send_file(
+        cached_mp3_file,
+        as_attachment=True,
+        download_name=filename,
+        mimetype=mimetype
+    )
+
+    sock = get_sendfile_socket()
+    if (MP3_DELIVERY_MODE == 'sendfile' and sock is not None
+            and request.method == 'GET' and response.status_code in (200, 206)):
+        offset, length = _parse_response_byte_range(response, os.path.getsize(cached_mp3_file))
+        response.response.close()
+        response.response = _sendfile_body(cached_mp3_file, sock, offset, length)
+        response.direct_passthrough = True
+
+    return response
+
+
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+@app.before_request
+def start_request_trace():
+    """Adopt the client's request id (or make one) and open the request's root span"""
+    request_id = request.headers.get(REQUEST_ID_HEADER, '')
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex[:16]
+    g.request_id_token = _current_request_id.set(request_id)
+    g.request_span = start_span('http.request', method=request.method, path=request.path, endpoint=request.endpoint)
+
+
+@app.after_request
+def echo_request_id(response):
+    """Echo the request id and close the root span with the response status"""
+    response.headers[REQUEST_ID_HEADER] = get_request_id() or ''
+    span = g.pop('request_span', None)
+    if span:
+        span['attributes']['status_code'] = response.status_code
+        finish_span(span)
+    return response
+
+
+@app.teardown_request
+def end_request_trace(error=None):
+    """Close the root span if the request failed before after_request, then forget the id"""
+    span = g.pop('request_span', None)
+    if span:
+        finish_span(span, error or 'Request failed')
+    token = g.pop('request_id_token', None)
+    if token:
+        _current_request_id.reset(token)
+
+
+class ProfileStore:
+    """Keep the latest PROFILING_MAX_PROFILES request profiles in memory"""
+
+    def __init__(self, max_profiles):
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+        self._profiles = OrderedDict()
+
+    def add(self, profile):
+        with self._lock:
+            self._profiles[profile['profile_id']] = profile
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+
+    def get(self, profile_id):
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    def list(self):
+        with self._lock:
+            return [
+                {key: value for key, value in profile.items() if key not in ('stats', 'summary', 'allocations')}
+                for profile in reversed(self._profiles.values())
+            ]
+
+    def clear(self):
+        with self._lock:
+            count = len(self._profiles)
+            self._profiles.clear()
+            return count
+
+
+profile_store = ProfileStore(PROFILING_MAX_PROFILES)
+_request_profiling_lock = threading.Lock()
+_allocation_tracing_lock = threading.Lock()
+
+
+def is_profiling_authorized():
+    """Whether this request may start or read profiles"""
+    if PROFILING_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Profile-Token', ''), PROFILING_TOKEN)
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+def build_profiling_forbidden_response():
+    return jsonify({
+        'error': 'Forbidden',
+        'message': 'Profiling requires a valid X-Profile-Token header'
+    }), 403
+
+
+def summarize_allocations(snapshot):
+    """Top allocation sites of a tracemalloc snapshot, without tracemalloc's own frames"""
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+    ])
+    return [
+        {
+            'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            'size_kb': round(stat.size / 1024, 1),
+            'count': stat.count
+        }
+        for stat in snapshot.statistics('lineno')[:PROFILING_TOP_ENTRIES]
+    ]
+
+
+@app.before_request
+def start_request_profile():
+    """Profile this request when asked to (authorized) or picked by sampling"""
+    if not PROFILING_ENABLED or request.path.startswith('/v3/admin/profiles'):
+        return
+    requested = request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'
+    if requested and not is_profiling_authorized():
+        requested = False
+    sampled = not requested and PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE
+    if not requested and not sampled:
+        return
+
+    # Only one profiler may be active per process (enable() raises otherwise on Python 3.12+),
+    # so a request arriving while another one is profiled simply runs unprofiled
+    if not _request_profiling_lock.acquire(blocking=False):
+        logger.debug(f"Skipping profile of {request.path}, another request is being profiled")
+        return
+
+    # tracemalloc is process-wide, so only one request traces allocations at a time
+    trace_allocations = PROFILING_TRACE_ALLOCATIONS and not tracemalloc.is_tracing() \
+        and _allocation_tracing_lock.acquire(blocking=False)
+    if trace_allocations:
+        tracemalloc.start()
+
+    profiler = cProfile.Profile()
+    g.profile = {
+        'profiler': profiler,
+        'sampled': sampled,
+        'trace_allocations': trace_allocations,
+        'started_at': time.time()
+    }
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiler (e.g. an external tool) already owns the process
+        logger.warning(f"Could not profile {request.path}: {str(e)}")
+        g.pop('profile')
+        if trace_allocations:
+            tracemalloc.stop()
+            _allocation_tracing_lock.release()
+        _request_profiling_lock.release()
+
+
+def finish_request_profile(status_code=None):
+    """Stop the profiler of this request, store the profile and return its id"""
+    active = g.pop('profile', None)
+    if active is None:
+        return None
+    try:
+        active['profiler'].disable()
+    finally:
+        _request_profiling_lock.release()
+    duration = time.time() - active['started_at']
+
+    allocations, memory_peak_kb = None, None
+    if active['trace_allocations']:
+        try:
+            memory_peak_kb = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+            allocations = summarize_allocations(tracemalloc.take_snapshot())
+        finally:
+            tracemalloc.stop()
+            _allocation_tracing_lock.release()
+
+    summary = io.StringIO()
+    stats = pstats.Stats(active['profiler'], stream=summary)
+    stats.sort_stats('cumulative').print_stats(PROFILING_TOP_ENTRIES)
+
+    profile_id = uuid.uuid4().hex
+    profile_store.add({
+        'profile_id': profile_id,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status_code': status_code,
+        'sampled': active['sampled'],
+        'created_at': active['started_at'],
+        'duration_ms': round(duration * 1000, 1),
+        'memory_peak_kb': memory_peak_kb,
+        'stats': marshal.dumps(stats.stats),
+        'summary': summary.getvalue(),
+        'allocations': allocations
+    })
+    logger.info(f"Stored profile {profile_id} for {request.method} {request.path} ({duration * 1000:.0f} ms)")
+    return profile_id
+
+
+@app.after_request
+def store_request_profile(response):
+    """Finish a profiled request and tell the caller where to find its profile"""
+    if 'profile' in g:
+        profile_id = finish_request_profile(response.status_code)
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+@app.teardown_request
+def discard_request_profile(error=None):
+    """Never leave a profiler running when a request ended with an unhandled error"""
+    if 'profile' in g:
+        finish_request_profile(500)
+
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint"""
+    return jsonify({
+        'status': 'healthy',
+        'service': 'YouTube Downloader API',
+        'cache_directory': folder_path,
+        'directory_exists': os.path.exists(folder_path),
+        'downloads': download_scheduler.stats(),
+        'read_ahead': read_ahead_manager.stats(),
+        'video_jobs': video_job_manager.stats(),
+        'extraction': extraction_pool.stats(),
+        'storage': cache_storage.stats(),
+        'session': extraction_session.stats(),
+        'traffic': traffic_shaper.stats()
+    })
+
+
+@app.route('/', methods=['GET'])
+def api_info():
+    """API information endpoint"""
+    return jsonify({
+        'service': 'YouTube Downloader API',
+        'version': '2.0.0',
+        'endpoints': {
+            'GET /': 'API information',
+            'GET /health': 'Health check',
+            'GET /v2/playlist?url=<playlist_url>&device=<device_id>&unavailable=<flag|omit>': (
+                'Get simplified playlist info with smart caching (using pytubefix). '
+                'unavailable flags or omits videos that failed recently'
+            ),
+            'GET /v2/video/<video_id>?device=<device_id>&priority=<interactive|background>': (
+                'Get video information with mp3_url if cached (using pytubefix)'
+            ),
+            'GET /v2/mp3/<video_id>?device=<device_id>': (
+                'Serve cached MP3 file directly'
+            ),
+            'GET /v3/playlist?url=<playlist_url>&device=<device_id>&unavailable=<flag|omit>': (
+                'Get simplified playlist info with smart caching (using yt-dlp). '
+                'unavailable flags or omits videos that failed recently'
+            ),
+            'GET /v3/video/<video_id>?device=<device_id>&priority=<interactive|background>&mode=async': (
+                'Get video information with mp3_url if cached (using yt-dlp). '
+                'mode=async answers 202 with a job instead of blocking on the download. '
+                'An X-Request-Deadline header (seconds) caps how long the download may take'
+            ),
+            'GET /v3/jobs/<job_id>?device=<device_id>&wait=<seconds>': (
+                'Poll (or long-poll) a video job started with mode=async'
+            ),
+            'GET /v3/mp3/<video_id>?device=<device_id>&start=<seconds>': (
+                'Serve cached MP3 file directly. start (optional) begins the audio at that offset, '
+                'cut at an MP3 frame boundary or re-encoded with ffmpeg for other formats'
+            ),
+            'GET /v3/progress': 'Server-Sent Events stream of progress for every download',
+            'GET /v3/progress/<video_id>': 'Server-Sent Events stream of progress for one download',
+            'POST /v3/readahead': (
+                'Keep the next tracks of a play order downloaded (JSON: device, video_ids, cursor, count)'
+            ),
+            'DELETE /v3/readahead?device=<device_id>': 'Cancel read-ahead for a device',
+            'GET /v3/thumb/<video_id>': (
+                'Serve a resized, cached thumbnail'
+            ),
+            'GET /v3/peer/<video_id>': (
+                'Cached metadata for peer servers (never downloads)'
+            ),
+            'GET /v3/cache?page=<n>&page_size=<n>&sort=<field>&playlist_id=<playlist_id>': (
+                'List cached videos with totals by playlist and disk use (X-Admin-Token header)'
+            ),
+            'DELETE /v3/cache/<video_id>': 'Delete one cached video (X-Admin-Token header)',
+            'DELETE /v3/cache?playlist_id=<playlist_id>': (
+                'Delete every cached video of a playlist (X-Admin-Token header)'
+            ),
+            'POST /v3/cache/reindex': (
+                'Rebuild the cache index from the download folder (X-Admin-Token header)'
+            ),
+            'GET /v3/cache/export?playlist_id=<playlist_id>': (
+                'Stream the cache (optionally one playlist) as a tar bundle (X-Admin-Token header)'
+            ),
+            'POST /v3/cache/import': (
+                'Import a tar bundle produced by /v3/cache/export (X-Admin-Token header)'
+            ),
+            'GET /v3/hls/<video_id>/index.m3u8': (
+                'HLS playlist of a cached video (when HLS_ENABLED), segments are served next to it'
+            ),
+            'GET /v3/admin/profiles': (
+                'List request profiles (any request with ?profile=1 when PROFILING_ENABLED)'
+            ),
+            'GET /v3/admin/profiles/<profile_id>?format=<json|pstats>': (
+                'Get a CPU/allocation profile summary, or the raw pstats file'
+            ),
+            'DELETE /v3/admin/profiles': 'Delete stored profiles'
+        },
+        'cache_directory': folder_path,
+        'tokens_directory': './tokens'
+    })
+
+
+# ================= V2 API ENDPOINTS =================
+
+@app.route('/v2/playlist', methods=['GET'])
+def get_playlist_videos_v2():
+    """
+    V2: Get videos from a YouTube playlist with device-specific tokens
+    Expected query parameters: url (YouTube playlist URL), device (device identifier),
+    unavailable (optional: flag or omit recently failed videos)
+    Returns: JSON array with simplified video information and caching
+    """
+    try:
+        playlist_url = request.args.get('url')
+        device = request.args.get('device')
+        unavailable_policy = request.args.get('unavailable')
+        
+        if not playlist_url:
+            return jsonify({
+                'error': 'Missing required parameter: url',
+                'message': 'Please provide a YouTube playlist URL'
+            }), 400
+            
+        if not device:
+            return jsonify({
+                'error': 'Missing required parameter: device',
+                'message': 'Please provide a device identifier'
+            }), 400
+
+        # Extract playlist ID for caching
+        playlist_id = extract_playlist_id(playlist_url)
+        if not playlist_id:
+            return jsonify({
+                'error': 'Invalid playlist URL',
+                'message': 'Could not extract playlist ID from URL'
+            }), 400
+
+        # Ensure cache directory exists
+        if not ensure_directory_exists(folder_path):
+            logger.warning(f"Could not create cache directory: {folder_path}")
+
+        logger.info(
+            f"Processing playlist (v2): {playlist_url} for device: {device}"
+        )
+
+        try:
+            # Always try to get playlist from YouTube API first
+            playlist = Playlist(playlist_url)
+            video_urls = playlist.video_urls
+
+            if not video_urls:
+                # If no videos found, try to return cached data
+                cached_data = load_playlist_cache(playlist_id)
+                if cached_data:
+                    logger.info(
+                        f"No videos found in API, returning cached data for {playlist_id}"
+                    )
+                    return jsonify(apply_failed_video_policy(cached_data, unavailable_policy))
+                
+                return jsonify({
+                    'error': 'No videos found',
+                    'message': (
+                        'The playlist appears to be empty or inaccessible'
+                    )
+                }), 404
+
+            # Build response data
+            videos_info = []
+            for video_url in video_urls:
+                video_id = video_url.split('watch?v=')[-1].split('&')[0]
+                video_info = {
+                    "video_url": video_url,
+                    "video_id": video_id
+                }
+                videos_info.append(video_info)
+
+            # Save successful results to cache
+            save_playlist_cache(playlist_id, videos_info)
+            logger.info(
+                f"Successfully processed {len(videos_info)} videos (v2)"
+            )
+
+            return jsonify(apply_failed_video_policy(videos_info, unavailable_policy))
+
+        except Exception as e:
+            logger.error(f"Error processing playlist: {str(e)}")
+            # Only if API fails, try to return cached data
+            cached_data = load_playlist_cache(playlist_id)
+            if cached_data:
+                logger.info(
+                    f"API failed, returning cached data for {playlist_id}: {str(e)}"
+                )
+                return jsonify(apply_failed_video_policy(cached_data, unavailable_policy))
+            
+            return jsonify({
+                'error': 'Failed to process playlist',
+                'message': str(e)
+            }), 500
+
+    except Exception as e:
+        logger.error(f"Error in v2 playlist endpoint: {str(e)}")
+        return jsonify({
+            'error': 'Failed to process playlist',
+            'message': str(e)
+        }), 500
+
+
+@app.route('/v3/playlist', methods=['GET'])
 def get_playlist_videos_v3():
     """
-    V3: Get videos from a YouTube playlist using yt-dlp instead of pytubefix
-    Expected query parameters: url (YouTube playlist URL), device (device identifier)
-    Returns: JSON array with simplified video information and caching
+    V3: Get videos from a YouTube playlist using yt-dlp instead of pytubefix
+    Expected query parameters: url (YouTube playlist URL), device (device identifier),
+    unavailable (optional: flag or omit recently failed videos)
+    Returns: JSON array with simplified video information and caching
+    """
+    try:
+        playlist_url = request.args.get('url')
+        device = request.args.get('device')
+        unavailable_policy = request.args.get('unavailable')
+        
+        if not playlist_url:
+            return jsonify({
+                'error': 'Missing required parameter: url',
+                'message': 'Please provide a YouTube playlist URL'
+            }), 400
+            
+        if not device:
+            return jsonify({
+                'error': 'Missing required parameter: device',
+                'message': 'Please provide a device identifier'
+            }), 400
+
+        # Extract playlist ID for caching
+        playlist_id = extract_playlist_id(playlist_url)
+        if not playlist_id:
+            return jsonify({
+                'error': 'Invalid playlist URL',
+                'message': 'Could not extract playlist ID from URL'
+            }), 400
+
+        # Ensure cache directory exists
+        if not ensure_directory_exists(folder_path):
+            logger.warning(f"Could not create cache directory: {folder_path}")
+
+        logger.info(
+            f"Processing playlist (v3): {playlist_url} for device: {device}"
+        )
+
+        try:
+            # Use yt-dlp to get playlist information
+            ydl_opts = {
+                'quiet': True,
+                'no_warnings': True,
+                'extract_flat': True,  # Don't download, just get URLs
+                'ignoreerrors': True,  # Continue on errors
+                # Handle signature extraction failures (common in HA)
+                'extractor_args': {
+                    'youtube': {
+                        'player_client': ['android', 'web'],  # Try different clients
+                    }
+                },
+                # Alternative user agent for better compatibility
+                'http_headers': {
+                    'User-Agent': YTDLP_USER_AGENT
+                }
+            }
+
+            # Reuse the warm extraction session instead of starting a cold one
+            ydl_opts['cachedir'] = YTDLP_CACHE_DIR
+
+            with extraction_session.cookie_file() as cookie_file, \
+                    yt_dlp.YoutubeDL(dict(ydl_opts, cookiefile=cookie_file)) as ydl:
+                logger.info("Extracting playlist info with yt-dlp...")
+                with trace_span('playlist.extract', playlist_id=playlist_id):
+                    info = ydl.extract_info(playlist_url, download=False)
+                
+                if not info:
+                    # If no info found, try to return cached data
+                    cached_data = load_playlist_cache(playlist_id)
+                    if cached_data:
+                        logger.info(
+                            f"No info found in API, returning cached data for {playlist_id}"
+                        )
+                        return jsonify(apply_failed_video_policy(cached_data, unavailable_policy))
+                    
+                    return jsonify({
+                        'error': 'No playlist information found',
+                        'message': 'The playlist appears to be empty or inaccessible'
+                    }), 404
+
+                # Extract video entries
+                entries = info.get('entries', [])
+                if not entries:
+                    # If no videos found, try to return cached data
+                    cached_data = load_playlist_cache(playlist_id)
+                    if cached_data:
+                        logger.info(
+                            f"No videos found in API, returning cached data for {playlist_id}"
+                        )
+                        return jsonify(apply_failed_video_policy(cached_data, unavailable_policy))
+                    
+                    return jsonify({
+                        'error': 'No videos found',
+                        'message': 'The playlist appears to be empty or inaccessible'
+                    }), 404
+
+                # Build response data
+                videos_info = []
+                for entry in entries:
+                    if entry and entry.get('id'):
+                        videos_info.append(build_flat_video_info(entry))
+
+                if not videos_info:
+                    # If no valid videos found, try to return cached data
+                    cached_data = load_playlist_cache(playlist_id)
+                    if cached_data:
+                        logger.info(
+                            f"No valid videos found in API, returning cached data for {playlist_id}"
+                        )
+                        return jsonify(apply_failed_video_policy(cached_data, unavailable_policy))
+                    
+                    return jsonify({
+                        'error': 'No valid videos found',
+                        'message': 'The playlist contains no accessible videos'
+                    }), 404
+
+                # Save successful results to cache
+                save_playlist_cache(playlist_id, videos_info)
+                remember_flat_video_metadata(videos_info)
+                logger.info(
+                    f"Successfully processed {len(videos_info)} videos (v3 yt-dlp)"
+                )
+
+                return jsonify(apply_failed_video_policy(videos_info, unavailable_policy))
+
+        except Exception as e:
+            logger.error(f"Error processing playlist with yt-dlp: {str(e)}")
+            # Only if API fails, try to return cached data
+            cached_data = load_playlist_cache(playlist_id)
+            if cached_data:
+                logger.info(
+                    f"yt-dlp API failed, returning cached data for {playlist_id}: {str(e)}"
+                )
+                return jsonify(apply_failed_video_policy(cached_data, unavailable_policy))
+            
+            return jsonify({
+                'error': 'Failed to process playlist',
+                'message': str(e)
+            }), 500
+
+    except Exception as e:
+        logger.error(f"Error in v3 playlist endpoint: {str(e)}")
+        return jsonify({
+            'error': 'Failed to process playlist',
+            'message': str(e)
+        }), 500
+
+
+@app.route('/v2/video/<video_id>', methods=['GET'])
+def get_video_info_v2(video_id):
+    """
+    V2: Get video information by video ID with device-specific tokens
+    Expected query parameter: device (device identifier)
+    Returns: JSON with video information
+    """
+    try:
+        device = request.args.get('device')
+        
+        if not device:
+            return jsonify({
+                'error': 'Missing required parameter: device',
+                'message': 'Please provide a device identifier'
+            }), 400
+
+        logger.info(f"Processing video info (v2): {video_id} for device: {device}")
+
+        # Create YouTube object with device-specific token
+        youtube_url = f"https://youtube.com/watch?v={video_id}"
+
+        # Check if MP3 file already exists in cache
+        cached_mp3_file = find_cached_mp3_file(video_id)
+        
+        if cached_mp3_file and os.path.exists(cached_mp3_file):
+            mp3_url = f"/v2/mp3/{video_id}?device={device}"
+            # Load metadata
+            cached_meta_data_path = find_cached_metadata_file(video_id)
+            cached_meta_data = load_video_metadata_cache(cached_meta_data_path)
+            if not cached_meta_data:
+                cached_meta_data = {
+                        "video_title": "",
+                        "video_thumbnail_url": "",
+                        "video_id": video_id,
+                        "video_url": youtube_url,
+                        "video_duration": "0",
+                        "mp3_url": mp3_url
+                    }
+                
+            # logger.info(f"Returning cached MP3 info (v2): {cached_meta_data.get("video_title", "")}. Metadata: {cached_meta_data}")
+                        
+            cache_index.touch(video_id)
+
+            # File exists, return info with mp3_url
+            video_info = {
+                "video_title": cached_meta_data.get("video_title", ""),
+                "video_thumbnail_url": cached_meta_data["video_thumbnail_url"],
+                "video_id": video_id,
+                "video_url": youtube_url,
+                "video_duration": cached_meta_data["video_duration"],
+                "mp3_url": mp3_url,
+                "is_loaded_from_cache": True
+            }
+            return jsonify(video_info)
+        
+        # File doesn't exist, download it
+        logger.info(f"MP3 not cached, downloading (v2): {video_id}")
+
+        # Ensure download directory exists
+        if not ensure_directory_exists(folder_path):
+            return jsonify({
+                'error': 'Directory creation failed',
+                'message': f'Could not create or access directory: {folder_path}'
+            }), 500
+
+        # Same path as v3 with the pytubefix backend: per-video lock, failure cache,
+        # fair slot, extraction worker and bandwidth shaping
+        max_retries = MAX_RETRIES
+        try:
+            video_info = download_and_cache_video_v3(
+                video_id, device, get_request_priority(), get_request_deadline(), backend='pytubefix'
+            )
+        except VideoUnavailableError as e:
+            # Known-bad videos fail fast without touching YouTube
+            return build_unavailable_response(e)
+        except DeadlineExceeded as e:
+            # Out of time is not a verdict on the video, don't cache it as failed
+            logger.warning(f"Deadline exceeded for {video_id}: {str(e)}")
+            return jsonify({
+                'error': 'Deadline exceeded',
+                'message': str(e),
+                'video_id': video_id
+            }), 504
+        except Exception as e:
+            # download_and_cache_video_v3 already recorded the failure
+            logger.warning(
+                f"failed: {str(e)}"
+            )
+            return jsonify({
+                'error': 'Download failed',
+                'message': (
+                    f'Failed to download video {video_id} '
+                    f'after {max_retries} attempts: {str(e)}'
+                ),
+                'video_id': video_id
+            }), 500
+
+        # Return video info with mp3_url
+        video_title = video_info["video_title"]
+        video_info["mp3_url"] = f"/v2/mp3/{video_id}?device={device}"
+        video_info["is_loaded_from_cache"] = False
+
+        logger.info(f"Successfully downloaded and cached (v2): {video_title}")
+        return jsonify(video_info)
+
+    except Exception as e:
+        logger.error(f"Error getting video info (v2) for {video_id}: {str(e)}")
+        return jsonify({
+            'error': 'Failed to get video information',
+            'message': str(e),
+            'video_id': video_id
+        }), 500
+
+  
+@app.route('/v3/video/<video_id>', methods=['GET'])
+def get_video_info_v3(video_id):
+    """
+    V3: Get video information by video ID with device-specific tokens using yt-dlp
+    Expected query parameter: device (device identifier)
+    Optional header: X-Request-Deadline (seconds the client will wait for the download)
+    Returns: JSON with video information, 504 if the deadline cannot be met
+    """
+    try:
+        device = request.args.get('device')
+        
+        if not device:
+            return jsonify({
+                'error': 'Missing required parameter: device',
+                'message': 'Please provide a device identifier'
+            }), 400
+
+        logger.info(f"Processing video info (v3): {video_id} for device: {device}")
+
+        # Serve repeat lookups from memory without touching the filesystem
+        memory_video_info = get_video_info_from_memory(video_id)
+        if memory_video_info:
+            cache_index.touch(video_id)
+            memory_video_info["video_thumbnail_url"] = build_thumbnail_url(
+                video_id, memory_video_info["video_thumbnail_url"]
+            )
+            memory_video_info["mp3_url"] = f"/v3/mp3/{video_id}?device={device}"
+            if HLS_ENABLED:
+                memory_video_info["hls_url"] = build_hls_url(video_id)
+            memory_video_info["is_loaded_from_cache"] = True
+            return jsonify(memory_video_info)
+
+        # Create YouTube URL
+        youtube_url = f"https://youtube.com/watch?v={video_id}"
+
+        # Ensure download directory exists
+        if not ensure_directory_exists(folder_path):
+            return jsonify({
+                'error': 'Directory creation failed',
+                'message': f'Could not create or access directory: {folder_path}'
+            }), 500
+
+        # Check if MP3 file already exists in cache (on local disk or in the storage backend)
+        if is_audio_cached(video_id):
+            mp3_url = f"/v3/mp3/{video_id}?device={device}"
+            
+            # Load metadata
+            cached_meta_data = load_cached_video_metadata(video_id)
+            
+            if not cached_meta_data:
+                # If metadata doesn't exist, use what the playlist told us or minimal metadata
+                cached_meta_data = get_flat_video_metadata(video_id) or {
+                    "video_title": "",
+                    "video_thumbnail_url": "",
+                    "video_id": video_id,
+                    "video_url": youtube_url,
+                    "video_duration": "0",
+                    "mp3_url": mp3_url
+                }
+                
+            logger.info(f"Returning cached MP3 info (v3): {cached_meta_data.get('video_title', 'Unknown')}")
+                        
+            # File exists, return info with mp3_url
+            video_info = {
+                "video_title": cached_meta_data.get("video_title", ""),
+                "video_thumbnail_url": cached_meta_data.get("video_thumbnail_url", ""),
+                "video_id": video_id,
+                "video_url": youtube_url,
+                "video_duration": str(cached_meta_data.get("video_duration", "0"))
+            }
+            put_video_info_in_memory(video_id, video_info)
+            cache_index.touch(video_id)
+
+            video_info["video_thumbnail_url"] = build_thumbnail_url(video_id, video_info["video_thumbnail_url"])
+            video_info["mp3_url"] = mp3_url
+            if HLS_ENABLED:
+                video_info["hls_url"] = build_hls_url(video_id)
+            video_info["is_loaded_from_cache"] = True
+            return jsonify(video_info)
+        
+        # Non-blocking mode: hand the download to a job and answer right away
+        if request.args.get('mode') == 'async':
+            try:
+                failed_video_cache.check(video_id)
+            except VideoUnavailableError as e:
+                return build_unavailable_response(e)
+            job = video_job_manager.submit(video_id, device, get_request_priority(), get_request_deadline())
+            logger.info(f"MP3 not cached, started job (v3): {video_id} -> {job['job_id']}")
+            body, status_code = build_job_response(job, device)
+            return jsonify(body), status_code
+
+        # File doesn't exist, download it
+        logger.info(f"MP3 not cached, downloading (v3): {video_id}")
+        
+        try:
+            video_info = download_and_cache_video_v3(
+                video_id, device, get_request_priority(), get_request_deadline()
+            )
+        except VideoUnavailableError as e:
+            logger.info(f"Skipping recently failed video (v3): {video_id}")
+            return build_unavailable_response(e)
+        except DeadlineExceeded as e:
+            logger.warning(f"Deadline exceeded for {video_id}: {str(e)}")
+            return jsonify({
+                'error': 'Deadline exceeded',
+                'message': str(e),
+                'video_id': video_id
+            }), 504
+        except Exception as e:
+            logger.error(f"Download failed for {video_id}: {str(e)}")
+            return jsonify({
+                'error': 'Download failed',
+                'message': f'Failed to download video {video_id}: {str(e)}',
+                'video_id': video_id
+            }), 500
+
+        video_title = video_info["video_title"]
+        video_info["video_thumbnail_url"] = build_thumbnail_url(video_id, video_info["video_thumbnail_url"])
+        video_info["mp3_url"] = f"/v3/mp3/{video_id}?device={device}"
+        if HLS_ENABLED:
+            video_info["hls_url"] = build_hls_url(video_id)
+        video_info["is_loaded_from_cache"] = False
+
+        logger.info(f"Successfully downloaded and cached (v3): {video_title}")
+        return jsonify(video_info)
+
+    except Exception as e:
+        logger.error(f"Error getting video info (v3) for {video_id}: {str(e)}")
+        return jsonify({
+            'error': 'Failed to get video information',
+            'message': str(e),
+            'video_id': video_id
+        }), 500
+
+
+@app.route('/v2/mp3/<video_id>', methods=['GET'])
+def serve_mp3_v2(video_id):
+    """
+    V2: Serve cached MP3 file by video_id
+    Expected query parameter: device (device identifier)
+    Returns: MP3 file or 404 if not cached
+    """
+    try:
+        device = request.args.get('device')
+        
+        if not device:
+            return jsonify({
+                'error': 'Missing required parameter: device',
+                'message': 'Please provide a device identifier'
+            }), 400
+
+        # Find cached MP3 file
+        cached_mp3_file = find_cached_mp3_file(video_id)
+        
+        if not cached_mp3_file or not os.path.exists(cached_mp3_file):
+            # The file was evicted behind our back, forget the cached entries
+            forget_cached_video(video_id)
+            return jsonify({
+                'error': 'MP3 not found',
+                'message': f'No cached MP3 file found for video {video_id}',
+                'video_id': video_id
+            }), 404
+
+        # Extract filename for download
+        filename = os.path.basename(cached_mp3_file)
+        
+        logger.info(f"Serving cached MP3 (v2): {filename}")
+        cache_index.touch(video_id, hit=False)
+        
+        return traffic_shaper.track_playback(build_mp3_response(cached_mp3_file))
+
+    except Exception as e:
+        logger.error(f"Error serving MP3 (v2) for {video_id}: {str(e)}")
+        return jsonify({
+            'error': 'Failed to serve MP3',
+            'message': str(e),
+            'video_id': video_id
+        }), 500
+        
+@app.route('/v3/mp3/<video_id>', methods=['GET'])
+def serve_mp3_v3(video_id):
+    """
+    V3: Serve cached MP3 file by video_id
+    Expected query parameters: device (device identifier),
+    start (optional, seconds into the track the audio should begin at, used to resume)
+    Returns: MP3 file or 404 if not cached
+    """
+    try:
+        device = request.args.get('device')
+        
+        if not device:
+            return jsonify({
+                'error': 'Missing required parameter: device',
+                'message': 'Please provide a device identifier'
+            }), 400
+
+        start_seconds = float(request.args.get('start', 0))
+        if not start_seconds >= 0:
+            raise ValueError(f"start must be a number of seconds >= 0, got {request.args.get('start')}")
+
+        # Find cached MP3 file, cutting at an offset needs it on local disk
+        if start_seconds > 0:
+            cached_mp3_file = cache_storage.fetch_audio(video_id)
+        else:
+            cached_mp3_file = find_cached_mp3_file(video_id)
+        
+        if not cached_mp3_file or not os.path.exists(cached_mp3_file):
+            # Only in the storage backend: stream it from there
+            remote_response = cache_storage.build_audio_response(video_id)
+            if remote_response is not None:
+                logger.info(f"Serving MP3 from {cache_storage.name} storage (v3): {video_id}")
+                return traffic_shaper.track_playback(remote_response)
+
+            # The file was evicted behind our back, forget the cached entries
+            forget_cached_video(video_id)
+            return jsonify({
+                'error': 'MP3 not found',
+                'message': f'No cached MP3 file found for video {video_id}',
+                'video_id': video_id
+            }), 404
+
+        # Extract filename for download
+        filename = os.path.basename(cached_mp3_file)
+        
+        logger.info(f"Serving cached MP3 (v2): {filename}")
+        cache_index.touch(video_id, hit=False)
+
+        if start_seconds > 0:
+            return traffic_shaper.track_playback(build_mp3_offset_response(cached_mp3_file, start_seconds))
+        return traffic_shaper.track_playback(build_mp3_response(cached_mp3_file))
+
+    except ValueError as e:
+        return jsonify({
+            'error': 'Invalid parameter',
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        logger.error(f"Error serving MP3 (v3) for {video_id}: {str(e)}")
+        return jsonify({
+            'error': 'Failed to serve MP3',
+            'message': str(e),
+            'video_id': video_id
+        }), 500
+
+
+@app.route('/v3/jobs/<job_id>', methods=['GET'])
+def get_video_job_v3(job_id):
+    """
+    V3: Get the status of a video job started with /v3/video/<id>?mode=async
+    Expected query parameters: device (device identifier),
+    wait (optional, seconds to long-poll for the job to finish)
+    Returns: 200 with video_info when done, 202 while pending, 500 if it failed
+    """
+    try:
+        device = request.args.get('device')
+
+        if not device:
+            return jsonify({
+                'error': 'Missing required parameter: device',
+                'message': 'Please provide a device identifier'
+            }), 400
+
+        job = video_job_manager.get(job_id)
+        if not job:
+            return jsonify({
+                'error': 'Job not found',
+                'message': f'No video job {job_id}. It may have expired.',
+                'job_id': job_id
+            }), 404
+
+        wait = min(max(float(request.args.get('wait', 0)), 0), JOB_MAX_WAIT)
+        if wait > 0:
+            job['done'].wait(wait)
+
+        body, status_code = build_job_response(job, device)
+        return jsonify(body), status_code
+
+    except ValueError as e:
+        return jsonify({
+            'error': 'Invalid parameter',
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        logger.error(f"Error getting video job {job_id}: {str(e)}")
+        return jsonify({
+            'error': 'Failed to get video job',
+            'message': str(e),
+            'job_id': job_id
+        }), 500
+
+
+def generate_progress_events(video_id=None):
+    """Yield Server-Sent Events for one video (or all videos) until the client disconnects"""
+    subscriber = progress_broker.subscribe(video_id)
+    try:
+        yield "retry: 2000\n\n"
+        while True:
+            try:
+                event = subscriber.get(timeout=PROGRESS_KEEPALIVE)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: {event['status']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        progress_broker.unsubscribe(subscriber, video_id)
+
+
+@app.route('/v3/progress', methods=['GET'])
+def stream_all_progress_v3():
+    """
+    V3: Server-Sent Events stream of download progress for every video
+    Events: strategy, downloading, downloaded, finished, error
+    """
+    return Response(
+        stream_with_context(generate_progress_events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/v3/progress/<video_id>', methods=['GET'])
+def stream_video_progress_v3(video_id):
+    """
+    V3: Server-Sent Events stream of download progress for one video
+    Each event carries bytes downloaded/total, speed, ETA and the current strategy
+    """
+    return Response(
+        stream_with_context(generate_progress_events(video_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/v3/readahead', methods=['POST'])
+def update_read_ahead_v3():
+    """
+    V3: Keep the next tracks of a play order downloaded in the background
+    Expected JSON body: device, video_ids (play order), cursor (index now playing),
+    count (optional, tracks to keep ready)
+    Returns: JSON with the video_ids scheduled for read-ahead, 400 for invalid video ids
     """
     try:
-        playlist_url = request.args.get('url')
-        device = request.args.get('device')
-        
-        if not playlist_url:
-            return jsonify({
-                'error': 'Missing required parameter: url',
-                'message': 'Please provide a YouTube playlist URL'
-            }), 400
-            
+        data = request.get_json(silent=True) or {}
+        device = data.get('device')
+        video_ids = data.get('video_ids')
+        cursor = data.get('cursor')
+
         if not device:
             return jsonify({
                 'error': 'Missing required parameter: device',
                 'message': 'Please provide a device identifier'
             }), 400
 
-        # Extract playlist ID for caching
-        playlist_id = extract_playlist_id(playlist_url)
-        if not playlist_id:
+        if not isinstance(video_ids, list) or not isinstance(cursor, int):
             return jsonify({
-                'error': 'Invalid playlist URL',
-                'message': 'Could not extract playlist ID from URL'
+                'error': 'Missing required parameter: video_ids/cursor',
+                'message': 'Please provide the play order (video_ids) and the cursor index'
             }), 400
 
-        # Ensure cache directory exists
-        if not ensure_directory_exists(folder_path):
-            logger.warning(f"Could not create cache directory: {folder_path}")
+        invalid_video_ids = [video_id for video_id in video_ids
+                             if not isinstance(video_id, str) or not is_valid_video_id(video_id)]
+        if invalid_video_ids:
+            return jsonify({
+                'error': 'Invalid video id',
+                'message': f'Invalid video ids in the play order: {invalid_video_ids[:10]}'
+            }), 400
 
-        logger.info(
-            f"Processing playlist (v3): {playlist_url} for device: {device}"
-        )
+        count = min(max(int(data.get('count', READ_AHEAD_TRACKS)), 0), READ_AHEAD_MAX_TRACKS)
+        targets = read_ahead_manager.update(device, video_ids, cursor, count)
 
-        try:
-            # Use yt-dlp to get playlist information
-            ydl_opts = {
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': True,  # Don't download, just get URLs
-                'ignoreerrors': True,  # Continue on errors
-                # Handle signature extraction failures (common in HA)
-                'extractor_args': {
-                    'youtube': {
-                        'player_client': ['android', 'web'],  # Try different clients
-                    }
-                },
-                # Alternative user agent for better compatibility
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-                }
-            }
+        return jsonify({
+            'device': device,
+            'cursor': cursor,
+            'scheduled': targets
+        }), 202
 
-            # Check if cookies file exists, if not, don't use it
-            cookie_file = 'cookies.txt'
-            use_cookies = os.path.exists(cookie_file)
-            if use_cookies:
-                ydl_opts['cookiefile'] = cookie_file
+    except Exception as e:
+        logger.error(f"Error in v3 read-ahead endpoint: {str(e)}")
+        return jsonify({
+            'error': 'Failed to schedule read-ahead',
+            'message': str(e)
+        }), 500
 
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                logger.info("Extracting playlist info with yt-dlp...")
-                info = ydl.extract_info(playlist_url, download=False)
-                
-                if not info:
-                    # If no info found, try to return cached data
-                    cached_data = load_playlist_cache(playlist_id)
-                    if cached_data:
-                        logger.info(
-                            f"No info found in API, returning cached data for {playlist_id}"
-                        )
-                        return jsonify(cached_data)
-                    
-                    return jsonify({
-                        'error': 'No playlist information found',
-                        'message': 'The playlist appears to be empty or inaccessible'
-                    }), 404
 
-                # Extract video entries
-                entries = info.get('entries', [])
-                if not entries:
-                    # If no videos found, try to return cached data
-                    cached_data = load_playlist_cache(playlist_id)
-                    if cached_data:
-                        logger.info(
-                            f"No videos found in API, returning cached data for {playlist_id}"
-                        )
-                        return jsonify(cached_data)
-                    
-                    return jsonify({
-                        'error': 'No videos found',
-                        'message': 'The playlist appears to be empty or inaccessible'
-                    }), 404
+@app.route('/v3/readahead', methods=['DELETE'])
+def cancel_read_ahead_v3():
+    """
+    V3: Cancel pending read-ahead work for a device
+    Expected query parameter: device (device identifier)
+    """
+    device = request.args.get('device')
+    if not device:
+        return jsonify({
+            'error': 'Missing required parameter: device',
+            'message': 'Please provide a device identifier'
+        }), 400
 
-                # Build response data
-                videos_info = []
-                for entry in entries:
-                    if entry and entry.get('id'):
-                        video_id = entry['id']
-                        video_url = f"https://youtube.com/watch?v={video_id}"
-                        video_info = {
-                            "video_url": video_url,
-                            "video_id": video_id
-                        }
-                        videos_info.append(video_info)
+    return jsonify({
+        'device': device,
+        'cancelled': read_ahead_manager.cancel(device)
+    })
 
-                if not videos_info:
-                    # If no valid videos found, try to return cached data
-                    cached_data = load_playlist_cache(playlist_id)
-                    if cached_data:
-                        logger.info(
-                            f"No valid videos found in API, returning cached data for {playlist_id}"
-                        )
-                        return jsonify(cached_data)
-                    
-                    return jsonify({
-                        'error': 'No valid videos found',
-                        'message': 'The playlist contains no accessible videos'
-                    }), 404
 
-                # Save successful results to cache
-                save_playlist_cache(playlist_id, videos_info)
-                logger.info(
-                    f"Successfully processed {len(videos_info)} videos (v3 yt-dlp)"
-                )
+@app.route('/v3/thumb/<video_id>', methods=['GET'])
+def serve_thumbnail_v3(video_id):
+    """
+    V3: Serve a resized thumbnail, fetching it from YouTube only the first time
+    Returns: JPEG image with long-lived cache headers, 400 for an invalid video id
+    """
+    if not is_valid_video_id(video_id):
+        return build_invalid_video_id_response(video_id)
 
-                return jsonify(videos_info)
+    try:
+        thumbnail_path = get_thumbnail_cache_path(video_id)
 
-        except Exception as e:
-            logger.error(f"Error processing playlist with yt-dlp: {str(e)}")
-            # Only if API fails, try to return cached data
-            cached_data = load_playlist_cache(playlist_id)
-            if cached_data:
-                logger.info(
-                    f"yt-dlp API failed, returning cached data for {playlist_id}: {str(e)}"
+        if not os.path.exists(thumbnail_path):
+            # Prefer the URL recorded at download time, fall back to the standard one
+            source_url = None
+            memory_video_info = get_video_info_from_memory(video_id)
+            if memory_video_info:
+                source_url = memory_video_info.get("video_thumbnail_url")
+            if not source_url:
+                cached_meta_data = (
+                    load_cached_video_metadata(video_id)
+                    or get_flat_video_metadata(video_id)
+                    or {}
                 )
-                return jsonify(cached_data)
-            
-            return jsonify({
-                'error': 'Failed to process playlist',
-                'message': str(e)
-            }), 500
+                source_url = cached_meta_data.get("video_thumbnail_url")
+            if not source_url:
+                source_url = f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"
+
+            try:
+                thumbnail_path = cache_thumbnail(video_id, source_url)
+            except Exception as e:
+                logger.warning(f"Failed to fetch thumbnail for {video_id}: {str(e)}")
+                return jsonify({
+                    'error': 'Thumbnail not found',
+                    'message': f'Could not fetch thumbnail for video {video_id}: {str(e)}',
+                    'video_id': video_id
+                }), 404
+
+        return send_file(
+            thumbnail_path,
+            mimetype='image/jpeg',
+            max_age=THUMBNAIL_MAX_AGE
+        )
 
     except Exception as e:
-        logger.error(f"Error in v3 playlist endpoint: {str(e)}")
+        logger.error(f"Error serving thumbnail (v3) for {video_id}: {str(e)}")
         return jsonify({
-            'error': 'Failed to process playlist',
-            'message': str(e)
+            'error': 'Failed to serve thumbnail',
+            'message': str(e),
+            'video_id': video_id
         }), 500
 
 
-@app.route('/v2/video/<video_id>', methods=['GET'])
-def get_video_info_v2(video_id):
+@app.route('/v3/hls/<video_id>/index.m3u8', methods=['GET'])
+def serve_hls_playlist_v3(video_id):
     """
-    V2: Get video information by video ID with device-specific tokens
-    Expected query parameter: device (device identifier)
-    Returns: JSON with video information
+    V3: Serve the HLS playlist of a cached video, packaging it with ffmpeg on first use
+    Segments are referenced relative to the playlist, so players start after the first
+    segment and a seek only fetches the segments it needs
+    Returns: HLS playlist, or 404 if HLS is disabled or the video is not cached
     """
-    try:
-        device = request.args.get('device')
-        
-        if not device:
-            return jsonify({
-                'error': 'Missing required parameter: device',
-                'message': 'Please provide a device identifier'
-            }), 400
+    if not HLS_ENABLED:
+        return jsonify({
+            'error': 'HLS disabled',
+            'message': 'Set HLS_ENABLED = True on the server to serve HLS'
+        }), 404
+    if not is_valid_video_id(video_id):
+        return build_invalid_video_id_response(video_id)
 
-        logger.info(f"Processing video info (v2): {video_id} for device: {device}")
+    try:
+        playlist_path = hls_packager.package(video_id)
+    except FileNotFoundError:
+        return jsonify({
+            'error': 'Audio not cached',
+            'message': f'Video {video_id} is not cached. Request /v3/video/{video_id} first',
+            'video_id': video_id
+        }), 404
+    except Exception as e:
+        logger.error(f"Error packaging HLS for {video_id}: {str(e)}")
+        return jsonify({
+            'error': 'Failed to package HLS',
+            'message': str(e),
+            'video_id': video_id
+        }), 500
 
-        # Create YouTube object with device-specific token
-        youtube_url = f"https://youtube.com/watch?v={video_id}"
+    cache_index.touch(video_id, hit=False)
+    return send_file(
+        playlist_path,
+        mimetype='application/vnd.apple.mpegurl',
+        max_age=HLS_MAX_AGE
+    )
 
-        # Check if MP3 file already exists in cache
-        cached_mp3_file = find_cached_mp3_file(video_id)
-        
-        if cached_mp3_file and os.path.exists(cached_mp3_file):
-            mp3_url = f"/v2/mp3/{video_id}?device={device}"
-            # Load metadata
-            cached_meta_data_path = find_cached_metadata_file(video_id)
-            cached_meta_data = load_video_metadata_cache(cached_meta_data_path)
-            if not cached_meta_data:
-                cached_meta_data = {
-                        "video_title": "",
-                        "video_thumbnail_url": "",
-                        "video_id": video_id,
-                        "video_url": youtube_url,
-                        "video_duration": "0",
-                        "mp3_url": mp3_url
-                    }
-                
-            # logger.info(f"Returning cached MP3 info (v2): {cached_meta_data.get("video_title", "")}. Metadata: {cached_meta_data}")
-                        
-            # File exists, return info with mp3_url
-            video_info = {
-                "video_title": cached_meta_data.get("video_title", ""),
-                "video_thumbnail_url": cached_meta_data["video_thumbnail_url"],
-                "video_id": video_id,
-                "video_url": youtube_url,
-                "video_duration": cached_meta_data["video_duration"],
-                "mp3_url": mp3_url,
-                "is_loaded_from_cache": True
-            }
-            return jsonify(video_info)
-        
-        # File doesn't exist, download it
-        logger.info(f"MP3 not cached, downloading (v2): {video_id}")
-        
-        # Create YouTube object with device-specific token
-        yt = create_youtube_object_with_retry(youtube_url, max_retries=MAX_RETRIES, device=device)
-        if not yt:
-            return jsonify({
-                'error': 'Video unavailable',
-                'message': f'Could not access video {video_id}. The video may be private, deleted, or temporarily unavailable.',
-                'video_id': video_id
-            }), 404
-        
-        # Ensure download directory exists
-        if not ensure_directory_exists(folder_path):
-            return jsonify({
-                'error': 'Directory creation failed',
-                'message': f'Could not create or access directory: {folder_path}'
-            }), 500
 
-        # Download audio stream with retry logic
-        audio_stream = None
-        max_retries = MAX_RETRIES
-        try:
-            audio_stream = yt.streams.get_audio_only()
-        except Exception as e:
-            logger.warning(
-                f"failed: {str(e)}"
-            )
-            return jsonify({
-                'error': 'Download failed',
-                'message': (
-                    f'Failed to get audio stream for video {video_id} '
-                    f'after {max_retries} attempts: {str(e)}'
-                ),
-                'video_id': video_id
-            }), 500
+@app.route('/v3/hls/<video_id>/<segment_name>', methods=['GET'])
+def serve_hls_segment_v3(video_id, segment_name):
+    """
+    V3: Serve one HLS segment listed in /v3/hls/<video_id>/index.m3u8
+    Returns: MPEG-TS segment or 404
+    """
+    if not HLS_ENABLED or not is_valid_video_id(video_id) or not HLS_SEGMENT_PATTERN.match(segment_name):
+        return jsonify({
+            'error': 'Segment not found',
+            'message': f'No HLS segment {segment_name} for video {video_id}'
+        }), 404
 
-        # Download the file with retry logic
-        sanitized_title = sanitize_filename(yt.title)
-        temp_filename = f"{sanitized_title}_{video_id}.mp4"
-        
-        downloaded_file = None
-        try:
-            downloaded_file = audio_stream.download(
-                output_path=folder_path,
-                filename=temp_filename
-            )
-        except Exception as e:
-            logger.warning(
-                f"failed: {str(e)}"
-            )
-            return jsonify({
-                'error': 'Download failed',
-                'message': (
-                    f'Failed to download video {video_id} '
-                    f'after {max_retries} attempts: {str(e)}'
-                ),
-                'video_id': video_id
-            }), 500
+    segment_path = os.path.join(hls_packager.get_folder(video_id), segment_name)
+    if not os.path.exists(segment_path):
+        return jsonify({
+            'error': 'Segment not found',
+            'message': f'No HLS segment {segment_name} for video {video_id}. Fetch the playlist first',
+            'video_id': video_id
+        }), 404
 
-        # Rename to .mp3 extension
-        mp3_filepath = downloaded_file.replace('.mp4', '.mp3')
-        if downloaded_file != mp3_filepath:
-            os.rename(downloaded_file, mp3_filepath)
+    return traffic_shaper.track_playback(send_file(
+        segment_path,
+        mimetype='video/mp2t',
+        max_age=HLS_MAX_AGE
+    ))
 
-        # Prepare metadata for caching
-        metadata = {
-            "video_title": yt.title,
-            "video_thumbnail_url": yt.thumbnail_url,
-            "video_id": video_id,
-            "video_url": youtube_url,
-            "video_duration": yt.length,
-            "mp3_url": mp3_filepath
-        }
 
-        # Save metadata to cache
-        save_video_metadata_cache(video_id, yt.title, metadata)
+@app.route('/v3/peer/<video_id>', methods=['GET'])
+def get_peer_video_info(video_id):
+    """
+    Peer lookup: return cached metadata for video_id without downloading anything
+    Returns: JSON metadata, 404 if the MP3 is not cached on this server, 400 for an invalid video id
+    """
+    if not is_valid_video_id(video_id):
+        return build_invalid_video_id_response(video_id)
 
-        # Return video info with mp3_url
-        mp3_url = f"/v2/mp3/{video_id}?device={device}"
-        video_info = {
-            "video_title": yt.title,
-            "video_thumbnail_url": yt.thumbnail_url,
-            "video_id": video_id,
-            "video_url": youtube_url,
-            "video_duration": yt.length,
-            "mp3_url": mp3_url,
-            "is_loaded_from_cache": False
-        }
+    try:
+        cached_mp3_file = find_cached_mp3_file(video_id)
+        if not cached_mp3_file or not os.path.exists(cached_mp3_file):
+            return jsonify({
+                'error': 'MP3 not found',
+                'message': f'No cached MP3 file found for video {video_id}',
+                'video_id': video_id
+            }), 404
 
-        logger.info(f"Successfully downloaded and cached (v2): {yt.title}")
-        return jsonify(video_info)
+        cached_meta_data = load_video_metadata_cache(find_cached_metadata_file(video_id)) or {}
+        return jsonify({
+            "video_title": cached_meta_data.get("video_title", ""),
+            "video_thumbnail_url": cached_meta_data.get("video_thumbnail_url", ""),
+            "video_id": video_id,
+            "video_duration": str(cached_meta_data.get("video_duration", "0")),
+            "audio_format": cached_meta_data.get("audio_format"),
+            "size": os.path.getsize(cached_mp3_file)
+        })
 
     except Exception as e:
-        logger.error(f"Error getting video info (v2) for {video_id}: {str(e)}")
+        logger.error(f"Error in peer lookup for {video_id}: {str(e)}")
         return jsonify({
-            'error': 'Failed to get video information',
+            'error': 'Failed to look up video',
             'message': str(e),
             'video_id': video_id
         }), 500
 
-  
-@app.route('/v3/video/<video_id>', methods=['GET'])
-def get_video_info_v3(video_id):
+
+# ================= CACHE ADMIN ENDPOINTS =================
+
+@app.route('/v3/cache', methods=['GET'])
+def list_cache():
     """
-    V3: Get video information by video ID with device-specific tokens using yt-dlp
-    Expected query parameter: device (device identifier)
-    Returns: JSON with video information
+    List cached videos from the cache index
+    Optional query parameters: page, page_size, sort (last_access|hits|size|created_at),
+    playlist_id (only videos of that playlist)
+    Requires the X-Admin-Token header (or localhost when no token is configured)
+    Returns: JSON page of videos plus totals by playlist and overall disk use
     """
+    if not is_admin_authorized():
+        return build_admin_forbidden_response()
+
     try:
-        device = request.args.get('device')
-        
-        if not device:
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = min(max(int(request.args.get('page_size', CACHE_PAGE_SIZE)), 1), 1000)
+        sort = request.args.get('sort', 'last_access')
+        playlist_id = request.args.get('playlist_id')
+
+        if sort not in ('last_access', 'hits', 'size', 'created_at'):
             return jsonify({
-                'error': 'Missing required parameter: device',
-                'message': 'Please provide a device identifier'
+                'error': 'Invalid sort',
+                'message': 'sort must be one of: last_access, hits, size, created_at'
             }), 400
 
-        logger.info(f"Processing video info (v3): {video_id} for device: {device}")
-
-        # Create YouTube URL
-        youtube_url = f"https://youtube.com/watch?v={video_id}"
-
-        # Ensure download directory exists
-        if not ensure_directory_exists(folder_path):
-            return jsonify({
-                'error': 'Directory creation failed',
-                'message': f'Could not create or access directory: {folder_path}'
-            }), 500
+        videos = cache_index.list_videos(playlist_id)
+        videos.sort(key=lambda entry: entry.get(sort, 0), reverse=True)
+        start = (page - 1) * page_size
 
-        # Check if MP3 file already exists in cache
-        cached_mp3_file = find_cached_mp3_file(video_id)
-        
-        if cached_mp3_file and os.path.exists(cached_mp3_file):
-            mp3_url = f"/v3/mp3/{video_id}?device={device}"
-            
-            # Load metadata
-            cached_meta_data_path = find_cached_metadata_file(video_id)
-            cached_meta_data = load_video_metadata_cache(cached_meta_data_path)
-            
-            if not cached_meta_data:
-                # If metadata doesn't exist, create minimal metadata
-                cached_meta_data = {
-                    "video_title": "",
-                    "video_thumbnail_url": "",
-                    "video_id": video_id,
-                    "video_url": youtube_url,
-                    "video_duration": "0",
-                    "mp3_url": mp3_url
-                }
-                
-            logger.info(f"Returning cached MP3 info (v3): {cached_meta_data.get('video_title', 'Unknown')}. Metadata: {cached_meta_data}")
-                        
-            # File exists, return info with mp3_url
-            video_info = {
-                "video_title": cached_meta_data.get("video_title", ""),
-                "video_thumbnail_url": cached_meta_data.get("video_thumbnail_url", ""),
-                "video_id": video_id,
-                "video_url": youtube_url,
-                "video_duration": str(cached_meta_data.get("video_duration", "0")),
-                "mp3_url": mp3_url,
-                "is_loaded_from_cache": True
-            }
-            return jsonify(video_info)
-        
-        # File doesn't exist, download it
-        logger.info(f"MP3 not cached, downloading (v3): {video_id}")
-        
-        # Download the audio file
-        try:
-            downloaded_file, video_info_data = download_audio_with_ytdlp(video_id)
-            
-        except Exception as e:
-            logger.error(f"Download failed for {video_id}: {str(e)}")
-            return jsonify({
-                'error': 'Download failed',
-                'message': f'Failed to download video {video_id}: {str(e)}',
-                'video_id': video_id
-            }), 500
+        disk = None
+        if os.path.exists(folder_path):
+            usage = shutil.disk_usage(folder_path)
+            disk = {'total': usage.total, 'used': usage.used, 'free': usage.free}
 
-        # Extract video information
-        video_title = video_info_data.get('title', 'Unknown')
-        video_duration = video_info_data.get('duration', 0)
-        video_thumbnail_url = video_info_data.get('thumbnail', '')
+        return jsonify({
+            'page': page,
+            'page_size': page_size,
+            'total_videos': len(videos),
+            'videos': videos[start:start + page_size],
+            'totals': cache_index.totals(),
+            'playlists': cache_index.playlist_totals(),
+            'disk': disk
+        })
 
-        # Prepare metadata for caching
-        metadata = {
-            "video_title": video_title,
-            "video_thumbnail_url": video_thumbnail_url,
-            "video_id": video_id,
-            "video_url": youtube_url,
-            "video_duration": video_duration,
-            "mp3_url": downloaded_file
-        }
+    except ValueError as e:
+        return jsonify({
+            'error': 'Invalid parameter',
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        logger.error(f"Error listing cache: {str(e)}")
+        return jsonify({
+            'error': 'Failed to list cache',
+            'message': str(e)
+        }), 500
 
-        # Save metadata to cache
-        save_video_metadata_cache(video_id, video_title, metadata)
 
-        # Return video info with mp3_url
-        mp3_url = f"/v3/mp3/{video_id}?device={device}"
-        video_info = {
-            "video_title": video_title,
-            "video_thumbnail_url": video_thumbnail_url,
-            "video_id": video_id,
-            "video_url": youtube_url,
-            "video_duration": str(video_duration),
-            "mp3_url": mp3_url,
-            "is_loaded_from_cache": False
-        }
+@app.route('/v3/cache/<video_id>', methods=['DELETE'])
+def delete_cache_video(video_id):
+    """
+    Delete one cached video (MP3, metadata and thumbnail)
+    Requires the X-Admin-Token header (or localhost when no token is configured)
+    Returns: JSON with the number of bytes freed, 400 for an invalid video id
+    """
+    if not is_admin_authorized():
+        return build_admin_forbidden_response()
+    if not is_valid_video_id(video_id):
+        return build_invalid_video_id_response(video_id)
 
-        logger.info(f"Successfully downloaded and cached (v3): {video_title}")
-        return jsonify(video_info)
+    try:
+        freed = delete_cached_video(video_id)
+        return jsonify({
+            'video_id': video_id,
+            'deleted_videos': 1 if freed else 0,
+            'freed_bytes': freed
+        })
 
     except Exception as e:
-        logger.error(f"Error getting video info (v3) for {video_id}: {str(e)}")
+        logger.error(f"Error deleting cached video {video_id}: {str(e)}")
         return jsonify({
-            'error': 'Failed to get video information',
+            'error': 'Failed to delete cached video',
             'message': str(e),
             'video_id': video_id
         }), 500
 
 
-@app.route('/v2/mp3/<video_id>', methods=['GET'])
-def serve_mp3_v2(video_id):
+@app.route('/v3/cache', methods=['DELETE'])
+def delete_cache_playlist():
     """
-    V2: Serve cached MP3 file by video_id
-    Expected query parameter: device (device identifier)
-    Returns: MP3 file or 404 if not cached
+    Delete every cached video of a playlist and its snapshot
+    Requires the X-Admin-Token header (or localhost when no token is configured)
+    Expected query parameter: playlist_id
+    Returns: JSON with the number of videos deleted and bytes freed
     """
+    if not is_admin_authorized():
+        return build_admin_forbidden_response()
+
     try:
-        device = request.args.get('device')
-        
-        if not device:
+        playlist_id = request.args.get('playlist_id')
+        if not playlist_id:
             return jsonify({
-                'error': 'Missing required parameter: device',
-                'message': 'Please provide a device identifier'
+                'error': 'Missing required parameter: playlist_id',
+                'message': 'Please provide a playlist identifier'
             }), 400
 
-        # Find cached MP3 file
-        cached_mp3_file = find_cached_mp3_file(video_id)
-        
-        if not cached_mp3_file or not os.path.exists(cached_mp3_file):
+        video_ids = cache_index.remove_playlist(playlist_id)
+        if video_ids is None:
             return jsonify({
-                'error': 'MP3 not found',
-                'message': f'No cached MP3 file found for video {video_id}',
-                'video_id': video_id
+                'error': 'Playlist not found',
+                'message': f'No cached playlist snapshot for {playlist_id}'
             }), 404
 
-        # Extract filename for download
-        filename = os.path.basename(cached_mp3_file)
-        
-        logger.info(f"Serving cached MP3 (v2): {filename}")
-        
-        return send_file(
-            cached_mp3_file,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='audio/mpeg'
-        )
+        deleted_videos = 0
+        freed = 0
+        for video_id in video_ids:
+            if not is_valid_video_id(video_id):
+                continue
+            video_freed = delete_cached_video(video_id)
+            if video_freed:
+                deleted_videos += 1
+                freed += video_freed
+
+        playlist_cache_path = get_playlist_cache_path(playlist_id)
+        if os.path.exists(playlist_cache_path):
+            os.remove(playlist_cache_path)
+
+        return jsonify({
+            'playlist_id': playlist_id,
+            'deleted_videos': deleted_videos,
+            'freed_bytes': freed
+        })
 
     except Exception as e:
-        logger.error(f"Error serving MP3 (v2) for {video_id}: {str(e)}")
+        logger.error(f"Error deleting cached playlist: {str(e)}")
         return jsonify({
-            'error': 'Failed to serve MP3',
-            'message': str(e),
-            'video_id': video_id
+            'error': 'Failed to delete cached playlist',
+            'message': str(e)
         }), 500
-        
-@app.route('/v3/mp3/<video_id>', methods=['GET'])
-def serve_mp3_v3(video_id):
+
+
+@app.route('/v3/cache/reindex', methods=['POST'])
+def reindex_cache():
     """
-    V3: Serve cached MP3 file by video_id
-    Expected query parameter: device (device identifier)
-    Returns: MP3 file or 404 if not cached
+    Rebuild the cache index from the download folder and drop HLS output of videos
+    that are gone. Use after files were added or removed outside the server
+    Requires the X-Admin-Token header (or localhost when no token is configured)
+    Returns: JSON cache totals
     """
+    if not is_admin_authorized():
+        return build_admin_forbidden_response()
+
     try:
-        device = request.args.get('device')
-        
-        if not device:
-            return jsonify({
-                'error': 'Missing required parameter: device',
-                'message': 'Please provide a device identifier'
-            }), 400
+        invalidate_video_info_in_memory()
+        cache_index.rebuild()
+        cache_index.flush()
+        hls_packager.prune()
+        return jsonify(cache_index.totals())
 
-        # Find cached MP3 file
-        cached_mp3_file = find_cached_mp3_file(video_id)
-        
-        if not cached_mp3_file or not os.path.exists(cached_mp3_file):
+    except Exception as e:
+        logger.error(f"Error rebuilding cache index: {str(e)}")
+        return jsonify({
+            'error': 'Failed to rebuild cache index',
+            'message': str(e)
+        }), 500
+
+
+@app.route('/v3/cache/export', methods=['GET'])
+def export_cache_bundle():
+    """
+    Stream the audio cache, metadata and playlist snapshots as a tar bundle
+    Requires the X-Admin-Token header (or localhost when no token is configured)
+    Optional query parameters: playlist_id or url (only export that playlist)
+    Returns: application/x-tar stream with manifest.json first
+    """
+    if not is_admin_authorized():
+        return build_admin_forbidden_response()
+
+    try:
+        playlist_id = request.args.get('playlist_id')
+        playlist_url = request.args.get('url')
+        if not playlist_id and playlist_url:
+            playlist_id = extract_playlist_id(playlist_url)
+            if not playlist_id:
+                return jsonify({
+                    'error': 'Invalid playlist URL',
+                    'message': 'Could not extract playlist ID from URL'
+                }), 400
+
+        if playlist_id and load_playlist_cache(playlist_id) is None:
             return jsonify({
-                'error': 'MP3 not found',
-                'message': f'No cached MP3 file found for video {video_id}',
-                'video_id': video_id
+                'error': 'Playlist not found',
+                'message': f'No cached playlist snapshot for {playlist_id}'
             }), 404
 
-        # Extract filename for download
-        filename = os.path.basename(cached_mp3_file)
-        
-        logger.info(f"Serving cached MP3 (v2): {filename}")
-        
-        return send_file(
-            cached_mp3_file,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='audio/mpeg'
+        manifest, files = build_cache_bundle_manifest(playlist_id)
+        logger.info(f"Exporting cache bundle: {len(manifest['videos'])} videos, {len(files)} files")
+
+        bundle_name = f"pytube_cache_{playlist_id or 'all'}.tar"
+        return Response(
+            stream_with_context(generate_cache_bundle(manifest, files)),
+            mimetype='application/x-tar',
+            headers={'Content-Disposition': f'attachment; filename={bundle_name}'}
         )
 
     except Exception as e:
-        logger.error(f"Error serving MP3 (v3) for {video_id}: {str(e)}")
+        logger.error(f"Error exporting cache bundle: {str(e)}")
         return jsonify({
-            'error': 'Failed to serve MP3',
-            'message': str(e),
-            'video_id': video_id
+            'error': 'Failed to export cache',
+            'message': str(e)
+        }), 500
+
+
+@app.route('/v3/cache/import', methods=['POST'])
+def import_cache_bundle_route():
+    """
+    Import a tar bundle produced by /v3/cache/export
+    Requires the X-Admin-Token header (or localhost when no token is configured)
+    Expected body: the raw tar stream (e.g. curl --data-binary @bundle.tar)
+    Returns: JSON summary of the imported files, 400 for an invalid or unsupported bundle
+    """
+    if not is_admin_authorized():
+        return build_admin_forbidden_response()
+
+    try:
+        if not ensure_directory_exists(folder_path):
+            return jsonify({
+                'error': 'Directory creation failed',
+                'message': f'Could not create or access directory: {folder_path}'
+            }), 500
+
+        summary = import_cache_bundle(request.stream)
+        logger.info(f"Imported cache bundle: {summary}")
+        return jsonify(summary)
+
+    except (tarfile.TarError, ValueError) as e:
+        logger.error(f"Invalid cache bundle: {str(e)}")
+        return jsonify({
+            'error': 'Invalid cache bundle',
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        logger.error(f"Error importing cache bundle: {str(e)}")
+        return jsonify({
+            'error': 'Failed to import cache',
+            'message': str(e)
         }), 500
 
 
+# ================= PROFILING ENDPOINTS =================
+
+@app.route('/v3/admin/profiles', methods=['GET'])
+def list_profiles():
+    """
+    List stored request profiles, newest first
+    Requires the X-Profile-Token header (or localhost when no token is configured)
+    Returns: JSON with profiling settings and profile summaries
+    """
+    if not is_profiling_authorized():
+        return build_profiling_forbidden_response()
+
+    return jsonify({
+        'enabled': PROFILING_ENABLED,
+        'sample_rate': PROFILING_SAMPLE_RATE,
+        'profiles': profile_store.list()
+    })
+
+
+@app.route('/v3/admin/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """
+    Get one request profile
+    Expected query parameter: format (optional: 'pstats' downloads the raw profile for
+    pstats/snakeviz, default is a JSON text summary with the allocation summary)
+    """
+    if not is_profiling_authorized():
+        return build_profiling_forbidden_response()
+
+    profile = profile_store.get(profile_id)
+    if not profile:
+        return jsonify({
+            'error': 'Profile not found',
+            'message': f'No profile {profile_id}. Profiles are kept in memory and the oldest are dropped'
+        }), 404
+
+    if request.args.get('format') == 'pstats':
+        return Response(
+            profile['stats'],
+            mimetype='application/octet-stream',
+            headers={'Content-Disposition': f'attachment; filename="{profile_id}.prof"'}
+        )
+
+    return jsonify({key: value for key, value in profile.items() if key != 'stats'})
+
+
+@app.route('/v3/admin/profiles', methods=['DELETE'])
+def clear_profiles():
+    """Delete every stored profile"""
+    if not is_profiling_authorized():
+        return build_profiling_forbidden_response()
+
+    return jsonify({'deleted': profile_store.clear()})
+
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({
@@ -998,5 +5154,15 @@ if __name__ == '__main__':
     else:
         logger.warning(f"Could not create cache directory: {folder_path}")
 
+    # Load (or build) the cache index and persist it in the background
+    cache_index.totals()
+    threading.Thread(target=run_cache_index_flusher, daemon=True).start()
+
+    # Fork the extraction workers up front so the first download starts warm
+    extraction_pool.start()
+
+    # Keep the YouTube session warm (and saved) between extractions
+    threading.Thread(target=run_session_refresher, daemon=True).start()
+
     logger.info(f"Starting YouTube Downloader API on {HOST}:{PORT}")
     app.run(host=HOST, port=PORT, debug=False)
@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.error import HTTPError
+from urllib.parse import quote
+from urllib.request import urlopen
+
+# Configuration
+DEFAULT_SERVER_URL = 'http://127.0.0.1:114'
+DEFAULT_DEVICE = 'warm_cache'  # Device id used for fair scheduling on the server
+DEFAULT_JOBS = 2  # Tracks downloaded in parallel
+DEFAULT_RATE = 20  # Max downloads started per minute
+DEFAULT_STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'warm_cache_state.json')
+PLAYLIST_TIME_OUT = 120  # Seconds to wait for a playlist
+VIDEO_TIME_OUT = 600  # Seconds to wait for one track to download
+
+
+def log(message):
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+
+def get_json(url, timeout):
+    """GET a JSON document from the server"""
+    with urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def to_playlist_url(playlist):
+    """Accept either a playlist URL or a bare playlist id"""
+    if playlist.startswith('http://') or playlist.startswith('https://'):
+        return playlist
+    return f"https://www.youtube.com/playlist?list={playlist}"
+
+
+def load_state(state_file):
+    """Load the tracks that failed in previous runs"""
+    try:
+        if os.path.exists(state_file):
+            with open(state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        log(f"Could not read state file {state_file}: {e}")
+    return {'failed': {}}
+
+
+def save_state(state_file, state):
+    try:
+        temp_file = f"{state_file}.part"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, state_file)
+    except Exception as e:
+        log(f"Could not save state file {state_file}: {e}")
+
+
+class RateLimiter:
+    """Space out download starts so no more than `per_minute` begin each minute"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0
+        self._lock = threading.Lock()
+        self._next_start = 0
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start_at = max(now, self._next_start)
+            self._next_start = start_at + self.interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+
+def is_cached_on_server(server_url, video_id):
+    """Ask the server whether video_id is cached, without triggering a download"""
+    try:
+        get_json(f"{server_url}/v3/peer/{video_id}", timeout=10)
+        return True
+    except HTTPError as e:
+        if e.code == 404:
+            return False
+        raise
+
+
+def warm_video(server_url, device, video_id, rate_limiter):
+    """Download one track through the server at background priority"""
+    if is_cached_on_server(server_url, video_id):
+        return 'cached', None
+
+    rate_limiter.wait()
+    url = f"{server_url}/v3/video/{video_id}?device={quote(device)}&priority=background"
+    try:
+        video_info = get_json(url, timeout=VIDEO_TIME_OUT)
+        return 'downloaded', video_info.get('video_title', '')
+    except HTTPError as e:
+        body = e.read().decode('utf-8', errors='replace')
+        try:
+            message = json.loads(body).get('message', body)
+        except ValueError:
+            message = body
+        return 'failed', f"HTTP {e.code}: {message}"
+
+
+def warm_playlists(server_url, playlists, device, jobs, rate, state_file, retry_failed):
+    state = load_state(state_file)
+    state_lock = threading.Lock()
+
+    # Collect every track first so progress can be reported against a total
+    video_ids = []
+    for playlist in playlists:
+        playlist_url = to_playlist_url(playlist)
+        log(f"Loading playlist: {playlist_url}")
+        items = get_json(
+            f"{server_url}/v3/playlist?url={quote(playlist_url, safe='')}&device={quote(device)}",
+            timeout=PLAYLIST_TIME_OUT
+        )
+        for item in items:
+            video_id = item.get('video_id')
+            if video_id and video_id not in video_ids:
+                video_ids.append(video_id)
+        log(f"Playlist has {len(items)} tracks")
+
+    # Tracks cached by an earlier (interrupted) run are skipped by the server-side check,
+    # known failures are skipped here unless asked to retry them
+    pending = [
+        video_id for video_id in video_ids
+        if retry_failed or video_id not in state['failed']
+    ]
+    log(f"{len(video_ids)} unique tracks, {len(video_ids) - len(pending)} skipped after failing before, "
+        f"{len(pending)} to check")
+
+    rate_limiter = RateLimiter(rate)
+    counts = {'cached': 0, 'downloaded': 0, 'failed': 0}
+    started_at = time.time()
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = {
+            executor.submit(warm_video, server_url, device, video_id, rate_limiter): video_id
+            for video_id in pending
+        }
+        for index, future in enumerate(as_completed(futures), start=1):
+            video_id = futures[future]
+            try:
+                status, detail = future.result()
+            except Exception as e:
+                status, detail = 'failed', str(e)
+
+            counts[status] += 1
+            with state_lock:
+                if status == 'failed':
+                    state['failed'][video_id] = detail
+                else:
+                    state['failed'].pop(video_id, None)
+                save_state(state_file, state)
+
+            elapsed = time.time() - started_at
+            throughput = counts['downloaded'] / elapsed * 60 if elapsed > 0 else 0
+            log(f"[{index}/{len(pending)}] {status:<10} {video_id} {detail or ''} "
+                f"| {throughput:.1f} downloads/min")
+    finally:
+        # Drop queued tracks on Ctrl+C, progress is already saved
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    elapsed = time.time() - started_at
+    log(f"Finished in {elapsed:.0f}s: {counts['downloaded']} downloaded, {counts['cached']} already cached, "
+        f"{counts['failed']} failed")
+    return counts['failed'] == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pre-download every uncached track of one or more playlists through pytube_server'
+    )
+    parser.add_argument('playlists', nargs='+', help='Playlist URLs or playlist ids')
+    parser.add_argument('--server', default=DEFAULT_SERVER_URL, help=f'Server URL (default: {DEFAULT_SERVER_URL})')
+    parser.add_argument('--device', default=DEFAULT_DEVICE, help=f'Device id sent to the server (default: {DEFAULT_DEVICE})')
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS, help=f'Parallel downloads (default: {DEFAULT_JOBS})')
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help=f'Max downloads started per minute (default: {DEFAULT_RATE})')
+    parser.add_argument('--state-file', default=DEFAULT_STATE_FILE, help='File recording tracks that failed')
+    parser.add_argument('--retry-failed', action='store_true', help='Retry tracks that failed in previous runs')
+    args = parser.parse_args()
+
+    try:
+        success = warm_playlists(
+            server_url=args.server.rstrip('/'),
+            playlists=args.playlists,
+            device=args.device,
+            jobs=max(args.jobs, 1),
+            rate=args.rate,
+            state_file=args.state_file,
+            retry_failed=args.retry_failed
+        )
+    except KeyboardInterrupt:
+        log("Interrupted, progress saved. Run the same command again to resume.")
+        sys.exit(130)
+    except Exception as e:
+        log(f"Cache warming failed: {e}")
+        sys.exit(1)
+    sys.exit(0 if success else 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,16 @@ import sys
 import os
 import time
 import glob
+import shutil
 import asyncio
+import requests
 
 __BASE_PATH = '/config/pyscript/servers'
 __INSTALL_REQUIREMENTS_FILE = 'requirements.txt'
 
 __PYTUBE_SERVER_PATH = f'{__BASE_PATH}/pytube'
 __PYTUBE_SERVER_FILE = 'pytube_server.py'
+__PYTUBE_SERVER_URL = 'http://127.0.0.1:114'
 
 def __install_ffmpeg_with_update():
     try:
@@ -82,16 +85,23 @@ def __install_requirements_simple(
 
 
 def __clean_files_in_folder(
-    folder: str
+    folder: str,
+    subfolders=("hls", "thumbs")
 ):
-    """Clean all files from the pytube download folder at midnight daily"""
+    """Clean all files from the pytube download folder (and its cache subfolders) at midnight daily"""
     try:
         files = glob.glob(os.path.join(folder, "*"))
+        for subfolder in subfolders:
+            files += glob.glob(os.path.join(folder, subfolder, "*"))
         removed_count = 0
         for file_path in files:
             if os.path.isfile(file_path):
                 os.remove(file_path)
                 removed_count += 1
+            elif os.path.dirname(file_path) != folder and os.path.isdir(file_path):
+                # e.g. hls/<video_id>/ with its segments
+                shutil.rmtree(file_path, ignore_errors=True)
+                removed_count += 1
         log.info(f"Successfully removed {removed_count} files from {folder}")
     except Exception as e:
         log.error(f"Error cleaning pytube download folder: {e}")
@@ -118,10 +128,22 @@ def __start_server(
         log.error(f"Failed to start {file} server: {e}")
 
 
+def __reindex_server_cache(
+    server_url: str
+):
+    """Ask the server to rebuild its cache index after files were removed"""
+    try:
+        task.executor(requests.post, f"{server_url}/v3/cache/reindex", timeout=60)
+        log.info(f"Requested cache reindex from {server_url}")
+    except Exception as e:
+        log.error(f"Failed to reindex server cache: {e}")
+
+
 @time_trigger("cron(0 0 */2 * *)")
 def clean_downloads():
     """Clean all files from the pytube download folder every 2 days at midnight"""
     __clean_files_in_folder(f"{__PYTUBE_SERVER_PATH}/download")
+    __reindex_server_cache(__PYTUBE_SERVER_URL)
 
 
 @time_trigger("startup")